@@ -1,4 +1,5 @@
 import os
+import sys
 import argparse
 import logging
 import multiprocessing
@@ -6,7 +7,10 @@ import glob
 from pipeline import process_image_segmentation
 from utils import find_files_with_string_in_name
 
-def main():
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nnunet'))
+import tracing
+
+def main(argv=None):
 
     """Main function to process images."""
     parser = argparse.ArgumentParser(description='Image Registration and Skull Stripping.')
@@ -20,7 +24,11 @@ def main():
     parser.add_argument('--log_level', type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         help='Set the logging level (default: INFO)')
 
-    args = parser.parse_args()
+    tracing.add_argument(parser)
+
+    args = parser.parse_args(argv)
+
+    tracing.enable(args.trace)
 
     # Configure logging level
     numeric_level = getattr(logging, args.log_level.upper(), None)
@@ -1,19 +1,19 @@
 import numpy as np
 import matplotlib.pyplot as plt
-import nibabel as nib
 from matplotlib.colors import ListedColormap
 import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nnunet'))
+from nifti_io import load_data
+import tracing
 
 def overlay_slices(image_path, mask_path):
     # Load the NIfTI image and mask
-    image = nib.load(image_path)
-    image_data = image.get_fdata()
+    image_data = np.clip(load_data(image_path, dtype=np.float64), 0, 200)
 
-    image_data[image_data >200] = 200
-    image_data[image_data < 0] = 0
-    
-    mask = nib.load(mask_path)
-    mask_data = mask.get_fdata()
+    mask_data = load_data(mask_path)
 
 
     # Create a custom colormap
@@ -44,14 +44,20 @@ def overlay_slices(image_path, mask_path):
 
     print('Slices saved as PNG files.')
 
-if __name__ == '__main__':
+def main(argv=None):
     # Create an argument parser
     parser = argparse.ArgumentParser(description='Overlay voxel data on NIfTI images.')
     parser.add_argument('--image', type=str, help='Path to the NIfTI image file.')
     parser.add_argument('--mask', type=str, help='Path to the NIfTI mask file.')
 
     # Parse the arguments
-    args = parser.parse_args()
+    tracing.add_argument(parser)
+    args = parser.parse_args(argv)
+    tracing.enable(args.trace)
 
     # Overlay slices with the provided image and mask paths
     overlay_slices(args.image, args.mask)
+
+
+if __name__ == '__main__':
+    main()
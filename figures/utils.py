@@ -4,6 +4,7 @@ import shutil
 import re
 import glob
 import shlex
+import numpy as np
 
 def find_files_with_string_in_name(directory_path, string_in_name):
     # This pattern will match any files that include the specified string in their names
@@ -15,6 +16,16 @@ def find_files_with_string_in_name(directory_path, string_in_name):
     
     return files
 
+def sum_lesions(lesion_paths, shape, load):
+    """
+    Adds up lesion masks into a frequency map (values above 1 are clipped to 1, so every
+    mask counts once per voxel). load(path) returns the data of a mask.
+    """
+    total = np.zeros(shape)
+    for lesion_path in lesion_paths:
+        total += np.minimum(load(lesion_path), 1)
+    return total
+
 def getSubjectID(path):
     """
     This function extracts the ICH ID from the file name, removing any prefixes and returning only the numeric part with 'ICH' prepended.
@@ -1,10 +1,14 @@
 import argparse
 import os
+import sys
 import nibabel as nib
 import datetime
 import multiprocessing
 from utils import getfileList, split_list
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nnunet'))
+import tracing
+
 def edit_sform_qform(im_list, sformcode, qformcode):
     """
     This function applies fslorient to edit the sform and the qform of an image. 
@@ -44,27 +48,32 @@ def edit_sform_qform(im_list, sformcode, qformcode):
 
         # run fslorient copyqform2sform to set sform equal to qform
         print(f'{datetime.datetime.now()}: copyqform2sform...')
-        os.system(f'fslorient -copyqform2sform {im_path}')
+        with tracing.span('fslorient copyqform2sform', 'subprocess', file=os.path.basename(im_path)):
+            os.system(f'fslorient -copyqform2sform {im_path}')
 
         # run fslorient setqformcode to set sform equal to qform
         print(f'{datetime.datetime.now()}: setqformcode...')
-        os.system(f'fslorient -setqformcode {qformcode} {im_path}')
+        with tracing.span('fslorient setqformcode', 'subprocess', file=os.path.basename(im_path)):
+            os.system(f'fslorient -setqformcode {qformcode} {im_path}')
 
         # run fslorient setsformcode to set sform equal to qform
         print(f'{datetime.datetime.now()}: setsformcode...')
-        os.system(f'fslorient -setsformcode {sformcode} {im_path}')
+        with tracing.span('fslorient setsformcode', 'subprocess', file=os.path.basename(im_path)):
+            os.system(f'fslorient -setsformcode {sformcode} {im_path}')
 
         print(f'{datetime.datetime.now()} {im_path}: fslorient DONE!')
 
             
-if __name__ == "__main__":
+def main(argv=None):
 
     parser = argparse.ArgumentParser(description='Edit sform and qform using fslorient.')
     parser.add_argument('-i', '--input_directory', help='Folder containing all images.', required=True)
     parser.add_argument('-n', '--number_of_workers', help='Number of parallel processing cores.', type=int, default=os.cpu_count()-1)
 
     # read the arguments
-    args = parser.parse_args()
+    tracing.add_argument(parser)
+    args = parser.parse_args(argv)
+    tracing.enable(args.trace)
 
     # get directory
     dir = args.input_directory
@@ -93,3 +102,6 @@ if __name__ == "__main__":
     
     print(f'{datetime.datetime.now()}: sform and qform editing DONE!')
 
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Single entry point for the scripts of this repository:
+
+    python ich.py <group> <command> [options]
+    python ich.py volumes batch --input_folder ... --mode ph --output volumes.csv
+    python ich.py dataset ph --image_directory ... --label_directory ... --split_dict ... --output_directory ...
+    python ich.py orient -i ...
+
+`python ich.py` lists the groups and commands, `python ich.py <group> <command> -h` the options
+of a command. Only the module of the invoked command is imported (and with it numpy, nibabel,
+pandas, matplotlib, ...), so listing commands and light commands start quickly. Every command is
+the main(argv) of a script, so batch drivers can also call it in-process:
+
+    import calculate_volumes_batch
+    calculate_volumes_batch.main(["--input_folder", folder, "--mode", "ph", "--output", "volumes.csv"])
+"""
+
+import os
+import sys
+import importlib
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# group -> command -> (folder, module, description); a group with a single command "" is
+# invoked without a command name
+COMMANDS = {
+    "dataset": {
+        "ph": ("nnunet", "create_dataset", "nnU-Net dataset of CTs and PH or edema masks"),
+        "multi_class": ("nnunet", "create_dataset_multi_class", "nnU-Net dataset of CTs and SV/V3/V4 label maps"),
+        "ventricles": ("nnunet", "create_dataset_multi_class_ventricles", "nnU-Net dataset of CTs and ventricle label maps"),
+        "six": ("nnunet", "create_dataset_multi_class_six", "nnU-Net dataset of CTs and six-class label maps"),
+        "combine": ("nnunet", "combine_lesion_masks", "combine SV/V3/V4 masks into one label map"),
+        "separate": ("nnunet", "separate_masks", "split label maps into binary masks"),
+        "synthetic": ("nnunet", "synthetic_data", "write a synthetic head CT / lesion cohort"),
+        "cache": ("nnunet", "volume_cache", "build, evict or verify the uncompressed volume cache"),
+        "gzip_index": ("nnunet", "gzip_index", "build gzip seek indices for single-slice reads"),
+        "store": ("nnunet", "scan_store", "deduplicate source volumes in a content-addressed store"),
+        "uncrop": ("nnunet", "head_crop", "put predictions of head-cropped images back onto the original grid"),
+        "compact_ct": ("nnunet", "compact_ct", "cast CTs with integral values to int16 losslessly"),
+        "fingerprint": ("nnunet", "fingerprint", "nnU-Net dataset fingerprint and per-case statistics"),
+    },
+    "orient": {
+        "": ("fslorient", "edit_sform_qform", "fix the sform/qform of NIfTI files with fslorient"),
+    },
+    "metrics": {
+        "anima": ("nnunet", "nnUNet_compute_test_metrics_anima_bids", "binary metrics with animaSegPerfAnalyzer"),
+        "multi_class": ("nnunet", "compute_multi_class_metrics", "per-class metrics of label maps"),
+        "bootstrap": ("nnunet", "bootstrap_metrics", "bootstrap confidence intervals of per-case metrics"),
+        "threshold_sweep": ("nnunet", "threshold_sweep", "metrics over a range of probability thresholds"),
+        "ensemble": ("nnunet", "ensemble_probabilities", "average the probabilities of several models"),
+        "store": ("nnunet", "results_store", "query and update the results store"),
+    },
+    "volumes": {
+        "batch": ("nnunet", "calculate_volumes_batch", "volumes of all masks of a folder"),
+        "ph": ("nnunet", "calculate_ph_vol_single", "PH volume of one mask"),
+        "edema": ("nnunet", "calculate_edema_vol_single", "edema volume of one mask"),
+        "multi_class": ("nnunet", "calculate_multi_class", "per-class volumes of one label map"),
+        "collect_ph": ("nnunet", "collect_ph", "combine the PH volume CSVs"),
+        "collect_edema": ("nnunet", "collect_edema", "combine the edema volume CSVs"),
+        "collect_multi_class": ("nnunet", "collect_multi_class", "combine the per-class volume CSVs"),
+        "morphology": ("nnunet", "calculate_morphology", "per-lesion shape and location features"),
+    },
+    "postprocess": {
+        "apply": ("nnunet", "postprocess_predictions", "remove implausible components from predictions per class"),
+        "search": ("nnunet", "postprocess_search", "grid search over postprocessing rules from cached component tables"),
+    },
+    "maps": {
+        "frequency": ("figures", "brain_lesion_map", "lesion frequency map of one folder"),
+        "one_row": ("figures", "brain_lesion_map_one_row", "frequency map figure, one row"),
+        "two_rows": ("figures", "brain_lesion_map_two_rows", "frequency map figure of two folders"),
+        "register": ("figures", "process_db_parallel", "register CTs and masks to the template"),
+    },
+    "pipeline": {
+        "": ("nnunet", "run_pipeline", "run the cached pipeline of a TOML file (ich_pipeline.toml)"),
+    },
+    "serve": {
+        "": ("nnunet", "inference_service", "watch a folder and predict and measure new scans with a loaded model"),
+    },
+    "qc": {
+        "snapshot": ("figures", "single_snapshot_lesion", "PNG overlays of every slice of a case"),
+        "benchmark": ("nnunet", "benchmark", "benchmark the hot paths on a synthetic cohort"),
+        "prefetch": ("nnunet", "prefetch", "sequential vs. prefetched volumetry under artificial I/O latency"),
+    },
+}
+
+
+def usage():
+    lines = ["usage: ich.py <group> <command> [options]", ""]
+    for group, commands in COMMANDS.items():
+        for command, (_, module, description) in commands.items():
+            name = f"{group} {command}".strip()
+            lines.append(f"  {name:<28} {description} ({module}.py)")
+    return "\n".join(lines)
+
+
+def resolve(argv):
+    """(folder, module, prog, remaining arguments) of a command line, or None if it names no command."""
+    if not argv or argv[0] not in COMMANDS:
+        return None
+    group, commands = argv[0], COMMANDS[argv[0]]
+    if "" in commands:
+        return commands[""][:2] + (group, argv[1:])
+    if len(argv) < 2 or argv[1] not in commands:
+        return None
+    return commands[argv[1]][:2] + (f"{group} {argv[1]}", argv[2:])
+
+
+def run(argv):
+    """Runs a command (e.g. ["volumes", "batch", "--input_folder", ...]) in this process."""
+    resolved = resolve(argv)
+    if resolved is None:
+        raise SystemExit(usage())
+    folder, module_name, prog, args = resolved
+    # the scripts import their neighbours by name (figures/ and fslorient/ both have a utils.py),
+    # so only the folder of the invoked command goes on the path
+    sys.path.insert(0, os.path.join(ROOT, folder))
+    sys.argv = [f"ich.py {prog}"] + args
+    return importlib.import_module(module_name).main(args)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+        print(usage())
+        sys.exit(0)
+    run(sys.argv[1:])
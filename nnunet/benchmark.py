@@ -0,0 +1,264 @@
+"""
+Benchmarks of the hot paths on a synthetic cohort (see synthetic_data.py), so performance can be
+measured without patient data.
+
+Stages:
+    binarize_segmentation   create_dataset.binarize_segmentation per PH mask (load + threshold)
+    combine_masks           combine_lesion_masks.combine_masks on SV/V3/V4 masks in memory
+    separate_masks          separate_masks.process_mask per label map (load, split, concurrent compressed writes)
+    volumetry               volumetry.label_volumes per label map (load + count)
+    frequency_map           accumulation of all PH masks into a frequency map (figures/utils.sum_lesions)
+    metrics                 confusion matrix + Dice/Jaccard/... per case (compute_multi_class_metrics)
+    create_dataset          create_dataset.py --binarize_labels on the cohort (subprocess)
+    create_dataset_multi    create_dataset_multi_class.py on the cohort (subprocess)
+
+The nifti_io cache of decoded volumes is cleared before every run, so repeats decode the files
+again. Every stage is run --repeats times for the timing and once more under tracemalloc for the peak
+memory of its allocations (for the subprocess stages: the peak RSS of the child processes).
+Throughput is given in cases/s and in MB/s of uncompressed voxel data. With --baseline, the
+results of an earlier run (CSV) are compared, so regressions and improvements show as speedups.
+
+USAGE:
+python benchmark.py --n_cases 10 --repeats 3 --output benchmark.csv
+python benchmark.py --data_dir /tmp/ich_synthetic --stages volumetry metrics --baseline benchmark.csv
+"""
+
+import os
+import sys
+import glob
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import resource
+import subprocess
+import tracemalloc
+import contextlib
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from synthetic_data import write_cohort
+from nifti_io import clear_cache
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'figures'))
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def cohort_files(data_dir):
+    """Files of a synthetic cohort by role."""
+    def files(*parts):
+        return sorted(glob.glob(os.path.join(data_dir, *parts)))
+
+    return {"images": files("images", "*_ct.nii.gz"), "lesions": files("labels", "*_lesionmask.nii.gz"),
+            "combined": files("labels_combined", "*_seg.nii.gz"), "sv": files("labels_ivh", "IVH_SV", "*.nii.gz"),
+            "v3": files("labels_ivh", "IVH_V3", "*.nii.gz"), "v4": files("labels_ivh", "IVH_V4", "*.nii.gz"),
+            "data_dir": data_dir}
+
+
+def voxel_mb(paths):
+    return sum(int(np.prod(nib.load(p).shape)) * nib.load(p).get_data_dtype().itemsize for p in paths) / 1024 ** 2
+
+
+def load_in_memory(path):
+    img = nib.load(path)
+    return nib.Nifti1Image(np.asanyarray(img.dataobj), img.affine, img.header)
+
+
+# every stage: prepare(files) -> (functions, cases, MB of voxel data), untimed; run(state) is timed
+
+def prepare_binarize(files):
+    from create_dataset import binarize_segmentation
+    return binarize_segmentation, list(zip(files["images"], files["lesions"])), voxel_mb(files["lesions"])
+
+
+def run_binarize(state):
+    binarize_segmentation, pairs, _ = state
+    for image, lesion in pairs:
+        binarize_segmentation(image, lesion, 1e-12).get_fdata()
+
+
+def prepare_combine(files):
+    from combine_lesion_masks import combine_masks
+    cases = [tuple(load_in_memory(p) for p in paths) for paths in zip(files["sv"], files["v3"], files["v4"])]
+    return combine_masks, cases, voxel_mb(files["sv"] + files["v3"] + files["v4"])
+
+
+def run_combine(state):
+    combine_masks, cases, _ = state
+    for sv, v3, v4 in cases:
+        combine_masks(sv, sv, v3, v4)
+
+
+def prepare_separate(files):
+    from separate_masks import process_mask, DEFAULT_LABELS
+    return (process_mask, DEFAULT_LABELS), files["combined"], voxel_mb(files["combined"])
+
+
+def run_separate(state):
+    (process_mask, labels), paths, _ = state
+    output_dir = tempfile.mkdtemp(prefix="ich_benchmark_")
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for path in paths:
+                process_mask(path, output_dir, labels)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def prepare_volumetry(files):
+    from volumetry import label_volumes
+    from calculate_multi_class import CLASS_LABELS
+    return (label_volumes, CLASS_LABELS), files["combined"], voxel_mb(files["combined"])
+
+
+def run_volumetry(state):
+    (label_volumes, class_labels), paths, _ = state
+    for path in paths:
+        label_volumes(path, class_labels)
+
+
+def prepare_frequency_map(files):
+    from utils import sum_lesions
+    from nifti_io import load_data
+    shape = nib.load(files["lesions"][0]).shape
+    return (sum_lesions, lambda p: load_data(p, cache=False), shape), files["lesions"], voxel_mb(files["lesions"])
+
+
+def run_frequency_map(state):
+    (sum_lesions, load, shape), paths, _ = state
+    sum_lesions(paths, shape, load)
+
+
+def prepare_metrics(files):
+    from compute_multi_class_metrics import confusion_matrix, case_metrics, load_label_map
+    classes = {"background": 0, "SV": 1, "V3": 2, "V4": 3}
+    # predictions: the GT shifted by one voxel, so all metrics are non-trivial
+    cases = [(load_label_map(p), np.roll(load_label_map(p), 1, axis=0)) for p in files["combined"]]
+    return (confusion_matrix, case_metrics, classes), cases, 2 * voxel_mb(files["combined"])
+
+
+def run_metrics(state):
+    (confusion_matrix, case_metrics, classes), cases, _ = state
+    for index, (gt, pred) in enumerate(cases):
+        case_metrics(str(index), confusion_matrix(gt, pred, len(classes)), classes, {}, 1.0)
+
+
+def prepare_create_dataset(files):
+    data_dir = files["data_dir"]
+    command = [sys.executable, os.path.join(SCRIPT_DIR, "create_dataset.py"),
+               "--image_directory", os.path.join(data_dir, "images"), "--label_directory", os.path.join(data_dir, "labels"),
+               "--split_dict", os.path.join(data_dir, "split.json"), "--binarize_labels"]
+    return command, files["images"], voxel_mb(files["images"] + files["lesions"])
+
+
+def prepare_create_dataset_multi(files):
+    data_dir = files["data_dir"]
+    command = [sys.executable, os.path.join(SCRIPT_DIR, "create_dataset_multi_class.py"),
+               "--image_directory", os.path.join(data_dir, "images_multi_class"),
+               "--label_directory", os.path.join(data_dir, "labels_ivh"),
+               "--split_dict", os.path.join(data_dir, "split_multi_class.json")]
+    return command, files["images"], voxel_mb(files["images"] + files["sv"] + files["v3"] + files["v4"])
+
+
+def run_subprocess(state):
+    command, _, _ = state
+    output_dir = tempfile.mkdtemp(prefix="ich_benchmark_")
+    try:
+        result = subprocess.run(command + ["--output_directory", output_dir], stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed")
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+STAGES = {
+    "binarize_segmentation": (prepare_binarize, run_binarize, False),
+    "combine_masks": (prepare_combine, run_combine, False),
+    "separate_masks": (prepare_separate, run_separate, False),
+    "volumetry": (prepare_volumetry, run_volumetry, False),
+    "frequency_map": (prepare_frequency_map, run_frequency_map, False),
+    "metrics": (prepare_metrics, run_metrics, False),
+    "create_dataset": (prepare_create_dataset, run_subprocess, True),
+    "create_dataset_multi": (prepare_create_dataset_multi, run_subprocess, True),
+}
+
+
+def benchmark_stage(name, files, repeats):
+    """Timing and peak memory of one stage, or a row with the reason why it was skipped."""
+    prepare, run, is_subprocess = STAGES[name]
+    times = []
+    try:
+        state = prepare(files)
+        for _ in range(repeats):
+            clear_cache()
+            start = time.perf_counter()
+            run(state)
+            times.append(time.perf_counter() - start)
+    except (ImportError, RuntimeError) as e:
+        # e.g. a dependency of the dataset scripts that is not installed
+        print(f"{name}: skipped ({e})")
+        return {"stage": name, "skipped": str(e)}
+    n_cases, megabytes = len(state[1]), state[2]
+
+    if is_subprocess:
+        # ru_maxrss of the children is the maximum over all children so far (KB on Linux)
+        peak_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    else:
+        clear_cache()
+        tracemalloc.start()
+        run(state)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        tracemalloc.stop()
+
+    median = float(np.median(times))
+    row = {"stage": name, "cases": n_cases, "repeats": repeats, "median_s": median, "min_s": min(times),
+           "cases_per_s": n_cases / median, "mb_per_s": megabytes / median, "peak_mb": peak_mb, "skipped": ""}
+    print(f"{name}: {median:.3f} s ({row['cases_per_s']:.1f} cases/s, {row['mb_per_s']:.1f} MB/s, "
+          f"peak {peak_mb:.1f} MB)")
+    return row
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths on a synthetic cohort.")
+    parser.add_argument("--data_dir", type=str, default=None,
+                        help="Existing synthetic cohort (default: generate one in a temporary folder).")
+    parser.add_argument("--n_cases", type=int, default=10, help="Number of generated cases.")
+    parser.add_argument("--shape", type=int, nargs=3, default=[256, 256, 48], help="Shape of the generated volumes.")
+    parser.add_argument("--spacing", type=float, nargs=3, default=[0.9, 0.9, 4.0], help="Spacing of the generated volumes.")
+    parser.add_argument("--dtype", type=str, default="int16", help="Stored dtype of the generated CTs.")
+    parser.add_argument("--n_lesions", type=int, default=2, help="Lesions per generated case.")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES), help="Stages to run.")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed repetitions per stage.")
+    parser.add_argument("--output", type=str, default="benchmark.csv", help="Output CSV file.")
+    parser.add_argument("--baseline", type=str, default=None, help="CSV of an earlier run to compare against.")
+    args = parser.parse_args(argv)
+
+    data_dir = args.data_dir
+    if data_dir is None:
+        data_dir = tempfile.mkdtemp(prefix="ich_synthetic_")
+        print(f"Generating {args.n_cases} synthetic cases in {data_dir}...")
+        write_cohort(data_dir, args.n_cases, tuple(args.shape), tuple(args.spacing), args.dtype, args.n_lesions)
+
+    try:
+        files = cohort_files(data_dir)
+        print(f"Python {platform.python_version()}, numpy {np.__version__}, nibabel {nib.__version__}, "
+              f"{os.cpu_count()} CPUs, {len(files['images'])} cases")
+        results = pd.DataFrame([benchmark_stage(name, files, args.repeats) for name in args.stages])
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    if args.baseline:
+        baseline = pd.read_csv(args.baseline).set_index("stage")["median_s"]
+        results["speedup_vs_baseline"] = results["stage"].map(baseline) / results["median_s"]
+
+    results.to_csv(args.output, index=False)
+    print(results.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+    print(f"Saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
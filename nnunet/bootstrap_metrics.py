@@ -0,0 +1,218 @@
+"""
+This script computes bootstrap confidence intervals for test-set metrics and paired
+differences between models (e.g. 2d vs 3d_fullres).
+
+Input are the per-case metric tables written by nnUNet_compute_test_metrics_anima_bids.py or
+compute_multi_class_metrics.py (per_case_metrics.csv). All resamples are drawn at once as a
+(n_resamples x n_cases) index matrix and turned into per-resample case counts. Means and paired
+differences of all metrics are then one matrix product, medians one cumulative sum per metric,
+so 10,000 resamples of 15 metrics for several models take well below a second.
+
+Resampling can be stratified, e.g. by lesion-size bucket, so every resample keeps the number of
+small/medium/large lesions of the test set.
+
+USAGE:
+python bootstrap_metrics.py --table 2d=<metrics_2d>/per_case_metrics.csv --table 3d=<metrics_3d>/per_case_metrics.csv
+--size_column VolTestedLesions --size_bins 5000 30000 -o <output_folder>
+"""
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import tracing
+
+
+ID_COLUMNS = ["subject", "case", "region"]
+
+
+def resample_indices(n_cases, n_resamples, strata=None, seed=1234):
+    """
+    Draws all bootstrap resamples as one (n_resamples, n_cases) index matrix.
+    With strata, every resample draws within each stratum as many cases as the stratum holds.
+    """
+    rng = np.random.default_rng(seed)
+    if strata is None:
+        return rng.integers(0, n_cases, size=(n_resamples, n_cases))
+
+    strata = np.asarray(strata)
+    columns = []
+    for stratum in pd.unique(strata):
+        members = np.flatnonzero(strata == stratum)
+        columns.append(members[rng.integers(0, len(members), size=(n_resamples, len(members)))])
+    return np.concatenate(columns, axis=1)
+
+
+def resample_counts(indices, n_cases):
+    """Converts the index matrix into per-resample case counts with one bincount."""
+    n_resamples = indices.shape[0]
+    offsets = (indices + n_cases * np.arange(n_resamples)[:, None]).ravel()
+    return np.bincount(offsets, minlength=n_resamples * n_cases).reshape(n_resamples, n_cases)
+
+
+def bootstrap_means(values, counts):
+    """
+    Means of every metric for every resample, ignoring NaNs (e.g. metrics skipped for empty GTs).
+    values: (n_cases, n_metrics), counts: (n_resamples, n_cases) -> (n_resamples, n_metrics)
+    """
+    valid = ~np.isnan(values)
+    totals = counts @ np.where(valid, values, 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return totals / (counts @ valid.astype(np.float64))
+
+
+def bootstrap_medians(values, counts):
+    """
+    Medians of every metric for every resample, ignoring NaNs -> (n_resamples, n_metrics).
+    The cases are sorted once per metric; the median of a resample is then found from the
+    cumulative case counts in that order instead of sorting every resample.
+    """
+    medians = np.full((counts.shape[0], values.shape[1]), np.nan)
+    for j in range(values.shape[1]):
+        column = values[:, j]
+        order = np.argsort(column)
+        order = order[~np.isnan(column[order])]
+        if len(order) == 0:
+            continue
+        cumulative = np.cumsum(counts[:, order], axis=1)
+        n_valid = cumulative[:, -1]
+
+        # positions of the two middle elements (identical for odd counts)
+        lower = (cumulative <= ((n_valid - 1) // 2)[:, None]).sum(axis=1)
+        upper = (cumulative <= (n_valid // 2)[:, None]).sum(axis=1)
+        sorted_values = column[order]
+        with np.errstate(invalid="ignore"):
+            result = 0.5 * (sorted_values[np.minimum(lower, len(order) - 1)] + sorted_values[np.minimum(upper, len(order) - 1)])
+        medians[:, j] = np.where(n_valid > 0, result, np.nan)
+    return medians
+
+
+def confidence_interval(samples, alpha):
+    """Percentile interval over the resamples (axis 0)."""
+    with np.errstate(invalid="ignore"):
+        return np.nanpercentile(samples, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+
+
+def summarize(name, metrics, estimate, samples, alpha, statistic):
+    low, high = confidence_interval(samples, alpha)
+    return pd.DataFrame({"model": name, "metric": metrics, "statistic": statistic, "estimate": estimate,
+                         "ci_low": low, "ci_high": high})
+
+
+def bootstrap_model(name, table, metrics, counts, alpha):
+    """Mean and median with confidence intervals of every metric of one model."""
+    values = table[metrics].to_numpy(dtype=np.float64)
+    return pd.concat([
+        summarize(name, metrics, np.nanmean(values, axis=0), bootstrap_means(values, counts), alpha, "mean"),
+        summarize(name, metrics, np.nanmedian(values, axis=0), bootstrap_medians(values, counts), alpha, "median"),
+    ], ignore_index=True)
+
+
+def bootstrap_difference(name_a, table_a, name_b, table_b, metrics, counts, alpha):
+    """
+    Paired differences (a - b) of the metric means. Both tables must be aligned on the same cases,
+    so every resample picks the same cases for both models.
+    """
+    deltas = table_a[metrics].to_numpy(dtype=np.float64) - table_b[metrics].to_numpy(dtype=np.float64)
+    samples = bootstrap_means(deltas, counts)
+    low, high = confidence_interval(samples, alpha)
+
+    # two-sided bootstrap p-value for a mean difference of zero
+    with np.errstate(invalid="ignore"):
+        p_value = 2 * np.minimum(np.nanmean(samples <= 0, axis=0), np.nanmean(samples >= 0, axis=0))
+    return pd.DataFrame({"model_a": name_a, "model_b": name_b, "metric": metrics,
+                         "mean_difference": np.nanmean(deltas, axis=0), "ci_low": low, "ci_high": high,
+                         "p_value": np.minimum(p_value, 1.0)})
+
+
+def size_strata(sizes, bins):
+    """Assigns each case to a lesion-size bucket given the bucket edges."""
+    edges = [-np.inf] + sorted(bins) + [np.inf]
+    labels = [f"<{edges[1]}"] + [f"{lo}-{hi}" for lo, hi in zip(edges[1:-2], edges[2:-1])] + [f">={edges[-2]}"]
+    return pd.cut(sizes, edges, labels=labels, right=False).astype(str).to_numpy()
+
+
+def load_tables(table_args, region=None):
+    """Loads the per-case tables given as NAME=path and aligns them on the cases they share."""
+    tables = {}
+    for table_arg in table_args:
+        name, _, path = table_arg.partition("=")
+        if not path:
+            name, path = os.path.basename(os.path.dirname(os.path.abspath(table_arg))), table_arg
+        table = pd.read_csv(path)
+        if "region" in table.columns:
+            assert region is not None, f'{path} holds several regions, please select one with --region.'
+            table = table[table["region"] == region]
+        tables[name] = table.set_index("case" if "case" in table.columns else "subject")
+
+    shared = sorted(set.intersection(*[set(t.index) for t in tables.values()]))
+    for name, table in tables.items():
+        if len(table) != len(shared):
+            print(f"{name}: using {len(shared)} of {len(table)} cases shared by all tables.")
+        tables[name] = table.loc[shared]
+    return tables
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Bootstrap confidence intervals and paired differences of per-case metrics.')
+    parser.add_argument('--table', action='append', required=True,
+                        help='Per-case metric table as NAME=path.csv. Give multiple times to compare models.')
+    parser.add_argument('--metrics', nargs='+', default=None, help='Metrics to bootstrap (default: all numeric columns).')
+    parser.add_argument('--region', type=str, default=None, help='Region to use from multi-class tables.')
+    parser.add_argument('--n_resamples', type=int, default=10000, help='Number of bootstrap resamples.')
+    parser.add_argument('--alpha', type=float, default=0.05, help='Confidence level is 1 - alpha.')
+    parser.add_argument('--seed', type=int, default=1234, help='Random seed.')
+    parser.add_argument('--strata_column', type=str, default=None, help='Column used to stratify the resampling.')
+    parser.add_argument('--size_column', type=str, default=None, help='Column with the lesion size used for size buckets.')
+    parser.add_argument('--size_bins', type=float, nargs='+', default=None, help='Edges of the lesion-size buckets.')
+    parser.add_argument('-o', '--output_folder', required=True, type=str, help='Path to the output folder.')
+
+    tracing.add_argument(parser)
+
+    args = parser.parse_args(argv)
+
+    tracing.enable(args.trace)
+
+    tables = load_tables(args.table, args.region)
+    names = list(tables)
+    reference = tables[names[0]]
+
+    metrics = args.metrics or [c for c in reference.columns
+                               if c not in ID_COLUMNS and pd.api.types.is_numeric_dtype(reference[c])
+                               and all(c in t.columns for t in tables.values())]
+
+    # strata are taken from the first table so all models are resampled identically
+    strata = None
+    if args.strata_column:
+        strata = reference[args.strata_column].astype(str).to_numpy()
+    elif args.size_column:
+        assert args.size_bins, '--size_bins is required with --size_column.'
+        strata = size_strata(reference[args.size_column].to_numpy(dtype=np.float64), args.size_bins)
+
+    indices = resample_indices(len(reference), args.n_resamples, strata, args.seed)
+    counts = resample_counts(indices, len(reference))
+
+    summary = pd.concat([bootstrap_model(name, tables[name], metrics, counts, args.alpha) for name in names],
+                        ignore_index=True)
+    differences = [bootstrap_difference(a, tables[a], b, tables[b], metrics, counts, args.alpha)
+                   for i, a in enumerate(names) for b in names[i + 1:]]
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    summary.to_csv(os.path.join(args.output_folder, 'bootstrap_summary.csv'), index=False)
+    if differences:
+        differences = pd.concat(differences, ignore_index=True)
+        differences.to_csv(os.path.join(args.output_folder, 'bootstrap_differences.csv'), index=False)
+
+    level = 100 * (1 - args.alpha)
+    print(f'Bootstrap ({args.n_resamples} resamples, {len(reference)} cases, {level:.0f}% CI):')
+    for row in summary[summary['statistic'] == 'mean'].itertuples():
+        print('\t%s %s -> Mean: %0.4f [%0.4f, %0.4f]' % (row.model, row.metric, row.estimate, row.ci_low, row.ci_high))
+    if len(differences):
+        for row in differences.itertuples():
+            print('\t%s - %s %s -> %0.4f [%0.4f, %0.4f] p=%0.4f' % (row.model_a, row.model_b, row.metric,
+                                                                   row.mean_difference, row.ci_low, row.ci_high, row.p_value))
+
+
+if __name__ == "__main__":
+    main()
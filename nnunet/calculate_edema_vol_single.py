@@ -1,24 +1,12 @@
-import nibabel as nib
-import numpy as np
 import os
 import csv
 import argparse
+from volumetry import compute_lesion_volume
+import tracing
 
 def calculate_lesion_volume(mask_path):
     try:
-        # Load the NIfTI file
-        nifti_img = nib.load(mask_path)
-        data = nifti_img.get_fdata()
-        header = nifti_img.header
-        
-        # Calculate voxel volume in mm³
-        voxel_size = np.prod(header.get_zooms())
-        
-        # Calculate number of lesion voxels
-        lesion_voxels = np.sum(data == 1)
-        
-        # Calculate lesion volume
-        lesion_volume = lesion_voxels * voxel_size  # in mm³
+        lesion_voxels, lesion_volume, lesion_volume_ml = compute_lesion_volume(mask_path)
         
         # Prepare the output CSV file name
         csv_file = str(mask_path).replace(".nii.gz", ".csv")
@@ -26,16 +14,22 @@ def calculate_lesion_volume(mask_path):
         # Save results to CSV
         with open(csv_file, mode="w", newline="") as file:
             writer = csv.writer(file)
-            writer.writerow(["filename", "edema_voxels", "edema_volume_mm3"])
-            writer.writerow([os.path.basename(mask_path), lesion_voxels, lesion_volume])
+            writer.writerow(["filename", "edema_voxels", "edema_volume_mm3", "edema_volume_ml"])
+            writer.writerow([os.path.basename(mask_path), lesion_voxels, lesion_volume, lesion_volume_ml])
         
         print(f"Results saved to {csv_file}")
     except Exception as e:
         print(f"Error: {e}")
 
-if __name__ == "__main__":
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Calculate lesion volume from a NIfTI mask file.")
     parser.add_argument("--mask", required=True, type=str, help="Path to the NIfTI mask file.")
-    args = parser.parse_args()
+    tracing.add_argument(parser)
+    args = parser.parse_args(argv)
+    tracing.enable(args.trace)
     
     calculate_lesion_volume(args.mask)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+This script extracts lesion morphology features from a folder of masks: number of components,
+component volumes, bounding box extent, centroid, surface area, sphericity and hemisphere.
+Surface areas are those of the marching cubes mesh of each component (skimage.measure, with the
+voxel spacing, so anisotropic 5 mm slices are accounted for), and the sphericity uses the area
+and the volume enclosed by that mesh, as in the IBSI morphological features.
+
+Every mask is read once. The bounding box of every label is found with a single find_objects
+pass over the label map, components are labelled once per class inside that box, and all
+per-component statistics are computed with bincount/find_objects reductions inside each
+component's own bounding box. Masks are processed in parallel.
+
+Outputs:
+    <output_prefix>_components.csv   one row per connected component
+    <output_prefix>_cases.csv        one row per mask and class
+
+The hemisphere is determined from the world (RAS+) x coordinate of the centroid relative to
+the midline, which defaults to the x coordinate of the center of the volume (--midline_x to
+override, e.g. 0 for images registered to MNI space).
+
+USAGE:
+python calculate_morphology.py --input_folder <folder_with_masks> --output_prefix morphology --num_processes 8
+python calculate_morphology.py --input_folder <folder_with_masks> --dataset_json <dataset.json> --output_prefix morphology
+"""
+
+import os
+import json
+import argparse
+import multiprocessing
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from skimage import measure
+from nifti_io import load_data, load_header
+import tracing
+
+
+def load_class_labels(dataset_json=None):
+    """Class names from a dataset.json, or None to use every label value found in the masks."""
+    if dataset_json is None:
+        return None
+    with open(dataset_json) as f:
+        labels = json.load(f)["labels"]
+    return {name: int(value) for name, value in labels.items() if not isinstance(value, list) and int(value) != 0}
+
+
+def surface_mesh(component, zooms):
+    """
+    Surface area (mm²) and enclosed volume (mm³) of the marching cubes mesh of a binary component
+    at level 0.5, with the voxel spacing.
+    """
+    # padded, so components touching their bounding box still give a closed surface
+    vertices, faces, _, _ = measure.marching_cubes(np.pad(component, 1).astype(np.float32), 0.5, spacing=zooms)
+    area = measure.mesh_surface_area(vertices, faces)
+    # divergence theorem over the closed mesh
+    a, b, c = (vertices[faces[:, i]] for i in range(3))
+    volume = abs(np.einsum("ij,ij->i", a, np.cross(b, c)).sum()) / 6.0
+    return float(area), float(volume)
+
+
+def component_features(labels, num_components, offset, zooms, affine, midline_x):
+    """
+    Per-component statistics of a labelled crop. offset is the position of the crop
+    in the full volume, so bounding boxes and centroids are given in full-volume voxels.
+    """
+    voxel_volume = float(np.prod(zooms))
+    voxels = np.bincount(labels.ravel(), minlength=num_components + 1)
+    rows = []
+    for index, box in enumerate(ndimage.find_objects(labels), start=1):
+        if box is None:
+            continue
+        component = labels[box] == index
+        coordinates = np.nonzero(component)
+        start = np.array([s.start for s in box]) + offset
+        stop = np.array([s.stop for s in box]) + offset
+        centroid = np.array([c.mean() for c in coordinates]) + start
+        world = affine @ np.append(centroid, 1.0)
+
+        volume = voxels[index] * voxel_volume
+        area, mesh_volume = surface_mesh(component, zooms)
+        rows.append({
+            "component": index,
+            "voxels": int(voxels[index]),
+            "volume_mm3": volume,
+            "volume_ml": volume / 1000.0,
+            "bbox_start": tuple(int(s) for s in start),
+            "bbox_stop": tuple(int(s) for s in stop),
+            "extent_x_mm": (stop[0] - start[0]) * zooms[0],
+            "extent_y_mm": (stop[1] - start[1]) * zooms[1],
+            "extent_z_mm": (stop[2] - start[2]) * zooms[2],
+            "centroid_i": centroid[0], "centroid_j": centroid[1], "centroid_k": centroid[2],
+            "centroid_x_mm": world[0], "centroid_y_mm": world[1], "centroid_z_mm": world[2],
+            "surface_area_mm2": area,
+            # area and volume of the same closed mesh (as in IBSI), so the sphericity is at most 1
+            "sphericity": np.pi ** (1 / 3) * (6 * mesh_volume) ** (2 / 3) / area,
+            # RAS+: x increases towards the subject's right
+            "hemisphere": "right" if world[0] > midline_x else "left",
+        })
+    return rows
+
+
+def mask_features(mask_path, class_labels=None, connectivity=3, midline_x=None):
+    """Returns the per-component rows and the per-class rows of one mask."""
+    img, data = load_header(mask_path), load_data(mask_path)
+    if not np.issubdtype(data.dtype, np.integer):
+        data = np.rint(data).astype(np.int32)
+    zooms = [float(z) for z in img.header.get_zooms()[:3]]
+    if midline_x is None:
+        center = (np.array(data.shape[:3]) - 1) / 2.0
+        midline_x = (img.affine @ np.append(center, 1.0))[0]
+
+    # bounding boxes of all label values in one pass
+    boxes = ndimage.find_objects(np.clip(data, 0, None))
+    if class_labels is None:
+        class_labels = {str(value): value for value, box in enumerate(boxes, start=1) if box is not None}
+
+    structure = ndimage.generate_binary_structure(3, connectivity)
+    case = os.path.basename(mask_path).replace(".nii.gz", "")
+    component_rows, case_rows = [], []
+    for name, value in class_labels.items():
+        box = boxes[value - 1] if value <= len(boxes) else None
+        rows = []
+        if box is not None:
+            labels, num_components = ndimage.label(data[box] == value, structure=structure)
+            offset = np.array([s.start for s in box])
+            rows = component_features(labels, num_components, offset, zooms, img.affine, midline_x)
+
+        volumes = np.array([row["volume_ml"] for row in rows])
+        right = sum(row["volume_ml"] for row in rows if row["hemisphere"] == "right")
+        left = sum(row["volume_ml"] for row in rows if row["hemisphere"] == "left")
+        largest = rows[int(volumes.argmax())] if rows else None
+        case_rows.append({
+            "case": case, "class": name,
+            "n_components": len(rows),
+            "volume_ml": volumes.sum(),
+            "largest_component_ml": largest["volume_ml"] if largest else 0.0,
+            "largest_component_sphericity": largest["sphericity"] if largest else np.nan,
+            "largest_component_hemisphere": largest["hemisphere"] if largest else "",
+            "right_volume_ml": right,
+            "left_volume_ml": left,
+            "hemisphere": "" if not rows else ("bilateral" if right and left else ("right" if right else "left")),
+        })
+        component_rows.extend(dict({"case": case, "class": name}, **row) for row in rows)
+
+    return component_rows, case_rows
+
+
+def safe_mask_features(mask_path, class_labels, connectivity, midline_x):
+    """Like mask_features, but reports the error instead of stopping the whole batch."""
+    try:
+        with tracing.span("case", "case", file=os.path.basename(mask_path)):
+            return mask_features(mask_path, class_labels, connectivity, midline_x)
+    except Exception as e:
+        print(f"Error: {mask_path}: {e}")
+        return [], []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract lesion morphology features from NIfTI masks.")
+    parser.add_argument("--input_folder", required=True, type=str, help="Folder containing the NIfTI masks.")
+    parser.add_argument("--pattern", type=str, default="*.nii.gz", help="Pattern of the masks in the input folder.")
+    parser.add_argument("--dataset_json", type=str, default=None,
+                        help="dataset.json providing the class names (default: every label value found).")
+    parser.add_argument("--connectivity", type=int, default=3, choices=[1, 2, 3],
+                        help="Neighbourhood of the components: 1 = 6-, 2 = 18-, 3 = 26-connectivity.")
+    parser.add_argument("--midline_x", type=float, default=None,
+                        help="World x coordinate of the midline (default: center of each volume).")
+    parser.add_argument("--output_prefix", type=str, default="morphology", help="Prefix of the output CSV files.")
+    parser.add_argument("--num_processes", type=int, default=os.cpu_count(), help="Number of processes in parallel.")
+    tracing.add_argument(parser)
+    args = parser.parse_args(argv)
+    tracing.enable(args.trace)
+
+    masks = sorted(str(p) for p in Path(args.input_folder).rglob(args.pattern))
+    class_labels = load_class_labels(args.dataset_json)
+    print(f"Found {len(masks)} masks. Extracting features...")
+
+    with multiprocessing.Pool(processes=args.num_processes) as pool:
+        results = pool.starmap(safe_mask_features,
+                               [(mask, class_labels, args.connectivity, args.midline_x) for mask in masks])
+
+    components = pd.DataFrame([row for component_rows, _ in results for row in component_rows])
+    cases = pd.DataFrame([row for _, case_rows in results for row in case_rows])
+    components.to_csv(f"{args.output_prefix}_components.csv", index=False)
+    cases.to_csv(f"{args.output_prefix}_cases.csv", index=False)
+    print(f"Saved {len(components)} components of {len(masks)} masks to {args.output_prefix}_components.csv "
+          f"and {args.output_prefix}_cases.csv")
+
+
+if __name__ == "__main__":
+    main()
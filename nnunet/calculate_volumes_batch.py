@@ -0,0 +1,173 @@
+"""
+This script computes lesion volumes for a whole folder (or a case catalog) of masks in one
+process launch and writes one combined table.
+
+It replaces running calculate_ph_vol_single.py / calculate_edema_vol_single.py /
+calculate_multi_class.py once per mask followed by collect_ph.py / collect_edema.py /
+collect_multi_class.py. The column layouts of the collected tables are kept, extended by the
+volumes in mL and the background class:
+
+    ph           filename, ph_voxels, ph_volume_mm3, ph_volume_ml                (one row per mask)
+    edema        filename, edema_voxels, edema_volume_mm3, edema_volume_ml       (one row per mask)
+    multi_class  filename, unit, background, SV, V3, V4, total                   (a voxels, a mm³ and a mL row
+                                                                                  per mask, named in unit;
+                                                                                  filename is the
+                                                                                  *_volumes.csv name)
+
+USAGE:
+python calculate_volumes_batch.py --input_folder <folder_with_masks> --mode ph --output combined_ph_data.csv
+python calculate_volumes_batch.py --catalog cases.csv --mode multi_class --output combined_volumes.csv
+
+On network storage, --read_ahead N reads the next N masks in reader threads while the worker
+processes compute (see prefetch.py):
+python calculate_volumes_batch.py --input_folder /media/raid3/.../predictions --mode ph --read_ahead 32 --num_readers 8
+"""
+
+import os
+import argparse
+import functools
+import multiprocessing
+from pathlib import Path
+import pandas as pd
+from volumetry import compute_lesion_volume
+import calculate_multi_class
+from results_store import open_store, load_case_names, parse_case_id, upsert_volumes
+import prefetch
+import tracing
+
+
+DEFAULT_OUTPUTS = {
+    "ph": "combined_ph_data.csv",
+    "edema": "combined_edema_data.csv",
+    "multi_class": "combined_volumes.csv",
+}
+
+
+MASK_TYPES = {"ph": "PH", "edema": "edema"}
+
+
+# unit column of the multi_class rows: the row names of the per-mask CSVs of calculate_multi_class.py
+UNITS = {"voxels": "voxels", "volume_mm3": "volume (mm³)", "volume_ml": "volume (mL)"}
+
+
+def volume_rows(mask_path, mode, raw=None):
+    """
+    Computes the volumes of one mask and returns its rows in the layout of the collect_* scripts
+    and its per-mask-type volumes for the results store.
+    """
+    filename = os.path.basename(mask_path)
+
+    if mode in MASK_TYPES:
+        voxels, volume, volume_ml = compute_lesion_volume(mask_path, raw)
+        rows = [{"filename": filename, f"{mode}_voxels": voxels, f"{mode}_volume_mm3": volume,
+                 f"{mode}_volume_ml": volume_ml}]
+        records = [{"mask_type": MASK_TYPES[mode], "voxels": voxels, "volume_mm3": volume, "volume_ml": volume_ml}]
+        return rows, records
+
+    results = calculate_multi_class.compute_volumes_per_class(mask_path, raw=raw)
+    csv_name = filename.replace(".nii.gz", "_volumes.csv")
+    rows = [dict({"filename": csv_name, "unit": unit}, **{name: values[key] for name, values in results.items()})
+            for key, unit in UNITS.items()]
+    records = [dict({"mask_type": name}, **values) for name, values in results.items()
+               if name not in ("background", "total")]
+    return rows, records
+
+
+def safe_volume_rows(mask_path, mode, raw=None):
+    """Like volume_rows, but reports the error instead of stopping the whole batch."""
+    try:
+        with tracing.span("case", "case", file=os.path.basename(mask_path)):
+            return volume_rows(mask_path, mode, raw)
+    except Exception as e:
+        print(f"Error: {mask_path}: {e}")
+        return [], []
+
+
+def find_masks(input_folder=None, catalog=None, pattern="*.nii.gz"):
+    """Returns the masks of a folder (recursively) or of a case catalog CSV with a "mask" column."""
+    if catalog is not None:
+        table = pd.read_csv(catalog)
+        column = "mask" if "mask" in table.columns else table.columns[0]
+        return [str(p) for p in table[column]]
+    return sorted(str(p) for p in Path(input_folder).rglob(pattern))
+
+
+def prefetched_volume_rows(mask_path, raw, mode):
+    """safe_volume_rows of a mask whose content was read by a prefetch reader thread."""
+    return safe_volume_rows(mask_path, mode, raw)
+
+
+def calculate_volumes(masks, mode, num_processes=4, chunksize=8, store_conn=None, model_id=None,
+                      read_ahead=0, num_readers=4, case_names=None):
+    """
+    Computes the volumes of all masks in a worker pool and returns the combined table.
+    With read_ahead, up to that many masks are read ahead by num_readers threads while the
+    workers compute; with num_processes=0 they are computed in this process. With a results
+    store connection, the volumes are also upserted into the store, nnU-Net case names mapped
+    back to ICH ID and scan date through case_names (see results_store.load_case_names).
+    """
+    if num_processes == 0:
+        results = [safe_volume_rows(mask, mode) for mask in masks]
+    elif read_ahead:
+        compute = functools.partial(prefetched_volume_rows, mode=mode)
+        done = dict(prefetch.run(masks, prefetch.read_bytes, compute, read_ahead=read_ahead, num_readers=num_readers,
+                                 num_workers=num_processes, processes=True))
+        results = [done[mask] or ([], []) for mask in masks]
+    else:
+        with multiprocessing.Pool(processes=num_processes) as pool:
+            results = pool.starmap(safe_volume_rows, [(mask, mode) for mask in masks], chunksize=chunksize)
+
+    if store_conn is not None:
+        store_rows = []
+        for mask, (_, records) in zip(masks, results):
+            ich_id, scan_date = parse_case_id(mask, case_names)
+            store_rows.extend(dict(record, ich_id=ich_id, scan_date=scan_date, model_id=str(model_id),
+                                   source=os.path.abspath(mask)) for record in records)
+        upsert_volumes(store_conn, store_rows)
+        print(f"Upserted {len(store_rows)} rows into the results store")
+
+    return pd.DataFrame([row for rows, _ in results for row in rows])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calculate lesion volumes of many NIfTI masks into one table.")
+    parser.add_argument("--input_folder", type=str, default=None, help="Folder containing the NIfTI masks.")
+    parser.add_argument("--catalog", type=str, default=None, help="CSV listing the masks in a 'mask' column.")
+    parser.add_argument("--pattern", type=str, default="*.nii.gz", help="Pattern of the masks in the input folder.")
+    parser.add_argument("--mode", required=True, choices=list(DEFAULT_OUTPUTS), help="Kind of masks.")
+    parser.add_argument("--output", type=str, default=None, help="Name of the output CSV file.")
+    parser.add_argument("--num_processes", type=int, default=os.cpu_count(), help="Number of processes in parallel.")
+    parser.add_argument("--read_ahead", type=int, default=0,
+                        help="Masks to read ahead in reader threads (for network storage, 0 = off).")
+    parser.add_argument("--num_readers", type=int, default=4, help="Reader threads with --read_ahead.")
+    parser.add_argument("--store", type=str, default=None, help="Also upsert the volumes into this results store.")
+    parser.add_argument("--model_id", type=str, default=None,
+                        help="Model/dataset ID the masks come from (results store key), e.g. 804, or manual for GT masks.")
+    parser.add_argument("--conversion_dict", type=str, default=None,
+                        help="conversion_dict.json of the dataset, maps the case names back to the ICH IDs.")
+    parser.add_argument("--conversion_split", type=str, default="imagesTs", choices=["imagesTr", "imagesTs"],
+                        help="Split folder the masks come from (case names are numbered per split).")
+    tracing.add_argument(parser)
+    args = parser.parse_args(argv)
+    tracing.enable(args.trace)
+    if args.store and not args.model_id:
+        parser.error("--model_id is required with --store (it is part of the results store key).")
+
+    assert (args.input_folder is None) != (args.catalog is None), 'Please provide either --input_folder or --catalog.'
+
+    masks = find_masks(args.input_folder, args.catalog, args.pattern)
+    if not masks:
+        print("No masks found.")
+    else:
+        print(f"Found {len(masks)} masks. Calculating volumes...")
+        output_file = args.output or DEFAULT_OUTPUTS[args.mode]
+        store_conn = open_store(args.store) if args.store else None
+        case_names = load_case_names(args.conversion_dict, args.conversion_split) if args.conversion_dict else None
+        combined_df = calculate_volumes(masks, args.mode, args.num_processes, store_conn=store_conn, model_id=args.model_id,
+                                        read_ahead=args.read_ahead, num_readers=args.num_readers, case_names=case_names)
+        combined_df.to_csv(output_file, index=False)
+        print(f"Combined data saved to {output_file}")
+
+
+if __name__ == "__main__":
+    main()
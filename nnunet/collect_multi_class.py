@@ -2,6 +2,7 @@ import os
 import glob
 import pandas as pd
 import argparse
+import tracing
 
 def combine_csv_files(directory, output_file="combined_volumes.csv"):
     try:
@@ -23,6 +24,8 @@ def combine_csv_files(directory, output_file="combined_volumes.csv"):
             # Transpose rows for class-based stats and add filename as an identifier
             transposed_df = df.set_index("class").T
             transposed_df["filename"] = os.path.basename(file)
+            # one row per unit (voxels, mm³, mL): name it, so readers do not rely on the row order
+            transposed_df.insert(0, "unit", transposed_df.index)
             
             # Append to the combined data list
             combined_data.append(transposed_df)
@@ -30,8 +33,8 @@ def combine_csv_files(directory, output_file="combined_volumes.csv"):
         # Combine all transposed dataframes into a single dataframe
         combined_df = pd.concat(combined_data, ignore_index=True)
 
-        # Reorder columns with 'filename' first
-        columns = ["filename"] + [col for col in combined_df.columns if col != "filename"]
+        # Reorder columns with 'filename' and 'unit' first
+        columns = ["filename", "unit"] + [col for col in combined_df.columns if col not in ("filename", "unit")]
         combined_df = combined_df[columns]
 
         # Save the combined DataFrame to a CSV file
@@ -41,10 +44,16 @@ def combine_csv_files(directory, output_file="combined_volumes.csv"):
     except Exception as e:
         print(f"Error: {e}")
 
-if __name__ == "__main__":
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Combine multiple CSV files with transposed rows into one.")
     parser.add_argument("--directory", required=True, type=str, help="Path to the directory containing CSV files.")
     parser.add_argument("--output", default="combined_volumes.csv", type=str, help="Name of the output CSV file.")
-    args = parser.parse_args()
+    tracing.add_argument(parser)
+    args = parser.parse_args(argv)
+    tracing.enable(args.trace)
     
     combine_csv_files(args.directory, args.output)
+
+
+if __name__ == "__main__":
+    main()
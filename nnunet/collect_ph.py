@@ -2,6 +2,7 @@ import os
 import glob
 import pandas as pd
 import argparse
+import tracing
 
 def combine_csv_files(directory, output_file="combined_ph_data.csv"):
     try:
@@ -27,10 +28,16 @@ def combine_csv_files(directory, output_file="combined_ph_data.csv"):
     except Exception as e:
         print(f"Error: {e}")
 
-if __name__ == "__main__":
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Combine multiple CSV files into one.")
     parser.add_argument("--directory", required=True, type=str, help="Path to the directory containing CSV files.")
     parser.add_argument("--output", default="combined_ph_data.csv", type=str, help="Name of the output CSV file.")
-    args = parser.parse_args()
+    tracing.add_argument(parser)
+    args = parser.parse_args(argv)
+    tracing.enable(args.trace)
     
     combine_csv_files(args.directory, args.output)
+
+
+if __name__ == "__main__":
+    main()
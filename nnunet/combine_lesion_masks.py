@@ -3,17 +3,19 @@ import argparse
 import nibabel as nib
 import numpy as np
 import glob
+from nifti_io import load_image, save
+import tracing
 
 
 
 
 def combine_masks(img, seg_sv, seg_v3, seg_v4):
     """Combines masks based on priority rules and handles overlaps, using V4 label for SV and V4 overlap."""
-    combined = np.zeros_like(seg_sv.get_fdata(), dtype=np.int16)
-    
-    sv_data = seg_sv.get_fdata()
-    v3_data = seg_v3.get_fdata()
-    v4_data = seg_v4.get_fdata()
+    sv_data = np.asanyarray(seg_sv.dataobj)
+    v3_data = np.asanyarray(seg_v3.dataobj)
+    v4_data = np.asanyarray(seg_v4.dataobj)
+
+    combined = np.zeros(sv_data.shape, dtype=np.int16)
     
     # Apply labels: SV=1, V3=2, V4=3
     combined[sv_data > 0] = 1
@@ -32,7 +34,7 @@ def combine_masks(img, seg_sv, seg_v3, seg_v4):
     return nib.Nifti1Image(combined, img.affine, img.header)
 
 
-def main(sv_dir, v4_dir, v3_dir, output_dir):
+def combine_folder(sv_dir, v4_dir, v3_dir, output_dir):
     # Get sorted file lists
     # Get sorted list of .nii.gz files in each directory
 
@@ -49,10 +51,10 @@ def main(sv_dir, v4_dir, v3_dir, output_dir):
         v3_path = v3_files[i]
         
         # Load NIfTI files
-        img = nib.load(sv_path)  # Use any file for affine and header
-        seg_sv = nib.load(sv_path)
-        seg_v4 = nib.load(v4_path)
-        seg_v3 = nib.load(v3_path)
+        seg_sv = load_image(sv_path)
+        seg_v4 = load_image(v4_path)
+        seg_v3 = load_image(v3_path)
+        img = seg_sv  # Use any file for affine and header
         
         # Combine masks
         combined_mask = combine_masks(img, seg_sv, seg_v3, seg_v4)
@@ -60,20 +62,28 @@ def main(sv_dir, v4_dir, v3_dir, output_dir):
         # Save the combined mask
         output_filename = os.path.basename(sv_path).replace("_seg-sv.nii.gz", "_seg-comb.nii.gz")
         output_path = os.path.join(output_dir, output_filename)
-        nib.save(combined_mask, output_path)
+        save(combined_mask, output_path)
         print(f"Saved combined mask: {output_path}")
 
 
-if __name__ == "__main__":
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Combine segmentation masks from three directories.")
     parser.add_argument("--sv", required=True, help="Directory containing seg-SV masks")
     parser.add_argument("--v4", required=True, help="Directory containing seg-V4 masks")
     parser.add_argument("--v3", required=True, help="Directory containing seg-V3 masks")
     parser.add_argument("--output", required=True, help="Output directory for combined masks")
     
-    args = parser.parse_args()
+    tracing.add_argument(parser)
+    
+    args = parser.parse_args(argv)
+    
+    tracing.enable(args.trace)
     
     # Ensure output directory exists
     os.makedirs(args.output, exist_ok=True)
     
-    main(args.sv, args.v4, args.v3, args.output)
+    combine_folder(args.sv, args.v4, args.v3, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Compact int16 storage of CT images.
+
+Some CTs come out of the RPI/fslorient steps as float32 or float64 although they only hold
+integral HU values, which doubles or quadruples their size and decompression time in nnU-Net
+preprocessing and the analysis scripts. Such CTs are cast to int16 without loss: values are
+written as they are if they fit into int16, otherwise with scl_inter as an offset (if their
+range fits into 16 bits). Every cast is verified by decoding the new file and comparing it
+with the original voxel by voxel. CTs with non-integral or non-finite values, or a range that
+does not fit, are refused and kept as they are.
+
+create_dataset*.py write the compact CTs with --compact_ct (with --store, the compact files are
+then put into the store) and report the size and decoding time before and after per dataset,
+with one row per CT in compact_ct.csv.
+
+USAGE (compacts existing files in place; --dry_run only reports):
+python compact_ct.py --input_folder /path/to/nnUNet_raw/Dataset804_ICH_Segmentation --pattern "*_0000.nii.gz" --dry_run
+"""
+
+import os
+import time
+import argparse
+import multiprocessing
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from nifti_io import image_from_bytes, image_to_bytes
+from prefetch import read_bytes, write_bytes
+import tracing
+
+
+# stored dtypes that are not cast
+COMPACT_DTYPES = [np.dtype(np.int8), np.dtype(np.uint8), np.dtype(np.int16)]
+
+INT16 = np.iinfo(np.int16)
+
+
+def compact_image(img, data=None):
+    """
+    int16 image with the voxel values of img, or None if img is stored compactly already.
+    Raises ValueError if the values cannot be stored in int16 without loss.
+    """
+    if img.get_data_dtype() in COMPACT_DTYPES:
+        return None
+    data = np.asanyarray(img.dataobj) if data is None else data
+
+    if not np.all(np.isfinite(data)):
+        raise ValueError(f"{np.count_nonzero(~np.isfinite(data))} non-finite values")
+    non_integral = np.count_nonzero(data != np.rint(data))
+    if non_integral:
+        raise ValueError(f"{non_integral} non-integral values")
+    low, high = float(data.min(initial=0)), float(data.max(initial=0))
+    if high - low > INT16.max - INT16.min:
+        raise ValueError(f"value range {low:g}..{high:g} does not fit into 16 bits")
+
+    inter = 0.0 if low >= INT16.min and high <= INT16.max else low - INT16.min
+    header = img.header.copy()
+    header.set_data_dtype(np.int16)
+    compact = img.__class__((data - inter).astype(np.int16), img.affine, header)
+    compact.header.set_slope_inter(1.0, inter)
+    return compact
+
+
+def compact_bytes(raw, path):
+    """
+    Content of a CT file (path gives the extension) cast to int16, and its report row. The
+    original content is returned if the CT is compact already or the cast is refused.
+    """
+    start = time.perf_counter()
+    img = image_from_bytes(raw)
+    data = np.asanyarray(img.dataobj)
+    read_s = time.perf_counter() - start
+    name = os.path.join(os.path.basename(os.path.dirname(str(path))), os.path.basename(str(path)))
+    row = {"file": name, "dtype": str(img.get_data_dtype()), "bytes": len(raw), "read_s": read_s,
+           "compact_bytes": len(raw), "compact_read_s": read_s}
+
+    try:
+        with tracing.span("compact", "compute", file=row["file"]):
+            compact = compact_image(img, data)
+            if compact is None:
+                row["status"] = "compact already"
+                return raw, row
+            compact_raw = image_to_bytes(compact, path)
+
+            start = time.perf_counter()
+            check = image_from_bytes(compact_raw)
+            check_data = np.asanyarray(check.dataobj)
+            compact_read_s = time.perf_counter() - start
+            if not (np.array_equal(check_data, data) and np.array_equal(check.affine, img.affine)):
+                raise ValueError("round trip is not exact")
+    except ValueError as e:
+        print(f"Warning: {path}: not cast to int16: {e}")
+        row["status"] = f"refused: {e}"
+        return raw, row
+
+    row.update(status="cast", compact_bytes=len(compact_raw), compact_read_s=compact_read_s)
+    return compact_raw, row
+
+
+def compact_file(source, target, dry_run=False):
+    """Writes the compacted content of a CT file to target (may be the source). Returns the report row."""
+    raw, row = compact_bytes(read_bytes(source), target)
+    if not dry_run and (row["status"] == "cast" or os.path.abspath(source) != os.path.abspath(target)):
+        write_bytes(target, raw)
+    return row
+
+
+def report(rows, output_folder=None):
+    """Prints the size and decoding time savings of the rows, and writes them to compact_ct.csv."""
+    table = pd.DataFrame(rows)
+    if output_folder is not None:
+        table.to_csv(os.path.join(output_folder, "compact_ct.csv"), index=False)
+    if table.empty:
+        return table
+    statuses = table["status"].str.split(":").str[0].value_counts()
+    gb = 1024 ** 3
+    before, after = table["bytes"].sum(), table["compact_bytes"].sum()
+    print(f"Compact CT: {statuses.get('cast', 0)} of {len(table)} CTs cast to int16, "
+          f"{statuses.get('compact already', 0)} compact already, {statuses.get('refused', 0)} refused")
+    print(f"Size {before / gb:.2f} GB -> {after / gb:.2f} GB ({100 * (before - after) / max(before, 1):.1f}% smaller), "
+          f"decoding {table['read_s'].sum():.1f} s -> {table['compact_read_s'].sum():.1f} s")
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cast CTs with integral values to int16 in place.")
+    parser.add_argument("--input_folder", required=True, type=str, help="Folder with the CTs (searched recursively).")
+    parser.add_argument("--pattern", type=str, default="*_0000.nii.gz", help="Pattern of the CT files.")
+    parser.add_argument("--dry_run", action="store_true", help="Only report the savings, do not rewrite files.")
+    parser.add_argument("--num_processes", type=int, default=os.cpu_count(), help="Number of processes in parallel.")
+    tracing.add_argument(parser)
+    args = parser.parse_args(argv)
+    tracing.enable(args.trace)
+
+    files = sorted(str(p) for p in Path(args.input_folder).rglob(args.pattern) if p.is_file())
+    print(f"Found {len(files)} CTs. {'Checking' if args.dry_run else 'Compacting'}...")
+    with multiprocessing.Pool(processes=args.num_processes) as pool:
+        rows = pool.starmap(compact_file, [(path, path, args.dry_run) for path in files])
+    report(rows, None if args.dry_run else args.input_folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+This script evaluates multi-class model predictions (e.g. SV/V3/V4 in 807, LV/V4/V3 in the
+ventricles variant or the six-class CSF/IVH scheme in 810) against the reference segmentations.
+
+The ANIMA path (nnUNet_compute_test_metrics_anima_bids.py) only accepts binary masks. Here we
+instead build one KxK confusion matrix per case with a single bincount over the uint8 label
+maps (rows: GT label, columns: predicted label). All per-class and region-merged metrics are
+derived from that matrix, so adding a region (e.g. "all IVH" = labels 4-6) does not require
+re-reading any data.
+
+Class names are taken from the "labels" block of the dataset's dataset.json. Regions can be
+given on the command line (--region IVH=4,5,6) or as list-valued entries in the labels block.
+
+USAGE:
+python compute_multi_class_metrics.py --pred_folder <path_to_predictions> --gt_folder <path_to_labelsTs>
+--dataset_json <path_to_dataset.json> --region IVH=4,5,6 --region CSF=1,2,3 -o <output_folder>
+
+To recompute metrics for new regions from a previous run without touching the NIfTIs:
+python compute_multi_class_metrics.py --from_confusion <output_folder>/confusion_matrices.npz
+--dataset_json <path_to_dataset.json> --region IVH=4,5,6 -o <output_folder>
+"""
+
+import os
+import json
+import argparse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from nifti_io import load_data, load_header
+from results_store import open_store, load_case_names, per_case_metric_rows, upsert_metrics
+import tracing
+
+
+METRIC_NAMES = ["Dice", "Jaccard", "Sensitivity", "Specificity", "PPV", "NPV", "RelativeVolumeError",
+                "VolumeGT_mL", "VolumePred_mL"]
+
+
+def load_label_definitions(dataset_json):
+    """
+    Reads the "labels" block of an nnU-Net dataset.json.
+
+    Returns a dict {class name: label value} for the single labels and a dict
+    {region name: [label values]} for list-valued (region-based) entries.
+    """
+    with open(dataset_json) as f:
+        labels = json.load(f)["labels"]
+
+    classes, regions = {}, {}
+    for name, value in labels.items():
+        if isinstance(value, (list, tuple)):
+            regions[name] = [int(v) for v in value]
+        else:
+            classes[name] = int(value)
+    return classes, regions
+
+
+def parse_regions(region_args):
+    """Parses --region NAME=1,2,3 arguments into {NAME: [1, 2, 3]}."""
+    regions = {}
+    for region in region_args or []:
+        name, _, values = region.partition("=")
+        if not name or not values:
+            raise ValueError(f"Invalid region definition '{region}', expected NAME=1,2,3")
+        regions[name] = [int(v) for v in values.split(",")]
+    return regions
+
+
+def load_label_map(path):
+    """Loads a label map in its stored dtype and returns it as uint8 without a float64 copy."""
+    data = load_data(path)
+    if not np.issubdtype(data.dtype, np.integer):
+        if not np.all(np.mod(data, 1) == 0):
+            raise ValueError(f"{path} contains non-integer label values.")
+    if data.min() < 0 or data.max() > 255:
+        raise ValueError(f"{path} contains label values outside of [0, 255].")
+    return data.astype(np.uint8, copy=False)
+
+
+def confusion_matrix(gt, pred, num_classes):
+    """
+    Computes the KxK confusion matrix of two label maps with one bincount.
+    Entry [i, j] counts the voxels with GT label i and predicted label j.
+    """
+    if gt.shape != pred.shape:
+        raise ValueError(f"Shape mismatch between GT {gt.shape} and prediction {pred.shape}.")
+
+    for name, data in (("GT", gt), ("prediction", pred)):
+        if data.max(initial=0) >= num_classes:
+            unexpected = sorted(set(np.unique(data).tolist()) - set(range(num_classes)))
+            raise ValueError(f"{name} contains labels {unexpected} not defined in dataset.json.")
+
+    # gt*K + pred stays below K*K, so for up to 16 classes the index fits into uint8
+    index_dtype = np.uint8 if num_classes * num_classes <= 256 else np.uint16
+    index = gt.astype(index_dtype, copy=False) * index_dtype(num_classes) + pred.astype(index_dtype, copy=False)
+    counts = np.bincount(index.ravel(), minlength=num_classes * num_classes)
+    return counts.reshape(num_classes, num_classes)
+
+
+def region_metrics(cm, members, voxel_volume_mm3=1.0):
+    """
+    Computes the overlap metrics of a set of labels (a single class or a merged region)
+    treated as foreground, using the confusion matrix only.
+    """
+    members = np.asarray(members)
+    tp = cm[np.ix_(members, members)].sum()
+    gt_pos = cm[members, :].sum()
+    pred_pos = cm[:, members].sum()
+    fp = pred_pos - tp
+    fn = gt_pos - tp
+    tn = cm.sum() - tp - fp - fn
+
+    # undefined ratios (e.g. empty GT) become NaN and are skipped during aggregation
+    with np.errstate(divide="ignore", invalid="ignore"):
+        metrics = {
+            "Dice": np.float64(2 * tp) / (2 * tp + fp + fn),
+            "Jaccard": np.float64(tp) / (tp + fp + fn),
+            "Sensitivity": np.float64(tp) / gt_pos,
+            "Specificity": np.float64(tn) / (tn + fp),
+            "PPV": np.float64(tp) / pred_pos,
+            "NPV": np.float64(tn) / (tn + fn),
+            "RelativeVolumeError": 100.0 * np.float64(pred_pos - gt_pos) / gt_pos,
+        }
+    metrics["VolumeGT_mL"] = gt_pos * voxel_volume_mm3 / 1000.0
+    metrics["VolumePred_mL"] = pred_pos * voxel_volume_mm3 / 1000.0
+    return metrics
+
+
+def case_metrics(case, cm, classes, regions, voxel_volume_mm3):
+    """Returns one row per class and region for a single case."""
+    rows = []
+    targets = [(name, [value]) for name, value in classes.items() if value != 0] + list(regions.items())
+    for name, members in targets:
+        row = {"case": case, "region": name}
+        row.update(region_metrics(cm, members, voxel_volume_mm3))
+        rows.append(row)
+    return rows
+
+
+def get_case_pairs(pred_folder, gt_folder):
+    """Matches prediction and GT files by filename."""
+    preds = {p.name: p for p in Path(pred_folder).glob("*.nii.gz")}
+    gts = {p.name: p for p in Path(gt_folder).glob("*.nii.gz")}
+
+    missing = sorted(set(gts) - set(preds))
+    assert not missing, f'No predictions found for {missing}. Please check the folders.'
+    return [(name.replace(".nii.gz", ""), preds[name], gts[name]) for name in sorted(gts)]
+
+
+def compute_confusion_matrices(pred_folder, gt_folder, num_classes):
+    """Computes the confusion matrix and the voxel volume of every case."""
+    matrices, voxel_volumes = {}, {}
+    for case, pred_file, gt_file in get_case_pairs(pred_folder, gt_folder):
+        with tracing.span("case", "case", case=case):
+            gt_img = load_header(gt_file)
+            gt, pred = load_label_map(gt_file), load_label_map(pred_file)
+            with tracing.span("confusion matrix", "compute", case=case):
+                matrices[case] = confusion_matrix(gt, pred, num_classes)
+            voxel_volumes[case] = float(np.prod(gt_img.header.get_zooms()[:3]))
+        print(f"{case}: done")
+    return matrices, voxel_volumes
+
+
+def save_confusion_matrices(path, matrices, voxel_volumes):
+    cases = sorted(matrices)
+    np.savez(path, cases=np.array(cases), matrices=np.stack([matrices[c] for c in cases]),
+             voxel_volumes=np.array([voxel_volumes[c] for c in cases]))
+
+
+def load_confusion_matrices(path):
+    archive = np.load(path)
+    cases = [str(c) for c in archive["cases"]]
+    matrices = dict(zip(cases, archive["matrices"]))
+    voxel_volumes = dict(zip(cases, archive["voxel_volumes"].tolist()))
+    return matrices, voxel_volumes
+
+
+def evaluate(matrices, voxel_volumes, classes, regions):
+    """Derives the per-case table, the mean/std summary and the pooled metrics from the confusion matrices."""
+    rows = []
+    for case in sorted(matrices):
+        rows.extend(case_metrics(case, matrices[case], classes, regions, voxel_volumes[case]))
+    per_case = pd.DataFrame(rows)
+
+    summary = per_case.groupby("region", sort=False)[METRIC_NAMES].agg(["mean", "std"])
+
+    # pooled matrix over all cases, i.e. the metrics of the test set as one big volume
+    pooled = sum(matrices[case] * voxel_volumes[case] for case in matrices)
+    pooled = pd.DataFrame(case_metrics("pooled", pooled, classes, regions, 1.0)).drop(columns="case")
+    return per_case, summary, pooled
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Compute multi-class test metrics from per-case confusion matrices.')
+    parser.add_argument('--pred_folder', type=str, help='Path to the folder containing nifti images of test predictions')
+    parser.add_argument('--gt_folder', type=str, help='Path to the folder containing nifti images of GT labels')
+    parser.add_argument('--from_confusion', type=str, default=None,
+                        help='Reuse the confusion_matrices.npz of a previous run instead of reading the NIfTIs.')
+    parser.add_argument('--dataset_json', required=True, type=str,
+                        help='Path to the dataset.json of the nnU-Net dataset (provides the class names).')
+    parser.add_argument('--region', action='append', default=[],
+                        help='Merged region to evaluate, e.g. IVH=4,5,6. Can be given multiple times.')
+    parser.add_argument('-o', '--output_folder', required=True, type=str,
+                        help='Path to the output folder to save the test metrics results')
+    parser.add_argument('--store', type=str, default=None, help='Also upsert the per-case metrics into this results store.')
+    parser.add_argument('--model_id', type=str, default=None, help='Model/dataset ID (results store key), e.g. 810.')
+    parser.add_argument('--conversion_dict', type=str, default=None,
+                        help='conversion_dict.json of the dataset, maps the case names back to the ICH IDs.')
+    parser.add_argument('--conversion_split', type=str, default='imagesTs', choices=['imagesTr', 'imagesTs'],
+                        help='Split folder the evaluated cases come from (case names are numbered per split).')
+
+    tracing.add_argument(parser)
+
+    args = parser.parse_args(argv)
+    if args.store and not args.model_id:
+        parser.error('--model_id is required with --store (it is part of the results store key).')
+
+    tracing.enable(args.trace)
+
+    classes, regions = load_label_definitions(args.dataset_json)
+    regions.update(parse_regions(args.region))
+    num_classes = max(list(classes.values()) + [v for members in regions.values() for v in members]) + 1
+
+    os.makedirs(args.output_folder, exist_ok=True)
+
+    if args.from_confusion:
+        matrices, voxel_volumes = load_confusion_matrices(args.from_confusion)
+    else:
+        assert args.pred_folder and args.gt_folder, '--pred_folder and --gt_folder are required without --from_confusion.'
+        matrices, voxel_volumes = compute_confusion_matrices(args.pred_folder, args.gt_folder, num_classes)
+        save_confusion_matrices(os.path.join(args.output_folder, "confusion_matrices.npz"), matrices, voxel_volumes)
+
+    per_case, summary, pooled = evaluate(matrices, voxel_volumes, classes, regions)
+    per_case.to_csv(os.path.join(args.output_folder, "per_case_metrics.csv"), index=False)
+    summary.to_csv(os.path.join(args.output_folder, "summary_metrics.csv"))
+    pooled.to_csv(os.path.join(args.output_folder, "pooled_metrics.csv"), index=False)
+
+    if args.store:
+        case_names = load_case_names(args.conversion_dict, args.conversion_split) if args.conversion_dict else None
+        upsert_metrics(open_store(args.store), per_case_metric_rows(per_case, args.model_id, case_names=case_names,
+                                                                    source=os.path.abspath(args.output_folder)))
+
+    # Print aggregation of each metric via mean and standard dev.
+    print('Test Phase Metrics [multi-class]: ')
+    for region in summary.index:
+        print(f'{region}:')
+        for key in METRIC_NAMES:
+            print('\t%s -> Mean: %0.4f Std: %0.2f' % (key, summary.loc[region, (key, "mean")], summary.loc[region, (key, "std")]))
+
+
+if __name__ == "__main__":
+    main()
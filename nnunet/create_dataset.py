@@ -1,16 +1,21 @@
 import argparse
-from cProfile import label
 import pathlib
 from pathlib import Path
 import json
 import os
-import shutil
 from collections import OrderedDict
 import sys
 import nibabel as nib
 import numpy as np
 from tqdm import tqdm
 import re
+from nifti_io import load_data, load_header, header_from_bytes, image_from_bytes, image_to_bytes
+from scan_store import ScanStore, MODES, place
+from fingerprint import case_fingerprint, samples_per_case, write_fingerprint
+import compact_ct
+import head_crop
+import prefetch
+import tracing
 
 # this script is employed to generate the nn-Unet based dataset format
 # as described in this readme:
@@ -48,19 +53,101 @@ def query_yes_no(question, default="yes"):
         else:
             sys.stdout.write("Please respond with 'yes' or 'no' " "(or 'y' or 'n').\n")
 
-def binarize_segmentation(ax_file_nnunet, seg_file_nnunet, threshold):
-    image = nib.load(seg_file_nnunet)
-    data = image.get_fdata()
+def binarize_image(data, ref_header, threshold):
     data = np.where(data > threshold, 1, 0)
-    ref = nib.load(ax_file_nnunet)
-    return nib.Nifti1Image(data.astype(int), ref.affine, ref.header)
+    return nib.Nifti1Image(data.astype(int), ref_header.get_best_affine(), ref_header)
+
+def binarize_segmentation(ax_file_nnunet, seg_file, threshold):
+    return binarize_image(load_data(seg_file), load_header(ax_file_nnunet).header, threshold)
+
+def convert_cases(jobs, binarize, threshold, store=None, store_mode='hardlink', read_ahead=0, num_readers=4, num_workers=None,
+                  fingerprint_samples=None, compact=False, crop_margin_mm=None, crop_threshold_hu=-300.0):
+    """
+    Writes the (img_file, img_file_nnunet, seg_file, seg_file_nnunet) jobs: the CT is copied (or
+    linked through the store), the label copied (or linked) or binarized. With read_ahead, the sources are
+    read ahead by reader threads and the outputs written behind by writer threads while other
+    cases are binarized (see prefetch.py). With crop_margin_mm, CT and label are cropped to the
+    head (see head_crop.py). With fingerprint_samples, the nnU-Net fingerprint of every case is
+    computed from the data already in memory (see fingerprint.py). With compact, CTs with
+    integral values are written as int16 (see compact_ct.py). Cropped or compacted CTs are put
+    into the store after they were written.
+    Returns the jobs that failed, {img_file_nnunet: case fingerprint}, the compact_ct report rows
+    and the crop_offsets.json entries.
+    """
+    crop = crop_margin_mm is not None
+    rewrite_ct = compact or crop
+
+    def read(job):
+        img_file, _, seg_file, _ = job
+        # files that are linked from the store are not read (of the CT, only the header is needed)
+        img_raw = prefetch.read_bytes(img_file) if store is None or rewrite_ct else None
+        seg_raw = prefetch.read_bytes(seg_file) if store is None or binarize or crop else None
+        return img_raw, seg_raw
+
+    def compute(job, raw):
+        img_file, img_file_nnunet, seg_file, seg_file_nnunet = job
+        img_raw, seg_raw = raw
+        ref_header = header_from_bytes(img_raw) if img_raw is not None else load_header(img_file).header
+        image = label = fingerprint = compact_row = crop_entry = None
+        if binarize:
+            label = binarize_image(np.asanyarray(image_from_bytes(seg_raw).dataobj), ref_header, threshold)
+        if crop or fingerprint_samples is not None:
+            image = image_from_bytes(img_raw) if img_raw is not None else load_header(img_file)
+            if label is None:
+                label = image_from_bytes(seg_raw) if seg_raw is not None else load_header(seg_file)
+        if crop:
+            image, label, crop_entry = head_crop.crop_case(image, label, crop_margin_mm, crop_threshold_hu)
+            img_raw = image_to_bytes(image, img_file_nnunet)
+        if binarize or crop:
+            seg_raw = image_to_bytes(label, seg_file_nnunet)
+        if fingerprint_samples is not None:
+            fingerprint = case_fingerprint(np.asanyarray(image.dataobj), np.asanyarray(label.dataobj),
+                                           ref_header.get_zooms(), fingerprint_samples)
+        if compact:
+            img_raw, compact_row = compact_ct.compact_bytes(img_raw, img_file_nnunet)
+        return img_raw, seg_raw, fingerprint, compact_row, crop_entry
+
+    def write(job, result):
+        _, img_file_nnunet, _, seg_file_nnunet = job
+        img_raw, seg_raw = result[:2]
+        if img_raw is not None:
+            prefetch.write_bytes(img_file_nnunet, img_raw)
+        if seg_raw is not None:
+            prefetch.write_bytes(seg_file_nnunet, seg_raw)
+
+    failed, fingerprints, compact_rows, crop_offsets, rewritten = [], {}, [], {}, []
+    for job, result in tqdm(prefetch.run(jobs, read, compute, write, read_ahead=read_ahead, num_readers=num_readers,
+                                         num_workers=num_workers), total=len(jobs)):
+        if result is None:
+            failed.append(job)
+            continue
+        _, _, fingerprint, compact_row, crop_entry = result
+        if fingerprint is not None:
+            fingerprints[job[1]] = fingerprint
+        if compact_row is not None:
+            compact_rows.append(compact_row)
+        if crop_entry is not None:
+            crop_offsets[head_crop.case_key(job[1])] = crop_entry
+        if store is not None:
+            # the store's index is only used from this thread
+            img_file, img_file_nnunet, seg_file, seg_file_nnunet = job
+            if rewrite_ct:
+                rewritten.append(img_file_nnunet)
+            else:
+                place(os.path.abspath(img_file), img_file_nnunet, store, store_mode)
+            if not (binarize or crop):
+                place(os.path.abspath(seg_file), seg_file_nnunet, store, store_mode)
+    if rewritten:
+        # the cropped / compact CTs were written by the writers, now they are moved into the store
+        store.ingest(rewritten, store_mode, num_workers)
+    return failed, fingerprints, compact_rows, dict(sorted(crop_offsets.items()))
 
 # Function to extract ICH ID using regex
 def extract_ich_id(filename):
     match = re.search(r"ICH\d+", filename)
     return match.group() if match else None
 
-if __name__ == '__main__':
+def main(argv=None):
 
     # Unfortunately, the incoming data structure is NOT BIDS
     # It looks like this:
@@ -87,7 +174,26 @@ if __name__ == '__main__':
     parser.add_argument('--binarize_labels', action='store_true', help="Binarize the label for nn-unet.")
     parser.add_argument('--threshold', type=float, default=1e-12, help="Binarizeation threshold for the label(s) for nn-unet.")
 
-    args = parser.parse_args()
+    parser.add_argument('--read_ahead', type=int, default=0, help='Cases to read ahead / write behind in background threads, for network storage (0 = off, see prefetch.py).')
+    parser.add_argument('--num_readers', type=int, default=4, help='Reader threads used with --read_ahead.')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='Threads binarizing labels with --read_ahead.')
+
+    parser.add_argument('--fingerprint', action='store_true', help='Also write the nnU-Net dataset_fingerprint.json and case_stats.csv, computed while converting (see fingerprint.py).')
+
+    parser.add_argument('--crop_head', action='store_true', help='Crop CTs and labels to the head and record the offsets in crop_offsets.json (see head_crop.py).')
+    parser.add_argument('--crop_margin_mm', type=float, default=10.0, help='Margin around the head used with --crop_head.')
+    parser.add_argument('--crop_threshold_hu', type=float, default=-300.0, help='HU threshold of the head used with --crop_head.')
+    parser.add_argument('--compact_ct', action='store_true', help='Write CTs with integral values as int16 (lossless, verified; see compact_ct.py).')
+
+    parser.add_argument('--store', default=None, help='Content-addressed scan store (see scan_store.py): link the CTs from it instead of copying them.')
+    parser.add_argument('--store_mode', choices=MODES, default='hardlink', help='Link type used with --store.')
+
+    tracing.add_argument(parser)
+
+    args = parser.parse_args(argv)
+
+    tracing.enable(args.trace)
+    store = ScanStore(args.store) if args.store else None
 
     path_in_images = Path(args.image_directory)
     path_in_labels = Path(args.label_directory)
@@ -110,8 +216,12 @@ if __name__ == '__main__':
     train_image_labels = []
     test_image_labels = []
     conversion_dict = {}
+    jobs = []
 
     images = sorted(list(path_in_images.rglob(f'*{args.image_str}*')))
+    if store is not None:
+        # hash all CTs in parallel up front, placing them then only looks up the hashes
+        store.digests([str(p) for p in images])
     masks = sorted(list(path_in_labels.rglob(f'*{args.label_str}*')))
 
     print(len(images))
@@ -161,25 +271,12 @@ if __name__ == '__main__':
             img_file_nnunet = os.path.join(path_out_imagesTr,f'{args.taskname}_{scan_cnt_train:04d}_0000.nii.gz')
             train_image.append(str(img_file_nnunet))
 
-            # create a system link (instead of copying)
-            shutil.copy(os.path.abspath(img_file), img_file_nnunet)
             conversion_dict[str(os.path.abspath(img_file))] = img_file_nnunet
 
             seg_file_nnunet = os.path.join(path_out_labelsTr,f'{args.taskname}_{scan_cnt_train:04d}.nii.gz')
 
-            # segmentation files
-
-            if args.binarize_labels:
-                # we copy the original label and binarize it
-                shutil.copyfile(seg_file, seg_file_nnunet)
-                # overwrite the label file
-                new_image = binarize_segmentation(img_file_nnunet, seg_file_nnunet, args.threshold)
-                nib.save(new_image, seg_file_nnunet)
-
-            else:
-                # we only create a symlink
-                shutil.copy(os.path.abspath(seg_file), seg_file_nnunet)
-
+            # the CT is copied (or linked) and the label copied or binarized by convert_cases below
+            jobs.append((img_file, img_file_nnunet, seg_file, seg_file_nnunet))
 
             train_image_labels.append(str(seg_file_nnunet))
 
@@ -190,25 +287,12 @@ if __name__ == '__main__':
             img_file_nnunet = os.path.join(path_out_imagesTs,f'{args.taskname}_{scan_cnt_test:04d}_0000.nii.gz')
             test_image.append(str(img_file_nnunet))
 
-            # create a system link (instead of copying)
-            shutil.copy(os.path.abspath(img_file), img_file_nnunet)
             conversion_dict[str(os.path.abspath(img_file))] = img_file_nnunet
 
             seg_file_nnunet = os.path.join(path_out_labelsTs,f'{args.taskname}_{scan_cnt_test:04d}.nii.gz')
 
-            # segmentation files
-
-            if args.binarize_labels:
-                # we copy the original label and binarize it
-                shutil.copyfile(seg_file, seg_file_nnunet)
-                # overwrite the label file
-                new_image = binarize_segmentation(img_file_nnunet, seg_file_nnunet, args.threshold)
-                nib.save(new_image, seg_file_nnunet)
-
-            else:
-                # we only create a symlink
-                shutil.copy(os.path.abspath(seg_file), seg_file_nnunet)
-
+            # the CT is copied (or linked) and the label copied or binarized by convert_cases below
+            jobs.append((img_file, img_file_nnunet, seg_file, seg_file_nnunet))
 
             test_image_labels.append(str(seg_file_nnunet))
 
@@ -216,6 +300,23 @@ if __name__ == '__main__':
             print("Skipping file, could not be located in the specified split.", img_file)
 
 
+    fingerprint_samples = samples_per_case(len(train_image)) if args.fingerprint else None
+    failed, fingerprints, compact_rows, crop_offsets = convert_cases(
+        jobs, args.binarize_labels, args.threshold, store, args.store_mode, args.read_ahead, args.num_readers, args.num_workers,
+        fingerprint_samples, args.compact_ct, args.crop_margin_mm if args.crop_head else None, args.crop_threshold_hu)
+    assert not failed, f'{len(failed)} cases could not be converted'
+    if args.crop_head:
+        head_crop.write_offsets(crop_offsets, path_out)
+    if args.compact_ct:
+        compact_ct.report(compact_rows, path_out)
+
+    if args.fingerprint:
+        cases = [dict(fingerprints[img_file_nnunet], case=os.path.basename(seg_file_nnunet)[:-len('.nii.gz')],
+                      split='train' if img_file_nnunet in set(train_image) else 'test', source=os.path.abspath(img_file))
+                 for img_file, img_file_nnunet, _, seg_file_nnunet in jobs]
+        for path in write_fingerprint(cases, path_out):
+            print(f'Fingerprint saved to {path}')
+
     print(scan_cnt_test)
     print(scan_cnt_train)
 
@@ -272,3 +373,7 @@ if __name__ == '__main__':
     dataset_dict_name = f"dataset.json"
     with open(os.path.join(path_out, dataset_dict_name), "w", encoding="utf-8") as outfile:
         outfile.write(json_object + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,16 @@ from pathlib import Path
 import json
 import os
 from collections import OrderedDict
-import shutil
 import sys
 import nibabel as nib
 import numpy as np
 import re
 from tqdm import tqdm
+from nifti_io import load_data, load_header, save
+from scan_store import ScanStore, MODES, place
+import compact_ct
+import head_crop
+import tracing
 
 def query_yes_no(question, default="yes"):
     """Ask a yes/no question via input() and return their answer."""
@@ -28,18 +32,18 @@ def query_yes_no(question, default="yes"):
 
 def binarize_mask(mask_file, threshold):
     """Binarizes a mask file based on the threshold."""
-    img = nib.load(mask_file)
-    data = img.get_fdata()
+    img = load_header(mask_file)
+    data = load_data(mask_file)
     binarized_data = np.where(data > threshold, 1, 0)
     return nib.Nifti1Image(binarized_data.astype(np.int16), img.affine, img.header)
 
 def combine_masks(img, seg_sv, seg_v3, seg_v4):
     """Combines masks based on priority rules and handles overlaps, using V4 label for SV and V4 overlap."""
-    combined = np.zeros_like(seg_sv.get_fdata(), dtype=np.int16)
-    
-    sv_data = seg_sv.get_fdata()
-    v3_data = seg_v3.get_fdata()
-    v4_data = seg_v4.get_fdata()
+    sv_data = np.asanyarray(seg_sv.dataobj)
+    v3_data = np.asanyarray(seg_v3.dataobj)
+    v4_data = np.asanyarray(seg_v4.dataobj)
+
+    combined = np.zeros(sv_data.shape, dtype=np.int16)
     
     # Apply labels: SV=1, V3=2, V4=3
     combined[sv_data > 0] = 1
@@ -69,11 +73,11 @@ def process_labels(img_path, label_paths, threshold, output_path, taskname, scan
     v4_binarized = binarize_mask(v4_file, threshold)
     
     # Combine masks
-    combined_mask = combine_masks(nib.load(img_path), sv_binarized, v3_binarized, v4_binarized)
+    combined_mask = combine_masks(load_header(img_path), sv_binarized, v3_binarized, v4_binarized)
     
     # Save combined mask
     output_file = os.path.join(output_path, f'{taskname}_{scan_num:04d}.nii.gz')
-    nib.save(combined_mask, output_file)
+    save(combined_mask, output_file)
     
     return output_file
 
@@ -81,7 +85,7 @@ def extract_ich_id(filename):
     match = re.search(r"(ICH\d+)_(\d{8})", filename)
     return match.group() if match else None
 
-if __name__ == '__main__':
+def main(argv=None):
     parser = argparse.ArgumentParser(description='Convert dataset to nn-UNet format.')
     parser.add_argument('--image_directory', help='Path to image directory.', required=True)
     parser.add_argument('--label_directory', help='Path to label directory.', required=True)
@@ -92,7 +96,19 @@ if __name__ == '__main__':
     parser.add_argument('--binarize_labels', action='store_true', help="Binarize the label for nn-unet.")
     parser.add_argument('--threshold', type=float, default=1e-12, help="Binarization threshold for the labels.")
 
-    args = parser.parse_args()
+    parser.add_argument('--crop_head', action='store_true', help='Crop CTs and labels to the head and record the offsets in crop_offsets.json (see head_crop.py).')
+    parser.add_argument('--crop_margin_mm', type=float, default=10.0, help='Margin around the head used with --crop_head.')
+    parser.add_argument('--crop_threshold_hu', type=float, default=-300.0, help='HU threshold of the head used with --crop_head.')
+    parser.add_argument('--compact_ct', action='store_true', help='Write CTs with integral values as int16 (lossless, verified; see compact_ct.py).')
+    parser.add_argument('--store', default=None, help='Content-addressed scan store (see scan_store.py): link the CTs from it instead of copying them.')
+    parser.add_argument('--store_mode', choices=MODES, default='hardlink', help='Link type used with --store.')
+
+    tracing.add_argument(parser)
+
+    args = parser.parse_args(argv)
+
+    tracing.enable(args.trace)
+    store = ScanStore(args.store) if args.store else None
 
     path_in_images = Path(args.image_directory)
     path_in_labels = Path(args.label_directory)
@@ -113,6 +129,9 @@ if __name__ == '__main__':
     conversion_dict = {}
 
     images = sorted(list(path_in_images.rglob('*.nii.gz')))
+    if store is not None:
+        # hash all CTs in parallel up front, placing them then only looks up the hashes
+        store.digests([str(p) for p in images])
 
     with open(args.split_dict) as f:
         splits = json.load(f)
@@ -120,6 +139,20 @@ if __name__ == '__main__':
     valid_train_imgs = [item for item in splits["train"]]# for item in sublist]
     valid_test_imgs = [item for item in splits["test"]] # for item in sublist]
 
+    compact_rows, crop_offsets = [], {}
+
+    def place_ct(img_file, img_file_nnunet):
+        if args.compact_ct:
+            # cast to int16 and written here, with --store moved into the store after the loop
+            compact_rows.append(compact_ct.compact_file(img_file, img_file_nnunet))
+        else:
+            place(img_file, img_file_nnunet, store, args.store_mode)
+
+    def crop_case(img_file_nnunet, seg_file_nnunet):
+        if args.crop_head:
+            crop_offsets[head_crop.case_key(img_file_nnunet)] = head_crop.crop_files(
+                img_file_nnunet, seg_file_nnunet, args.crop_margin_mm, args.crop_threshold_hu)
+
     scan_cnt_train, scan_cnt_test = 0, 0
 
     for img_file in tqdm(images):
@@ -139,23 +172,33 @@ if __name__ == '__main__':
         if f'{ich_id}_ct_0000.nii.gz' in valid_train_imgs:
             scan_cnt_train += 1
             img_file_nnunet = os.path.join(path_out_imagesTr, f'{args.taskname}_{scan_cnt_train:04d}_0000.nii.gz')
-            shutil.copyfile(os.path.abspath(img_file), img_file_nnunet)
+            place_ct(os.path.abspath(img_file), img_file_nnunet)
             conversion_dict[str(os.path.abspath(img_file))] = img_file_nnunet
             
             seg_file_nnunet = process_labels(img_file, label_paths, args.threshold, path_out_labelsTr, args.taskname, scan_cnt_train)
+            crop_case(img_file_nnunet, seg_file_nnunet)
             train_image.append(str(img_file_nnunet))
             train_image_labels.append(str(seg_file_nnunet))
 
         elif f'{ich_id}_ct_0000.nii.gz' in valid_test_imgs:
             scan_cnt_test += 1
             img_file_nnunet = os.path.join(path_out_imagesTs, f'{args.taskname}_{scan_cnt_test:04d}_0000.nii.gz')
-            shutil.copyfile(os.path.abspath(img_file), img_file_nnunet)
+            place_ct(os.path.abspath(img_file), img_file_nnunet)
             conversion_dict[str(os.path.abspath(img_file))] = img_file_nnunet
             
             seg_file_nnunet = process_labels(img_file, label_paths, args.threshold, path_out_labelsTs, args.taskname, scan_cnt_test)
+            crop_case(img_file_nnunet, seg_file_nnunet)
             test_image.append(str(img_file_nnunet))
             test_image_labels.append(str(seg_file_nnunet))
 
+    if args.crop_head:
+        head_crop.write_offsets(crop_offsets, path_out)
+    if args.compact_ct:
+        compact_ct.report(compact_rows, path_out)
+    if store is not None and (args.compact_ct or args.crop_head):
+        # the cropped / compact CTs were written, not linked: move them into the store
+        store.ingest(train_image + test_image, args.store_mode)
+
     json_dict = OrderedDict({
         'name': args.taskname,
         'description': args.taskname,
@@ -177,3 +220,7 @@ if __name__ == '__main__':
 
     with open(os.path.join(path_out, "conversion_dict.json"), "w") as outfile:
         json.dump(conversion_dict, outfile, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,16 @@ from pathlib import Path
 import json
 import os
 from collections import OrderedDict
-import shutil
 import sys
 import nibabel as nib
 import numpy as np
 import re
 from tqdm import tqdm
+from nifti_io import load_data, load_header, save
+from scan_store import ScanStore, MODES, place
+import compact_ct
+import head_crop
+import tracing
 
 def query_yes_no(question, default="yes"):
     valid = {"yes": True, "y": True, "ye": True, "no": False, "n": False}
@@ -26,8 +30,8 @@ def query_yes_no(question, default="yes"):
             sys.stdout.write("Please respond with 'yes' or 'no' (or 'y' or 'n').\n")
 
 def process_single_mask(label_path):
-    img = nib.load(label_path)
-    data = img.get_fdata().astype(np.uint8)
+    img = load_header(label_path)
+    data = load_data(label_path, dtype=np.uint8)
 
     return nib.Nifti1Image(data, img.affine, img.header)
 
@@ -35,7 +39,7 @@ def extract_ich_id(filename):
     match = re.search(r"(ICH\d+)_(\d{8})", filename)
     return match.group() if match else None
 
-if __name__ == '__main__':
+def main(argv=None):
     parser = argparse.ArgumentParser(description='Convert single multiclass label dataset to nn-UNet format.')
     parser.add_argument('--image_directory', required=True)
     parser.add_argument('--label_directory', required=True)
@@ -44,7 +48,19 @@ if __name__ == '__main__':
     parser.add_argument('--tasknumber', default=810, type=int)
     parser.add_argument('--split_dict', required=True)
 
-    args = parser.parse_args()
+    parser.add_argument('--crop_head', action='store_true', help='Crop CTs and labels to the head and record the offsets in crop_offsets.json (see head_crop.py).')
+    parser.add_argument('--crop_margin_mm', type=float, default=10.0, help='Margin around the head used with --crop_head.')
+    parser.add_argument('--crop_threshold_hu', type=float, default=-300.0, help='HU threshold of the head used with --crop_head.')
+    parser.add_argument('--compact_ct', action='store_true', help='Write CTs with integral values as int16 (lossless, verified; see compact_ct.py).')
+    parser.add_argument('--store', default=None, help='Content-addressed scan store (see scan_store.py): link the CTs from it instead of copying them.')
+    parser.add_argument('--store_mode', choices=MODES, default='hardlink', help='Link type used with --store.')
+
+    tracing.add_argument(parser)
+
+    args = parser.parse_args(argv)
+
+    tracing.enable(args.trace)
+    store = ScanStore(args.store) if args.store else None
 
     path_in_images = Path(args.image_directory)
     path_in_labels = Path(args.label_directory)
@@ -61,6 +77,9 @@ if __name__ == '__main__':
     conversion_dict = {}
 
     images = sorted(path_in_images.rglob('*.nii.gz'))
+    if store is not None:
+        # hash all CTs in parallel up front, placing them then only looks up the hashes
+        store.digests([str(p) for p in images])
 
     with open(args.split_dict) as f:
         splits = json.load(f)
@@ -68,6 +87,20 @@ if __name__ == '__main__':
     valid_train_imgs = [item for item in splits["train"]]
     valid_test_imgs = [item for item in splits["test"]]
 
+    compact_rows, crop_offsets = [], {}
+
+    def place_ct(img_file, img_file_nnunet):
+        if args.compact_ct:
+            # cast to int16 and written here, with --store moved into the store after the loop
+            compact_rows.append(compact_ct.compact_file(img_file, img_file_nnunet))
+        else:
+            place(img_file, img_file_nnunet, store, args.store_mode)
+
+    def crop_case(img_file_nnunet, seg_file_nnunet):
+        if args.crop_head:
+            crop_offsets[head_crop.case_key(img_file_nnunet)] = head_crop.crop_files(
+                img_file_nnunet, seg_file_nnunet, args.crop_margin_mm, args.crop_threshold_hu)
+
     scan_cnt_train, scan_cnt_test = 0, 0
 
     for img_file in tqdm(images):
@@ -83,12 +116,13 @@ if __name__ == '__main__':
         if f'{ich_id}_ct_0000.nii.gz' in valid_train_imgs:
             scan_cnt_train += 1
             img_out = path_out_imagesTr / f'{args.taskname}_{scan_cnt_train:04d}_0000.nii.gz'
-            shutil.copyfile(img_file, img_out)
+            place_ct(img_file, img_out)
             conversion_dict[str(img_file)] = str(img_out)
 
             label_out = path_out_labelsTr / f'{args.taskname}_{scan_cnt_train:04d}.nii.gz'
             combined_mask = process_single_mask(label_path)
-            nib.save(combined_mask, label_out)
+            save(combined_mask, label_out)
+            crop_case(img_out, label_out)
 
             train_image.append(str(img_out))
             train_image_labels.append(str(label_out))
@@ -96,16 +130,25 @@ if __name__ == '__main__':
         elif f'{ich_id}_ct_0000.nii.gz' in valid_test_imgs:
             scan_cnt_test += 1
             img_out = path_out_imagesTs / f'{args.taskname}_{scan_cnt_test:04d}_0000.nii.gz'
-            shutil.copyfile(img_file, img_out)
+            place_ct(img_file, img_out)
             conversion_dict[str(img_file)] = str(img_out)
 
             label_out = path_out_labelsTs / f'{args.taskname}_{scan_cnt_test:04d}.nii.gz'
             combined_mask = process_single_mask(label_path)
-            nib.save(combined_mask, label_out)
+            save(combined_mask, label_out)
+            crop_case(img_out, label_out)
 
             test_image.append(str(img_out))
             test_image_labels.append(str(label_out))
 
+    if args.crop_head:
+        head_crop.write_offsets(crop_offsets, path_out)
+    if args.compact_ct:
+        compact_ct.report(compact_rows, path_out)
+    if store is not None and (args.compact_ct or args.crop_head):
+        # the cropped / compact CTs were written, not linked: move them into the store
+        store.ingest(train_image + test_image, args.store_mode)
+
     json_dict = OrderedDict({
         'name': args.taskname,
         'description': args.taskname,
@@ -135,3 +178,7 @@ if __name__ == '__main__':
 
     with open(path_out / "conversion_dict.json", "w") as outfile:
         json.dump(conversion_dict, outfile, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+This script ensembles the softmax outputs of several nnU-Net prediction folders (e.g. folds 0-4
+of the 2d and the 3d_fullres configuration, predicted with --save_probabilities).
+
+Instead of loading all probability arrays of a case into memory, every .npz is memory-mapped
+(see probabilities.py) and the weighted average is accumulated slab by slab. Per case only the
+segmentation, the optional uncertainty maps and one slab per model are held in memory, so the
+peak memory stays around the size of a single case. Cases are processed in parallel.
+
+Outputs per case:
+    <case>.nii.gz              argmax of the averaged probabilities (uint8)
+    <case>_entropy.nii.gz      entropy of the averaged probabilities (optional)
+    <case>_variance.nii.gz     variance across the models, summed over the classes (optional)
+
+The geometry of the outputs is taken from the segmentation nnU-Net wrote next to the .npz files.
+
+USAGE:
+python ensemble_probabilities.py --pred_folders <2d_pred> <3d_fullres_pred> --weights 0.4 0.6
+--output_folder <ensemble_pred> --uncertainty entropy variance --num_processes 4
+"""
+
+import os
+import argparse
+import multiprocessing
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+from probabilities import open_probabilities, spatial_order, iter_slabs
+from nifti_io import load_header
+import tracing
+
+
+def find_cases(pred_folders):
+    """Returns the cases that have an .npz file in every prediction folder."""
+    cases = [set(p.name[:-len(".npz")] for p in Path(folder).glob("*.npz")) for folder in pred_folders]
+    shared = set.intersection(*cases)
+    for folder, folder_cases in zip(pred_folders, cases):
+        if folder_cases - shared:
+            print(f"Skipping {sorted(folder_cases - shared)} from {folder}, not predicted by all models.")
+    return sorted(shared)
+
+
+def ensemble_case(case, pred_folders, weights, output_folder, uncertainty, cache_dir=None, slab_size=8):
+    """Averages the probabilities of one case slab by slab and writes the ensembled outputs."""
+    with tracing.span("case", "case", case=case):
+        _ensemble_case(case, pred_folders, weights, output_folder, uncertainty, cache_dir, slab_size)
+
+
+def _ensemble_case(case, pred_folders, weights, output_folder, uncertainty, cache_dir, slab_size):
+    with tracing.span("open probabilities", "io", case=case):
+        probs = [open_probabilities(os.path.join(folder, f"{case}.npz"), cache_dir) for folder in pred_folders]
+    shape = probs[0].shape
+    for folder, prob in zip(pred_folders, probs):
+        assert prob.shape == shape, f'{case}: shape {prob.shape} in {folder} does not match {shape}.'
+
+    weights = np.asarray(weights, dtype=np.float32) / np.sum(weights)
+    spatial = shape[1:]
+    segmentation = np.empty(spatial, dtype=np.uint8)
+    entropy = np.empty(spatial, dtype=np.float32) if "entropy" in uncertainty else None
+    variance = np.empty(spatial, dtype=np.float32) if "variance" in uncertainty else None
+
+    for slab in iter_slabs(spatial[0], slab_size):
+        mean = None
+        squares = None
+        for prob, weight in zip(probs, weights):
+            p = np.asarray(prob[:, slab], dtype=np.float32)
+            mean = weight * p if mean is None else mean + weight * p
+            if variance is not None:
+                squares = weight * p * p if squares is None else squares + weight * p * p
+
+        segmentation[slab] = mean.argmax(axis=0)
+        if entropy is not None:
+            log_mean = np.log(mean, out=np.zeros_like(mean), where=mean > 0)
+            entropy[slab] = -(mean * log_mean).sum(axis=0)
+        if variance is not None:
+            variance[slab] = np.maximum(squares - mean * mean, 0).sum(axis=0)
+
+    # geometry and axis order of the outputs follow the segmentation written by nnU-Net
+    reference_file = os.path.join(pred_folders[0], f"{case}.nii.gz")
+    assert os.path.isfile(reference_file), f'{case}: no segmentation {reference_file} to take the geometry from.'
+    reference = load_header(reference_file)
+    order = spatial_order(shape, reference.shape)
+
+    outputs = [(segmentation, f"{case}.nii.gz", np.uint8), (entropy, f"{case}_entropy.nii.gz", np.float32),
+               (variance, f"{case}_variance.nii.gz", np.float32)]
+    for data, filename, dtype in outputs:
+        if data is None:
+            continue
+        img = nib.Nifti1Image(data.transpose(order), reference.affine, reference.header)
+        img.set_data_dtype(dtype)
+        with tracing.span("write", "io", file=filename):
+            nib.save(img, os.path.join(output_folder, filename))
+
+    print(f"{case}: ensembled {len(probs)} models")
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Ensemble nnU-Net softmax outputs of several prediction folders.')
+    parser.add_argument('--pred_folders', nargs='+', required=True, help='Prediction folders containing .npz files.')
+    parser.add_argument('--weights', nargs='+', type=float, default=None, help='Per-model weights (default: equal).')
+    parser.add_argument('--output_folder', required=True, type=str, help='Output folder for the ensembled predictions.')
+    parser.add_argument('--uncertainty', nargs='*', default=[], choices=['entropy', 'variance'],
+                        help='Uncertainty maps to write next to the segmentation.')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Keep the uncompressed probabilities in this folder for later runs '
+                             '(default: temporary files, deleted after each case).')
+    parser.add_argument('--slab_size', type=int, default=8, help='Number of slices averaged at once.')
+    parser.add_argument('--num_processes', type=int, default=4, help="Number of processes in parallel.")
+
+    tracing.add_argument(parser)
+
+    args = parser.parse_args(argv)
+
+    tracing.enable(args.trace)
+
+    weights = args.weights or [1.0] * len(args.pred_folders)
+    assert len(weights) == len(args.pred_folders), 'Please provide one weight per prediction folder.'
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    cases = find_cases(args.pred_folders)
+
+    with multiprocessing.Pool(processes=args.num_processes) as pool:
+        pool.starmap(ensemble_case, [(case, args.pred_folders, weights, args.output_folder, args.uncertainty,
+                                      args.cache_dir, args.slab_size) for case in cases])
+
+
+if __name__ == "__main__":
+    main()
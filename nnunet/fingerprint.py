@@ -0,0 +1,185 @@
+"""
+nnU-Net v2 dataset fingerprint (dataset_fingerprint.json) and a per-case statistics table.
+
+nnUNetv2_plan_and_preprocess (nnUNetv2_extract_fingerprint) reads every training image and label
+only to collect spacings, shapes after cropping and foreground intensity statistics. The same
+numbers are computed here, following nnU-Net's DatasetFingerprintExtractor:
+
+    - axes and spacings in nnU-Net's (z, y, x) order
+    - crop to the bounding box of the (hole-filled) nonzero region of the image
+    - 10e7 (num_foreground_voxels_for_intensitystats) // number of training cases foreground
+      intensities sampled per case with RandomState(1234), in nnU-Net's voxel order
+    - mean, median, std, min, max, 0.5 and 99.5 percentiles of all samples per channel
+
+create_dataset.py --fingerprint computes them while it converts the cases (the images are then
+only read once) and writes dataset_fingerprint.json to the dataset folder and, if nnUNet_preprocessed
+is set, to $nnUNet_preprocessed/Dataset{N}_{name}/, where nnUNetv2_plan_and_preprocess uses it
+instead of extracting the fingerprint again (unless --clean). Only the training cases go into
+the fingerprint; case_stats.csv lists all cases with their foreground HU statistics and label
+voxel counts (class balance). Single-channel (_0000) datasets only.
+
+USAGE (for a dataset that already exists):
+python fingerprint.py --dataset /path/to/nnUNet_raw/Dataset804_ICH_Segmentation --num_processes 8
+"""
+
+import os
+import json
+import argparse
+import multiprocessing
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scipy.ndimage import binary_fill_holes
+from nifti_io import load_data, load_header
+import tracing
+
+
+# nnU-Net's DatasetFingerprintExtractor.num_foreground_voxels_for_intensitystats
+NUM_FOREGROUND_VOXELS = 10e7
+
+PERCENTILES = np.array((0.5, 50.0, 99.5))
+
+
+def samples_per_case(num_training_cases):
+    """Foreground intensities nnU-Net samples from every training case."""
+    return int(NUM_FOREGROUND_VOXELS // max(num_training_cases, 1))
+
+
+def intensity_statistics(values):
+    """Mean, median, std, min, max and 0.5/99.5 percentiles of foreground intensities (NaN if none)."""
+    if len(values) == 0:
+        return {key: float("nan") for key in ("mean", "median", "std", "min", "max", "percentile_99_5", "percentile_00_5")}
+    percentile_00_5, median, percentile_99_5 = np.percentile(values, PERCENTILES)
+    return {"mean": float(np.mean(values)), "median": float(median), "std": float(np.std(values)),
+            "min": float(np.min(values)), "max": float(np.max(values)),
+            "percentile_99_5": float(percentile_99_5), "percentile_00_5": float(percentile_00_5)}
+
+
+def case_fingerprint(image, label, zooms, num_samples, seed=1234):
+    """
+    Fingerprint of one case from its image and label arrays (nibabel (x, y, z) order) and voxel
+    size. Returns the per-case statistics and, under "samples", the sampled foreground intensities.
+    """
+    # nnU-Net's readers give float32 arrays in (z, y, x) order
+    data = np.asarray(image, dtype=np.float32).transpose(2, 1, 0)
+    seg = np.asarray(label).transpose(2, 1, 0)
+
+    with tracing.span("fingerprint", "compute"):
+        nonzero = binary_fill_holes(data != 0)
+        if nonzero.any():
+            slicer = tuple(slice(int(np.min(where)), int(np.max(where)) + 1) for where in np.nonzero(nonzero))
+        else:
+            slicer = tuple(slice(0, size) for size in data.shape)
+        cropped, cropped_seg = data[slicer], seg[slicer]
+
+        foreground = cropped[cropped_seg > 0]
+        rs = np.random.RandomState(seed)
+        samples = rs.choice(foreground, num_samples, replace=True) if len(foreground) > 0 else []
+
+        values, counts = np.unique(seg, return_counts=True)
+
+    voxel_ml = float(np.prod(zooms[:3])) / 1000.0
+    return {
+        "shape": list(data.shape),
+        "spacing": [float(z) for z in zooms[:3]][::-1],
+        "shape_after_crop": list(cropped.shape),
+        "relative_size_after_cropping": float(np.prod(cropped.shape) / np.prod(data.shape)),
+        "foreground_voxels": int(len(foreground)),
+        "foreground": intensity_statistics(foreground),
+        "label_voxels": {int(v): int(c) for v, c in zip(values, counts)},
+        "label_ml": {int(v): int(c) * voxel_ml for v, c in zip(values, counts)},
+        "samples": samples,
+    }
+
+
+def file_fingerprint(image_path, label_path, num_samples):
+    """case_fingerprint of an image and a label file."""
+    return case_fingerprint(load_data(image_path), load_data(label_path), load_header(image_path).header.get_zooms(),
+                            num_samples)
+
+
+def dataset_fingerprint(cases):
+    """dataset_fingerprint.json content of the training cases' fingerprints (in nnU-Net's case order)."""
+    samples = np.concatenate([case["samples"] for case in cases]) if cases else []
+    return {
+        "foreground_intensity_properties_per_channel": {"0": intensity_statistics(samples)},
+        "median_relative_size_after_cropping": float(np.median([case["relative_size_after_cropping"] for case in cases])),
+        "shapes_after_crop": [case["shape_after_crop"] for case in cases],
+        "spacings": [case["spacing"] for case in cases],
+    }
+
+
+def case_table(cases):
+    """One row per case: geometry, foreground HU statistics and voxels/mL per label value."""
+    labels = sorted({value for case in cases for value in case["label_voxels"]})
+    rows = []
+    for case in cases:
+        row = {"case": case.get("case", ""), "split": case.get("split", ""), "source": case.get("source", ""),
+               "shape": "x".join(map(str, case["shape"][::-1])),
+               "spacing": "x".join(f"{s:g}" for s in case["spacing"][::-1]),
+               "shape_after_crop": "x".join(map(str, case["shape_after_crop"][::-1])),
+               "relative_size_after_cropping": case["relative_size_after_cropping"],
+               "foreground_voxels": case["foreground_voxels"]}
+        row.update({f"fg_{key}": value for key, value in case["foreground"].items()})
+        for value in labels:
+            row[f"label_{value}_voxels"] = case["label_voxels"].get(value, 0)
+            row[f"label_{value}_ml"] = case["label_ml"].get(value, 0.0)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def write_fingerprint(cases, dataset_folder):
+    """
+    Writes dataset_fingerprint.json of the cases with split "train" (sorted by case name, as
+    nnU-Net lists them) and case_stats.csv of all cases. Returns the fingerprint paths written.
+    """
+    training = sorted((case for case in cases if case.get("split", "train") == "train"), key=lambda case: case["case"])
+    fingerprint = dataset_fingerprint(training)
+    paths = [os.path.join(dataset_folder, "dataset_fingerprint.json")]
+    if os.environ.get("nnUNet_preprocessed"):
+        paths.append(os.path.join(os.environ["nnUNet_preprocessed"], os.path.basename(os.path.normpath(dataset_folder)),
+                                  "dataset_fingerprint.json"))
+    for path in paths:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(fingerprint, f, sort_keys=False, indent=4)
+    case_table(cases).to_csv(os.path.join(dataset_folder, "case_stats.csv"), index=False)
+
+    totals = {}
+    for case in training:
+        for value, voxels in case["label_voxels"].items():
+            totals[value] = totals.get(value, 0) + voxels
+    foreground = sum(voxels for value, voxels in totals.items() if value > 0)
+    if foreground:
+        print("Training label voxels: " + ", ".join(f"{value}: {voxels} ({100 * voxels / foreground:.1f}% of foreground)"
+                                                    for value, voxels in sorted(totals.items()) if value > 0))
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute the nnU-Net dataset fingerprint and per-case statistics.")
+    parser.add_argument("--dataset", required=True, type=str, help="Dataset folder with imagesTr/labelsTr (and imagesTs/labelsTs).")
+    parser.add_argument("--num_processes", type=int, default=os.cpu_count(), help="Number of processes in parallel.")
+    tracing.add_argument(parser)
+    args = parser.parse_args(argv)
+    tracing.enable(args.trace)
+
+    jobs = []
+    for split, images, labels in (("train", "imagesTr", "labelsTr"), ("test", "imagesTs", "labelsTs")):
+        for image in sorted(Path(args.dataset, images).glob("*_0000.nii.gz")):
+            name = image.name[:-len("_0000.nii.gz")]
+            label = Path(args.dataset, labels, name + ".nii.gz")
+            if label.exists():
+                jobs.append((name, split, str(image), str(label)))
+    num_samples = samples_per_case(sum(split == "train" for _, split, _, _ in jobs))
+    print(f"Found {len(jobs)} cases. Computing the fingerprint...")
+
+    with multiprocessing.Pool(processes=args.num_processes) as pool:
+        results = pool.starmap(file_fingerprint, [(image, label, num_samples) for _, _, image, label in jobs])
+    cases = [dict(result, case=name, split=split, source=image) for (name, split, image, _), result in zip(jobs, results)]
+    for path in write_fingerprint(cases, args.dataset):
+        print(f"Fingerprint saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""
+Random access into .nii.gz files through gzip seek points.
+
+A plain gzip stream can only be read from the start, so reading one axial slice of a .nii.gz
+inflates everything before it. This module keeps zran-style checkpoints (the decompressor state
+every `spacing` uncompressed bytes), so a read only inflates from the nearest checkpoint before
+the requested offset:
+
+  - with the indexed_gzip package (a dependency of the slice reads: pip install indexed_gzip),
+    the index is built once per file and persisted next to it as <file>.gzidx (rebuilt when
+    the file is newer than the index), so repeat access in later runs is near-instant;
+  - without it, checkpoints are collected in memory while reading (decompressor copies) and
+    live as long as the open file, which makes several slices of one file cheap, but every
+    new open still inflates everything up to the requested slice. zlib decompressor states
+    cannot be serialized, so these checkpoints are not persisted; a warning is printed once.
+
+open_image returns a regular nibabel image whose dataobj reads through the index, so
+img.dataobj[:, :, z] only decompresses the bytes around slice z.
+
+USAGE:
+python gzip_index.py --build <folder_or_files> [--spacing_mb 4]
+"""
+
+import io
+import os
+import zlib
+import bisect
+import argparse
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+import tracing
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+
+DEFAULT_SPACING = 4 * 1024 * 1024
+
+# the missing-indexed_gzip warning is printed once per process
+_warned = False
+
+
+def index_path(path):
+    return str(path) + ".gzidx"
+
+
+class CheckpointGzipFile(io.RawIOBase):
+    """Seekable reader of a single-member gzip file that checkpoints the decompressor while reading."""
+
+    def __init__(self, path, spacing=DEFAULT_SPACING, chunk_size=16 * 1024):
+        super().__init__()
+        self._file = open(path, "rb")
+        self._spacing = spacing
+        self._chunk_size = chunk_size
+        # (uncompressed offset, compressed offset, decompressor state at that point)
+        self._checkpoints = [(0, 0, zlib.decompressobj(wbits=31))]
+        self._pos = 0
+        self._restore(self._checkpoints[0])
+
+    def _restore(self, checkpoint):
+        self._start, self._compressed_pos, decompressor = checkpoint
+        self._decompressor = decompressor.copy()
+        self._buffer = b""
+
+    def _advance(self):
+        """Decompresses the next compressed chunk into the buffer; False at the end of the stream."""
+        if self._decompressor.eof:
+            return False
+        self._file.seek(self._compressed_pos)
+        chunk = self._file.read(self._chunk_size)
+        if not chunk:
+            return False
+        self._compressed_pos += len(chunk)
+        self._start += len(self._buffer)
+        self._buffer = self._decompressor.decompress(chunk)
+
+        end = self._start + len(self._buffer)
+        if not self._decompressor.eof and end >= self._checkpoints[-1][0] + self._spacing:
+            self._checkpoints.append((end, self._compressed_pos, self._decompressor.copy()))
+        return True
+
+    def readinto(self, b):
+        """Fills b completely unless the end of the stream is reached first."""
+        view = memoryview(b).cast("B")
+        filled = 0
+        while filled < len(view):
+            offset = self._pos - self._start
+            if 0 <= offset < len(self._buffer):
+                n = min(len(view) - filled, len(self._buffer) - offset)
+                view[filled:filled + n] = self._buffer[offset:offset + n]
+                self._pos += n
+                filled += n
+                continue
+            # jump to the last checkpoint before the position if it is behind us or further ahead
+            index = bisect.bisect_right([c[0] for c in self._checkpoints], self._pos) - 1
+            checkpoint = self._checkpoints[index]
+            if self._pos < self._start or checkpoint[0] > self._start + len(self._buffer):
+                self._restore(checkpoint)
+            elif not self._advance():
+                break
+        return filled
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            raise io.UnsupportedOperation("seeking from the end of a gzip stream is not supported")
+        return self._pos
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def open_indexed(path, spacing=DEFAULT_SPACING, persist=True):
+    """
+    Seekable file object of a .nii.gz file. Uses indexed_gzip with a persisted .gzidx index
+    when available, otherwise a CheckpointGzipFile.
+    """
+    global _warned
+    path = str(path)
+    if indexed_gzip is None:
+        if persist and not _warned:
+            print("Warning: indexed_gzip is not installed (pip install indexed_gzip): gzip seek indexes are kept "
+                  "in memory only, so every slice read inflates the file up to that slice")
+            _warned = True
+        return CheckpointGzipFile(path, spacing)
+
+    fileobj = indexed_gzip.IndexedGzipFile(path, spacing=spacing)
+    sidecar = index_path(path)
+    if persist:
+        if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+            fileobj.import_index(sidecar)
+        else:
+            fileobj.build_full_index()
+            fileobj.export_index(sidecar)
+    return fileobj
+
+
+def open_image(path, spacing=DEFAULT_SPACING, persist=True):
+    """nibabel image whose dataobj reads slices and slabs through the seek index."""
+    if not str(path).endswith(".gz"):
+        return nib.load(path)
+    holder = nib.FileHolder(filename=str(path), fileobj=open_indexed(path, spacing, persist))
+    return nib.Nifti1Image.from_file_map({"header": holder, "image": holder})
+
+
+def read_slices(path, slices, axis=2, dtype=None):
+    """Stack of the given slices (along axis, last axis of the result) read through the seek index."""
+    img = open_image(path)
+    index = [slice(None)] * len(img.shape)
+    stack = []
+    for s in slices:
+        index[axis] = s
+        stack.append(np.asanyarray(img.dataobj[tuple(index)]))
+    data = np.stack(stack, axis=-1)
+    return data if dtype is None else data.astype(dtype, copy=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build persisted gzip seek indexes (.gzidx) for .nii.gz files.")
+    parser.add_argument("--build", required=True, nargs="+", help="Folders (searched recursively) or .nii.gz files.")
+    parser.add_argument("--spacing_mb", type=float, default=DEFAULT_SPACING / 1024 ** 2,
+                        help="Uncompressed distance between seek points in MB.")
+    tracing.add_argument(parser)
+    args = parser.parse_args(argv)
+    tracing.enable(args.trace)
+
+    if indexed_gzip is None:
+        parser.error("persisting indexes requires the indexed_gzip package (pip install indexed_gzip)")
+
+    files = []
+    for entry in args.build:
+        files.extend(sorted(str(p) for p in Path(entry).rglob("*.nii.gz")) if os.path.isdir(entry) else [entry])
+    for path in files:
+        open_indexed(path, int(args.spacing_mb * 1024 ** 2)).close()
+    print(f"Indexed {len(files)} files")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Crop head CTs (and their labels) to the head, and un-crop predictions back onto the original grid.
+
+The head is found on a volume downsampled to ~4 mm voxels by striding: voxels above an HU
+threshold (-300 by default, i.e. skin, brain and bone but not air), a binary opening that
+detaches the table and thin structures, and the largest connected component. Its bounding box
+(back at full resolution) is widened by a margin (10 mm by default) and always covers the
+label's foreground, so no label voxel is lost. Image and label are cropped to the same box,
+keeping their stored values, scaling and header; the affine is shifted to the crop origin, so
+the cropped volumes stay at the same positions in world space.
+
+create_dataset*.py crop with --crop_head and record the box of every case in crop_offsets.json
+of the dataset folder:
+
+    {"imagesTs/ICH_Segmentation_0001": {"shape": [512, 512, 34], "bbox": [[x0, x1], [y0, y1], [z0, z1]],
+                                        "affine": [[...], ...], "qform_code": 1, "sform_code": 1}, ...}
+
+The script puts predictions of the cropped images (e.g. ICH_Segmentation_0001.nii.gz of imagesTs)
+into volumes of the original shape, affine and qform/sform codes, voxel for voxel:
+
+USAGE:
+python head_crop.py --offsets /path/to/Dataset804_ICH_Segmentation/crop_offsets.json --split imagesTs --input_folder /path/to/predictions --output_folder /path/to/predictions_uncropped
+"""
+
+import os
+import json
+import math
+import argparse
+from pathlib import Path
+import numpy as np
+from scipy import ndimage
+from nifti_io import load_header, save
+import tracing
+
+
+def case_key(img_file_nnunet):
+    """crop_offsets.json key of an nnU-Net image, e.g. imagesTr/ICH_Segmentation_0001."""
+    path = Path(img_file_nnunet)
+    return f"{path.parent.name}/{path.name[:-len('_0000.nii.gz')]}"
+
+
+def head_bbox(data, zooms, threshold_hu=-300.0, margin_mm=10.0, label=None, step_mm=4.0):
+    """[[lo, hi], ...] per axis of the head in a CT volume (in HU), widened by margin_mm and by the label's foreground."""
+    steps = [max(1, int(round(step_mm / zoom))) for zoom in zooms[:3]]
+    with tracing.span("head bbox", "compute"):
+        small = np.asarray(data[::steps[0], ::steps[1], ::steps[2]]) > threshold_hu
+        small = ndimage.binary_opening(small)
+        components, num_components = ndimage.label(small)
+
+        if num_components:
+            largest = int(np.argmax(np.bincount(components.ravel())[1:])) + 1
+            box = ndimage.find_objects(components)[largest - 1]
+            bbox = []
+            for axis, (sl, step, zoom) in enumerate(zip(box, steps, zooms)):
+                margin = int(math.ceil(margin_mm / zoom))
+                bbox.append([max(0, sl.start * step - margin), min(data.shape[axis], sl.stop * step + margin)])
+        else:
+            bbox = [[0, size] for size in data.shape[:3]]
+
+        if label is not None and np.any(label):
+            for axis, where in enumerate(np.nonzero(np.asarray(label))):
+                bbox[axis] = [min(bbox[axis][0], int(where.min())), max(bbox[axis][1], int(where.max()) + 1)]
+    return bbox
+
+
+def _stored(img):
+    """Stored (unscaled) voxel values and the (slope, inter) to apply to them."""
+    dataobj = img.dataobj
+    if hasattr(dataobj, "get_unscaled"):
+        return dataobj.get_unscaled(), (dataobj.slope, dataobj.inter)
+    return np.asanyarray(dataobj), (None, None)
+
+
+def _with_geometry(img, data, affine, scaling, qform_code, sform_code):
+    out = img.__class__(data, affine, img.header)
+    out.header.set_slope_inter(*scaling)
+    out.header.set_qform(affine, int(qform_code))
+    out.header.set_sform(affine, int(sform_code))
+    return out
+
+
+def crop_image(img, bbox):
+    """Image cropped to bbox, with the stored values, scaling and header of img."""
+    data, scaling = _stored(img)
+    affine = img.affine.copy()
+    affine[:3, 3] = img.affine[:3, :3] @ np.array([lo for lo, _ in bbox], dtype=float) + img.affine[:3, 3]
+    data = data[tuple(slice(lo, hi) for lo, hi in bbox)]
+    return _with_geometry(img, data, affine, scaling, img.header["qform_code"], img.header["sform_code"])
+
+
+def crop_entry(img, bbox):
+    """crop_offsets.json entry of an image cropped to bbox."""
+    return {"shape": [int(size) for size in img.shape[:3]], "bbox": [[int(lo), int(hi)] for lo, hi in bbox],
+            "affine": img.affine.tolist(), "qform_code": int(img.header["qform_code"]),
+            "sform_code": int(img.header["sform_code"])}
+
+
+def crop_case(image, label, margin_mm=10.0, threshold_hu=-300.0):
+    """(cropped image, cropped label, crop_offsets.json entry) of a CT and its label."""
+    bbox = head_bbox(np.asanyarray(image.dataobj), image.header.get_zooms(), threshold_hu, margin_mm,
+                     np.asanyarray(label.dataobj))
+    return crop_image(image, bbox), crop_image(label, bbox), crop_entry(image, bbox)
+
+
+def crop_files(img_path, seg_path, margin_mm=10.0, threshold_hu=-300.0):
+    """Crops an image and its label file in place. Returns the crop_offsets.json entry."""
+    # proxies: the crop keeps the stored values and scaling, so the data is not decoded through load_data
+    image, label, entry = crop_case(load_header(img_path), load_header(seg_path), margin_mm, threshold_hu)
+    save(image, img_path)
+    save(label, seg_path)
+    return entry
+
+
+def uncrop_image(img, entry):
+    """Image of a cropped case (e.g. its prediction) put back onto the original grid; zero outside the crop."""
+    bbox = entry["bbox"]
+    if list(img.shape[:3]) != [hi - lo for lo, hi in bbox]:
+        raise ValueError(f"shape {img.shape[:3]} does not match the crop {bbox}")
+    data, scaling = _stored(img)
+    full = np.zeros(tuple(entry["shape"]) + data.shape[3:], dtype=data.dtype)
+    full[tuple(slice(lo, hi) for lo, hi in bbox)] = data
+    return _with_geometry(img, full, np.array(entry["affine"]), scaling, entry["qform_code"], entry["sform_code"])
+
+
+def write_offsets(offsets, dataset_folder):
+    """Writes crop_offsets.json and prints how much of the volumes the crops keep."""
+    with open(os.path.join(dataset_folder, "crop_offsets.json"), "w") as f:
+        json.dump(offsets, f, indent=4)
+    if offsets:
+        kept = [np.prod([hi - lo for lo, hi in entry["bbox"]]) / np.prod(entry["shape"]) for entry in offsets.values()]
+        print(f"Cropped {len(offsets)} cases to the head, keeping {100 * np.mean(kept):.1f}% of the voxels on average "
+              f"(min {100 * np.min(kept):.1f}%, max {100 * np.max(kept):.1f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Un-crop predictions of head-cropped images onto the original grid.")
+    parser.add_argument("--offsets", required=True, type=str, help="crop_offsets.json of the dataset.")
+    parser.add_argument("--split", type=str, default="imagesTs", help="Image folder the predictions come from.")
+    parser.add_argument("--input_folder", required=True, type=str, help="Folder with the predictions.")
+    parser.add_argument("--output_folder", required=True, type=str, help="Folder for the un-cropped predictions.")
+    parser.add_argument("--pattern", type=str, default="*.nii.gz", help="Pattern of the predictions.")
+    tracing.add_argument(parser)
+    args = parser.parse_args(argv)
+    tracing.enable(args.trace)
+
+    with open(args.offsets) as f:
+        offsets = json.load(f)
+    os.makedirs(args.output_folder, exist_ok=True)
+
+    predictions = sorted(Path(args.input_folder).glob(args.pattern))
+    print(f"Found {len(predictions)} predictions. Un-cropping...")
+    for path in predictions:
+        key = f"{args.split}/{path.name[:-len('.nii.gz')]}"
+        if key not in offsets:
+            print(f"Error: {path}: no crop offsets for {key}")
+            continue
+        try:
+            save(uncrop_image(load_header(path), offsets[key]), os.path.join(args.output_folder, path.name))
+        except Exception as e:
+            print(f"Error: {path}: {e}")
+
+
+if __name__ == "__main__":
+    main()
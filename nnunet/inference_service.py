@@ -0,0 +1,258 @@
+"""
+Long-running inference service: watches an input folder, predicts new scans with a model that
+stays loaded and computes their volumes right away.
+
+Instead of renaming the input files to the _0000 convention and running nnUNetv2_predict per
+batch (which loads the model every time), the service
+
+    1. polls the input folder for new scans (*_ct.nii.gz); a file is taken once its size and
+       mtime have not changed for --settle_s seconds, i.e. once it is completely copied
+    2. stages every case as a symlink <output>/.staging/<case>_0000.nii.gz -> input file, so the
+       clinical files are never renamed or modified
+    3. predicts the new cases in batches (up to --batch_size) into <output>/<case>.nii.gz
+    4. computes their volumes (calculate_volumes_batch.py, --mode) into <output>/volumes.csv and,
+       with --store, the results store
+    5. appends the latency of every case (waiting, prediction, volumetry, total) to
+       <output>/latency.csv
+
+Cases whose prediction exists already are skipped, so the service can be restarted. A batch
+that fails is logged as failed in latency.csv and its cases are taken up again once their files
+have settled. Predictors:
+
+    nnunet       nnU-Net v2 model of --dataset_id/--configuration/--trainer/--plans/--folds, from
+                 $nnUNet_results (needs nnunetv2 and torch)
+    threshold    stand-in for local tests without a model or GPU: voxels in an HU window
+                 (--threshold_hu, acute blood by default)
+    module:Class any class with predict(inputs, outputs) writing one mask per input file,
+                 constructed without arguments (the module is imported from the Python path)
+
+USAGE:
+python inference_service.py --input_folder /media/raid3/incoming --output_folder /media/raid3/predictions --predictor nnunet --dataset_id 804 --mode ph
+python inference_service.py --input_folder /tmp/cohort/images --output_folder /tmp/predictions --predictor threshold --once
+"""
+
+import os
+import time
+import argparse
+import importlib
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from nifti_io import load_data, load_header, save
+from calculate_volumes_batch import calculate_volumes, DEFAULT_OUTPUTS
+from results_store import open_store
+import tracing
+
+
+class ThresholdPredictor:
+    """Stand-in model: label 1 for voxels within an HU window."""
+
+    def __init__(self, low=50.0, high=90.0):
+        self.low, self.high = low, high
+
+    def predict(self, inputs, outputs):
+        for input_file, output_file in zip(inputs, outputs):
+            # read once per scan: kept out of the LRU cache of the long-running service
+            img, data = load_header(input_file), load_data(input_file, cache=False)
+            mask = ((data >= self.low) & (data <= self.high)).astype(np.uint8)
+            out = nib.Nifti1Image(mask, img.affine, img.header)
+            out.set_data_dtype(np.uint8)
+            save(out, output_file)
+
+
+class NnUNetPredictor:
+    """nnU-Net v2 model loaded once from $nnUNet_results."""
+
+    def __init__(self, dataset_id, configuration="3d_fullres", trainer="nnUNetTrainer", plans="nnUNetPlans",
+                 folds=(0, 1, 2, 3, 4), checkpoint="checkpoint_final.pth", device="cuda", num_processes=2):
+        import torch
+        from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+        from nnunetv2.utilities.file_path_utilities import get_output_folder
+
+        self.num_processes = num_processes
+        self.predictor = nnUNetPredictor(tile_step_size=0.5, use_gaussian=True, use_mirroring=True,
+                                         device=torch.device(device), verbose=False, allow_tqdm=False)
+        with tracing.span("load model", "io"):
+            self.predictor.initialize_from_trained_model_folder(
+                get_output_folder(dataset_id, trainer, plans, configuration), use_folds=folds, checkpoint_name=checkpoint)
+
+    def predict(self, inputs, outputs):
+        self.predictor.predict_from_files([[input_file] for input_file in inputs],
+                                          [output_file[:-len(".nii.gz")] for output_file in outputs],
+                                          save_probabilities=False, overwrite=True,
+                                          num_processes_preprocessing=self.num_processes,
+                                          num_processes_segmentation_export=self.num_processes)
+
+
+def load_predictor(args):
+    if args.predictor == "nnunet":
+        folds = args.folds if args.folds == ["all"] else [int(fold) for fold in args.folds]
+        return NnUNetPredictor(args.dataset_id, args.configuration, args.trainer, args.plans, folds, args.checkpoint,
+                               args.device, args.num_processes)
+    if args.predictor == "threshold":
+        return ThresholdPredictor(*args.threshold_hu)
+    module_name, _, class_name = args.predictor.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class InputWatcher:
+    """New files of a folder, reported once they have not changed for settle_s seconds."""
+
+    def __init__(self, folder, suffix, settle_s):
+        self.folder, self.suffix, self.settle_s = Path(folder), suffix, settle_s
+        self.pending = {}  # path -> (size, mtime_ns, detected_at, unchanged_since)
+        self.reported = set()
+
+    def poll(self):
+        now = time.time()
+        ready = []
+        for path in sorted(self.folder.glob(f"*{self.suffix}")):
+            path = str(path)
+            if path in self.reported:
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            size, mtime_ns, detected_at, unchanged_since = self.pending.get(path, (None, None, now, now))
+            if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+                unchanged_since = now
+            self.pending[path] = (st.st_size, st.st_mtime_ns, detected_at, unchanged_since)
+            if now - unchanged_since >= self.settle_s:
+                ready.append((path, detected_at))
+                self.reported.add(path)
+                del self.pending[path]
+        return ready
+
+    def retry(self, items):
+        """Reports (path, detected_at) items again once they have settled (e.g. after a failed batch)."""
+        now = time.time()
+        for path, detected_at in items:
+            self.reported.discard(path)
+            self.pending[path] = (None, None, detected_at, now)
+
+
+def case_id(path, suffix):
+    return os.path.basename(path)[:-len(suffix)]
+
+
+def stage(path, staging_folder, case):
+    """Symlink <staging_folder>/<case>_0000.nii.gz to the input file."""
+    staged = os.path.join(staging_folder, f"{case}_0000.nii.gz")
+    tmp = f"{staged}.{os.getpid()}.tmp"
+    os.symlink(os.path.abspath(path), tmp)
+    os.replace(tmp, staged)
+    return staged
+
+
+LATENCY_COLUMNS = ["case", "input", "detected", "batch_size", "status", "wait_s", "predict_s", "volumetry_s", "total_s",
+                   "error"]
+
+
+def append_csv(rows, path, columns=None):
+    if rows:
+        pd.DataFrame(rows, columns=columns).to_csv(path, mode="a", header=not os.path.exists(path), index=False)
+
+
+def process_batch(batch, predictor, args, store_conn=None):
+    """Stages, predicts and measures a batch of (input path, detected_at). Returns the latency rows."""
+    cases = [case_id(path, args.suffix) for path, _ in batch]
+    staged = [stage(path, args.staging_folder, case) for (path, _), case in zip(batch, cases)]
+    predictions = [os.path.join(args.output_folder, f"{case}.nii.gz") for case in cases]
+
+    start = time.time()
+    with tracing.span("predict", "compute", cases=len(batch)):
+        predictor.predict(staged, predictions)
+    predicted = time.time()
+
+    rows = []
+    for (path, detected_at), case, prediction in zip(batch, cases, predictions):
+        row = {"case": case, "input": path, "detected": datetime.fromtimestamp(detected_at).isoformat(timespec="seconds"),
+               "batch_size": len(batch), "wait_s": start - detected_at, "predict_s": predicted - start}
+        if not os.path.exists(prediction):
+            print(f"Error: {path}: no prediction written")
+            rows.append(dict(row, status="failed", error="no prediction written"))
+            continue
+        volume_start = time.time()
+        volumes = calculate_volumes([prediction], args.mode, num_processes=0, store_conn=store_conn, model_id=args.model_id)
+        append_csv(volumes.to_dict("records"), os.path.join(args.output_folder, args.volumes_output))
+        done = time.time()
+        rows.append(dict(row, status="done", volumetry_s=done - volume_start, total_s=done - detected_at))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Watch a folder and predict and measure new scans with a loaded model.")
+    parser.add_argument("--input_folder", required=True, type=str, help="Folder the new scans arrive in.")
+    parser.add_argument("--output_folder", required=True, type=str, help="Folder for predictions, volumes and latencies.")
+    parser.add_argument("--staging_folder", type=str, default=None, help="Folder for the _0000 links (default <output>/.staging).")
+    parser.add_argument("--suffix", type=str, default="_ct.nii.gz", help="File name ending of the scans; the rest is the case ID.")
+    parser.add_argument("--predictor", type=str, default="nnunet", help="nnunet, threshold or module:Class.")
+    parser.add_argument("--dataset_id", type=str, default="804", help="nnU-Net dataset name or ID.")
+    parser.add_argument("--configuration", type=str, default="3d_fullres", help="nnU-Net configuration.")
+    parser.add_argument("--trainer", type=str, default="nnUNetTrainer", help="nnU-Net trainer.")
+    parser.add_argument("--plans", type=str, default="nnUNetPlans", help="nnU-Net plans identifier.")
+    parser.add_argument("--folds", nargs="+", default=["0", "1", "2", "3", "4"], help="Folds of the model (or all).")
+    parser.add_argument("--checkpoint", type=str, default="checkpoint_final.pth", help="Checkpoint file name.")
+    parser.add_argument("--device", type=str, default="cuda", help="Torch device.")
+    parser.add_argument("--num_processes", type=int, default=2, help="nnU-Net preprocessing/export processes.")
+    parser.add_argument("--threshold_hu", nargs=2, type=float, default=[50.0, 90.0], help="HU window of the threshold predictor.")
+    parser.add_argument("--mode", choices=list(DEFAULT_OUTPUTS), default="ph", help="Kind of masks for the volumetry.")
+    parser.add_argument("--volumes_output", type=str, default="volumes.csv", help="Volumes table in the output folder.")
+    parser.add_argument("--store", type=str, default=None, help="Also upsert the volumes into this results store.")
+    parser.add_argument("--model_id", type=str, default=None, help="Model ID in the results store (default: dataset ID, or the predictor name).")
+    parser.add_argument("--batch_size", type=int, default=8, help="Maximum number of cases per prediction.")
+    parser.add_argument("--poll_s", type=float, default=5.0, help="Seconds between checks of the input folder.")
+    parser.add_argument("--settle_s", type=float, default=10.0, help="Seconds a file must be unchanged before it is taken.")
+    parser.add_argument("--once", action="store_true", help="Process the scans that are there and exit.")
+    parser.add_argument("--reprocess", action="store_true", help="Also predict cases that have a prediction already.")
+    tracing.add_argument(parser)
+    args = parser.parse_args(argv)
+    tracing.enable(args.trace)
+
+    args.staging_folder = args.staging_folder or os.path.join(args.output_folder, ".staging")
+    args.model_id = args.model_id or (args.dataset_id if args.predictor == "nnunet" else args.predictor)
+    os.makedirs(args.staging_folder, exist_ok=True)
+    store_conn = open_store(args.store) if args.store else None
+
+    print(f"Loading the {args.predictor} predictor...")
+    predictor = load_predictor(args)
+    watcher = InputWatcher(args.input_folder, args.suffix, 0 if args.once else args.settle_s)
+    latency_file = os.path.join(args.output_folder, "latency.csv")
+    print(f"Watching {args.input_folder} for *{args.suffix}")
+
+    try:
+        while True:
+            ready = []
+            for path, detected_at in watcher.poll():
+                prediction = os.path.join(args.output_folder, f"{case_id(path, args.suffix)}.nii.gz")
+                if args.reprocess or not os.path.exists(prediction):
+                    ready.append((path, detected_at))
+            for start in range(0, len(ready), args.batch_size):
+                batch = ready[start:start + args.batch_size]
+                try:
+                    rows = process_batch(batch, predictor, args, store_conn)
+                except Exception as e:
+                    print(f"Error: batch of {len(batch)} cases: {e}" + ("" if args.once else " (will be retried)"))
+                    failed = time.time()
+                    rows = [{"case": case_id(path, args.suffix), "input": path,
+                             "detected": datetime.fromtimestamp(detected_at).isoformat(timespec="seconds"),
+                             "batch_size": len(batch), "wait_s": failed - detected_at, "status": "failed",
+                             "error": str(e)} for path, detected_at in batch]
+                    watcher.retry(batch)
+                append_csv(rows, latency_file, LATENCY_COLUMNS)
+                for row in rows:
+                    if row["status"] == "done":
+                        print(f"{row['case']}: done in {row['total_s']:.1f} s (prediction {row['predict_s']:.1f} s "
+                              f"for {row['batch_size']} cases, volumetry {row['volumetry_s']:.2f} s)")
+            if args.once:
+                break
+            time.sleep(args.poll_s)
+    except KeyboardInterrupt:
+        print("Stopped.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Small SQLite store for per-case evaluation results.
+
+Results are cached under a key built from the content hashes of the prediction and the GT, the
+metric set and its parameters, so re-running an evaluation only computes new or changed cases.
+File hashes are memoized by (path, mtime, size), so unchanged files are not re-read either.
+"""
+
+import os
+import json
+import sqlite3
+import hashlib
+
+
+def open_cache(path):
+    """Opens (and creates if necessary) the cache database."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS file_digests "
+                 "(path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, digest TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS results "
+                 "(key TEXT PRIMARY KEY, metrics TEXT, created TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+    conn.commit()
+    return conn
+
+
+def hash_file(path, chunk_size=4 * 1024 * 1024):
+    """SHA-256 of the file content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digest(conn, path):
+    """Content hash of a file, only re-hashed if its mtime or size changed since the last call."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    row = conn.execute("SELECT mtime_ns, size, digest FROM file_digests WHERE path = ?", (path,)).fetchone()
+    if row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+        return row[2]
+
+    digest = hash_file(path)
+    conn.execute("INSERT OR REPLACE INTO file_digests VALUES (?, ?, ?, ?)",
+                 (path, stat.st_mtime_ns, stat.st_size, digest))
+    conn.commit()
+    return digest
+
+
+def cache_key(pred_digest, gt_digest, metric_set, params=None):
+    """Key of a per-case result: content of both inputs plus what was computed and how."""
+    payload = json.dumps([pred_digest, gt_digest, metric_set, params or {}], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get_result(conn, key):
+    """Returns the cached metrics of a key or None."""
+    row = conn.execute("SELECT metrics FROM results WHERE key = ?", (key,)).fetchone()
+    return None if row is None else json.loads(row[0])
+
+
+def put_result(conn, key, metrics):
+    conn.execute("INSERT OR REPLACE INTO results (key, metrics) VALUES (?, ?)", (key, json.dumps(metrics)))
+    conn.commit()
@@ -0,0 +1,195 @@
+"""
+Shared NIfTI I/O for the nnunet/ and figures/ scripts.
+
+    load_header(path)          image without decoded data (affine and header only)
+    load_data(path, dtype)     decoded voxel array in its stored dtype, or cast to dtype
+    load_image(path, dtype)    Nifti1Image around load_data, e.g. for nib.save or combine_masks
+    load_slices(path, slices)  only the given axial slices, read through a gzip seek index
+    header_from_bytes(raw)     header of a file read into memory, without decompressing the data
+    image_from_bytes(raw)      image of a file that was already read into memory (prefetch.py)
+    image_to_bytes(img, path)  what save would write to path, for writing it elsewhere (prefetch.py)
+
+Decoded arrays are kept in a process-wide LRU cache keyed by (path, mtime, size), so a file that
+is used by several steps of a pipeline is only decompressed once; a file that changed on disk is
+a new key. The cache is capped in bytes (ICH_NIFTI_CACHE_MB, default 2048, 0 disables it) and
+counts hits, misses and evictions. Cached arrays are read-only: copy before modifying in place.
+
+When ICH_VOLUME_CACHE points to a volume cache (see volume_cache.py), files that are in it are
+read from their uncompressed copy instead: load_data then returns a read-only memmap, which
+worker processes share through the page cache, so these arrays bypass the LRU cache.
+"""
+
+import io
+import os
+import gzip
+from collections import OrderedDict
+import numpy as np
+import nibabel as nib
+from gzip_index import read_slices
+import volume_cache
+import tracing
+
+
+class LRUCache:
+    """Least recently used cache of numpy arrays with a cap on the total number of bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, array):
+        if array.nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.num_bytes -= self.entries.pop(key).nbytes
+        while self.entries and self.num_bytes + array.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= evicted.nbytes
+            self.evictions += 1
+        self.entries[key] = array
+        self.num_bytes += array.nbytes
+
+    def discard(self, path):
+        """Drops every entry of a path (any mtime, size or dtype)."""
+        for key in [key for key in self.entries if key[0] == path]:
+            self.num_bytes -= self.entries.pop(key).nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.entries), "bytes": self.num_bytes, "max_bytes": self.max_bytes}
+
+
+_cache = LRUCache(int(float(os.environ.get("ICH_NIFTI_CACHE_MB", 2048)) * 1024 ** 2))
+
+
+def cache_stats():
+    """Hits, misses, evictions, number of entries and bytes of the process-wide cache."""
+    return _cache.stats()
+
+
+def clear_cache():
+    _cache.clear()
+
+
+def _cache_key(path, dtype):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size, None if dtype is None else np.dtype(dtype).str
+
+
+def load_header(path):
+    """
+    Loads the image without decoding its data; use .affine, .header and .shape (the dataobj
+    is a lazy proxy, e.g. for the stored unscaled values, read from the volume cache if there).
+    """
+    return nib.load(volume_cache.lookup(path) or path)
+
+
+def load_data(path, dtype=None, cache=True):
+    """
+    Decoded voxel data of a NIfTI file as a read-only array.
+
+    With dtype=None the data keeps its stored dtype (scaling from the header is applied by
+    nibabel, which then gives floats); otherwise it is cast to dtype, e.g. np.float64 for the
+    result of get_fdata() or np.uint8 for label maps.
+    """
+    cached = volume_cache.lookup(path)
+    if cached is not None:
+        data = np.asanyarray(nib.load(cached, mmap="r").dataobj)
+        if dtype is None or data.dtype == np.dtype(dtype):
+            return data
+        path = cached
+
+    key = _cache_key(path, dtype) if cache else None
+    if cache:
+        data = _cache.get(key)
+        if data is not None:
+            return data
+
+    with tracing.span("load", "io", file=os.path.basename(path)):
+        data = np.asanyarray(nib.load(path).dataobj)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    data.flags.writeable = False
+
+    if cache:
+        _cache.put(key, data)
+    return data
+
+
+def load_image(path, dtype=None, cache=True):
+    """Nifti1Image with the affine and header of the file and the (cached) data of load_data."""
+    img = load_header(path)
+    return nib.Nifti1Image(load_data(path, dtype, cache), img.affine, img.header)
+
+
+def load_slices(path, slices, dtype=None, cache=True):
+    """
+    Full-size read-only array in which only the given axial (last axis) slices are read, the
+    rest is zero. For scripts that only look at a few slices: the slices are read through
+    gzip_index, so the rest of the file is not decompressed.
+    """
+    key = _cache_key(path, dtype) + (tuple(slices),) if cache else None
+    if cache:
+        data = _cache.get(key)
+        if data is not None:
+            return data
+
+    path = volume_cache.lookup(path) or path
+    shape = load_header(path).shape
+    with tracing.span("load slices", "io", file=os.path.basename(path)):
+        stack = read_slices(path, slices, axis=2, dtype=dtype)
+    data = np.zeros(shape, dtype=stack.dtype)
+    data[:, :, list(slices)] = stack
+    data.flags.writeable = False
+
+    if cache:
+        _cache.put(key, data)
+    return data
+
+
+def header_from_bytes(raw):
+    """Nifti1Header of the content of a .nii or .nii.gz file; only the header is decompressed."""
+    fileobj = io.BytesIO(raw)
+    if raw[:2] == b"\x1f\x8b":
+        fileobj = gzip.GzipFile(fileobj=fileobj)
+    return nib.Nifti1Header.from_fileobj(fileobj)
+
+
+def image_from_bytes(raw):
+    """Nifti1Image of the content of a .nii or .nii.gz file; the data is decoded from memory."""
+    if raw[:2] == b"\x1f\x8b":
+        raw = gzip.decompress(raw)
+    return nib.Nifti1Image.from_bytes(raw)
+
+
+def image_to_bytes(img, path):
+    """Content of the file nib.save would write to path (gzip level 1, as nibabel, for .gz)."""
+    raw = img.to_bytes()
+    return gzip.compress(raw, compresslevel=1) if str(path).endswith(".gz") else raw
+
+
+def save(img, path):
+    """
+    nib.save that also drops the cached data of the overwritten file. A link (e.g. into the scan
+    store) is replaced instead of written through, so the file it points to is not modified.
+    """
+    _cache.discard(os.path.abspath(path))
+    if os.path.islink(path) or (os.path.exists(path) and os.stat(path).st_nlink > 1):
+        os.remove(path)
+    with tracing.span("write", "io", file=os.path.basename(str(path))):
+        nib.save(img, path)
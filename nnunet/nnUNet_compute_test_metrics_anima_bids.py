@@ -70,52 +70,113 @@ USAGE:
 python nnUNet_compute_test_metrics_anima.py --pred_folder <path_to_predictions_folder> 
 --gt_folder <path_to_gt_folder> -t_id <task_id> -t_name <task_name> -o <output_folder>
 
+Per-case results are cached in <output_folder>/metrics_cache.sqlite, keyed by the content of the
+prediction and the GT, so a rerun after changing a few predictions only re-evaluates those cases
+(use --no_cache to evaluate everything again).
+
 """
 
 import os
 import glob
-import subprocess
 import argparse
+import subprocess
 from collections import defaultdict
 import xml.etree.ElementTree as ET
 import pandas as pd
 import numpy as np
 import nibabel as nib
 from pathlib import Path
+from nifti_io import load_data
+from metrics_cache import open_cache, file_digest, cache_key, get_result, put_result
+from results_store import open_store, load_case_names, per_case_metric_rows, upsert_metrics
+import tracing
+
+ANIMA_CONFIG = os.path.expanduser('~/.anima/config.txt')
 
-# get the ANIMA binaries path
-cmd = r'''grep "^anima = " ~/.anima/config.txt | sed "s/.* = //"'''
-anima_binaries_path = subprocess.check_output(cmd, shell=True).decode('utf-8').strip('\n')
-print('ANIMA Binaries Path:', anima_binaries_path)
 
-# Define arguments
-parser = argparse.ArgumentParser(description='Compute test metrics using animaSegPerfAnalyzer')
+def get_anima_binaries_path(config_file=ANIMA_CONFIG):
+    """Path of the ANIMA binaries, the "anima = " entry of the ANIMA config file"""
+    with open(config_file) as f:
+        for line in f:
+            if line.startswith('anima = '):
+                return line.split(' = ', 1)[1].strip()
+    raise ValueError(f'No "anima = " entry in {config_file}')
 
-# Arguments for model, data, and training
-parser.add_argument('--pred_folder', required=True, type=str,
-                    help='Path to the folder containing nifti images of test predictions')
-parser.add_argument('--gt_folder', required=True, type=str,
-                    help='Path to the folder containing nifti images of GT labels')                
-parser.add_argument('-o', '--output_folder', required=True, type=str,
-                    help='Path to the output folder to save the test metrics results')
 
-args = parser.parse_args()
+# animaSegPerfAnalyzer options used for every case, part of the cache key (see metrics_cache.py)
+ANIMA_METRIC_SET = 'animaSegPerfAnalyzer -d -l -a -s -X'
 
-pred_folder, gt_folder = args.pred_folder, args.gt_folder
-num_predictions = len(glob.glob(os.path.join(pred_folder, "*.nii.gz")))
-num_gts = len(glob.glob(os.path.join(gt_folder, "*.nii.gz"))) 
 
-if not os.path.exists(args.output_folder):
-    os.makedirs(args.output_folder, exist_ok=True)
+def anima_xml_files(output_prefix):
+    """XML files written by animaSegPerfAnalyzer for the output prefix of one subject"""
+    return sorted(glob.glob(output_prefix + '.xml') + glob.glob(output_prefix + '_*.xml'))
 
-# basic checks
-assert num_gts == num_predictions, 'Number of predictions and GTs do not match. Please check the folders.'
-print(num_gts, "\t", num_predictions)
 
-def get_test_metrics(pred_folder, gt_folder, num_predictions):
+def run_anima(pred_file, gt_file, output_prefix, anima_binaries_path):
+    """
+    Runs "animaSegPerfAnalyzer" on a single prediction/GT pair and returns the metrics
+    from the XML file(s) it writes as a list of (name, value) pairs
+    """
+    # read once per case: keep the float64 copies out of the process-wide LRU cache
+    pred_npy = load_data(pred_file, dtype=np.float64, cache=False)
+    # make sure the predictions are binary because ANIMA accepts binarized inputs only
+    #pred_npy = np.array(pred_npy > 0.5, dtype=float)
+
+    gt_npy = load_data(gt_file, dtype=np.float64, cache=False)
+    # make sure the GT is binary because ANIMA accepts binarized inputs only
+    # gt_npy = np.array(gt_npy > 0.5, dtype=float)
+    # print(((gt_npy==0.0) | (gt_npy==1.0)).all())
+
+    # Save the binarized predictions and GTs
+    pred_nib = nib.Nifti1Image(pred_npy, affine=np.eye(4))
+    gtc_nib = nib.Nifti1Image(gt_npy, affine=np.eye(4))
+    with tracing.span("write binarized", "io", case=os.path.basename(pred_file)):
+        nib.save(img=pred_nib, filename=pred_file.replace(".nii.gz", "_binarized.nii.gz"))
+        nib.save(img=gtc_nib, filename=gt_file.replace(".nii.gz", "_binarized.nii.gz"))
+
+    # Run ANIMA segmentation performance metrics on the predictions
+    # NOTE 1: For checking all the available options run the following command from your terminal: 
+    #       <anima_binaries_path>/animaSegPerfAnalyzer -h
+    # NOTE 2: We use certain additional arguments below with the following purposes:
+    #       -i -> input image, -r -> reference image, -o -> output folder
+    #       -d -> evaluates surface distance, -l -> evaluates the detection of lesions
+    #       -a -> intra-lesion evalulation (advanced), -s -> segmentation evaluation, 
+    #       -X -> save as XML file  -A -> prints details on output metrics and exits
+    
+    # remove XMLs of a previous run of this subject, so a failed run is not mistaken for a result
+    for xml_file in anima_xml_files(output_prefix):
+        os.remove(xml_file)
+
+    pred_binarized = pred_file.replace(".nii.gz", "_binarized.nii.gz")
+    gt_binarized = gt_file.replace(".nii.gz", "_binarized.nii.gz")
+    try:
+        with tracing.span("animaSegPerfAnalyzer", "subprocess", case=os.path.basename(pred_file)):
+            result = subprocess.run([os.path.join(anima_binaries_path, 'animaSegPerfAnalyzer'),
+                                     '-i', pred_binarized, '-r', gt_binarized, '-o', output_prefix,
+                                     '-d', '-l', '-a', '-s', '-X'])
+    finally:
+        # Delete temporary binarized NIfTI files
+        os.remove(pred_binarized)
+        os.remove(gt_binarized)
+
+    xml_files = anima_xml_files(output_prefix)
+    if result.returncode != 0:
+        raise RuntimeError(f'animaSegPerfAnalyzer exited with code {result.returncode}')
+    if not xml_files:
+        raise RuntimeError(f'animaSegPerfAnalyzer wrote no XML file for {output_prefix}')
+
+    metrics = []
+    for xml_file in xml_files:
+        root_node = ET.parse(source=xml_file).getroot()
+        metrics.extend((metric.get('name'), float(metric.text)) for metric in list(root_node))
+    return metrics
+
+
+def get_test_metrics(pred_folder, gt_folder, num_predictions, output_folder, anima_binaries_path, cache_conn=None):
     """
     Computes the test metrics given folders containing nifti images of test predictions 
-    and GT images by running the "animaSegPerfAnalyzer" command
+    and GT images by running the "animaSegPerfAnalyzer" command.
+    With a cache connection, only cases whose prediction or GT content changed are recomputed.
     """
 
     pred = sorted(Path(pred_folder).rglob("*.nii.gz"))
@@ -123,96 +184,167 @@ def get_test_metrics(pred_folder, gt_folder, num_predictions):
     gt = Path(gt_folder).rglob("*.nii.gz")
     gt = sorted([str(x) for x in gt])
 
+    results = []
+    num_cached = 0
     for idx in range(num_predictions):
         
         # Load the predictions and GTs        
         #pred_file = os.path.join(pred_folder, f"{args.task_name}_{(idx+1):03d}.nii.gz")
         pred_file = pred[idx]
-        pred_npy = nib.load(pred_file).get_fdata()
-        # make sure the predictions are binary because ANIMA accepts binarized inputs only
-        #pred_npy = np.array(pred_npy > 0.5, dtype=float)
-
         #gt_file = os.path.join(gt_folder, f"{args.task_name}_{(idx+1):03d}.nii.gz")
         gt_file = gt[idx]
-        gt_npy = nib.load(gt_file).get_fdata()
-        # make sure the GT is binary because ANIMA accepts binarized inputs only
-        # gt_npy = np.array(gt_npy > 0.5, dtype=float)
-        # print(((gt_npy==0.0) | (gt_npy==1.0)).all())
-
-        # Save the binarized predictions and GTs
-        pred_nib = nib.Nifti1Image(pred_npy, affine=np.eye(4))
-        gtc_nib = nib.Nifti1Image(gt_npy, affine=np.eye(4))
-        nib.save(img=pred_nib, filename=pred[idx].replace(".nii.gz", "_binarized.nii.gz"))
-        nib.save(img=gtc_nib, filename=gt[idx].replace(".nii.gz", "_binarized.nii.gz"))
-
-        # Run ANIMA segmentation performance metrics on the predictions
-        # NOTE 1: For checking all the available options run the following command from your terminal: 
-        #       <anima_binaries_path>/animaSegPerfAnalyzer -h
-        # NOTE 2: We use certain additional arguments below with the following purposes:
-        #       -i -> input image, -r -> reference image, -o -> output folder
-        #       -d -> evaluates surface distance, -l -> evaluates the detection of lesions
-        #       -a -> intra-lesion evalulation (advanced), -s -> segmentation evaluation, 
-        #       -X -> save as XML file  -A -> prints details on output metrics and exits
-        
-        seg_perf_analyzer_cmd = '%s -i %s -r %s -o %s -d -l -a -s -X'
-        os.system(seg_perf_analyzer_cmd %
-                    (os.path.join(anima_binaries_path, 'animaSegPerfAnalyzer'),
-                    pred[idx].replace(".nii.gz", "_binarized.nii.gz"),
-                    gt[idx].replace(".nii.gz", "_binarized.nii.gz"),
-                    os.path.join(args.output_folder, f"{(idx+1)}")))
-
-        # Delete temporary binarized NIfTI files
-        os.remove(pred[idx].replace(".nii.gz", "_binarized.nii.gz"))
-        os.remove(gt[idx].replace(".nii.gz", "_binarized.nii.gz"))
 
-    # Get all XML filepaths where ANIMA performance metrics are saved for each hold-out subject
-    subject_filepaths = [os.path.join(args.output_folder, f) for f in
-                            os.listdir(args.output_folder) if f.endswith('.xml')]
-    
-    return subject_filepaths
+        metrics, key = None, None
+        if cache_conn is not None:
+            key = cache_key(file_digest(cache_conn, pred_file), file_digest(cache_conn, gt_file),
+                            ANIMA_METRIC_SET, {'anima': anima_binaries_path})
+            metrics = get_result(cache_conn, key)
+
+        if metrics is None:
+            try:
+                with tracing.span("case", "case", case=os.path.basename(pred_file)):
+                    metrics = run_anima(pred_file, gt_file, os.path.join(output_folder, f"{(idx+1)}"),
+                                        anima_binaries_path)
+            except Exception as e:
+                # reported as failed and not cached, so the next run evaluates the subject again
+                print(f"Error: {pred_file}: {e}")
+                metrics = None
+            if cache_conn is not None and metrics:
+                put_result(cache_conn, key, metrics)
+        else:
+            num_cached += 1
+
+        case = os.path.basename(pred_file).replace(".nii.gz", "")
+        results.append({'subject': idx + 1, 'case': case, 'metrics': metrics})
+
+    print(f'{num_cached} of {num_predictions} cases taken from the cache.')
+    return results
     
 
-# Get all XML filepaths where ANIMA performance metrics are saved for each hold-out subject
-subject_filepaths = get_test_metrics(pred_folder, gt_folder, num_predictions)
-
-test_metrics = defaultdict(list)
-
-# Update the test metrics dictionary by iterating over all subjects
-for subject_filepath in subject_filepaths:
-    # print(subject_filepath)
-    subject = os.path.split(subject_filepath)[-1].split('_')[0]
-    root_node = ET.parse(source=subject_filepath).getroot()
-
-    # if GT is empty then metrics aren't calculated, hence the only entries in the XML file 
-    # NbTestedLesions and VolTestedLesions, both of which are zero. Hence, we can skip subjects
-    # with empty GTs by checked if the length of the .xml file is 2
-    if len(root_node) == 2:
-        print(f"Skipping Subject={int(subject):03d} ENTIRELY Due to Empty GT!")
-        continue
-
-    # # Check if RelativeVolumeError is INF -> means the GT is empty and should be ignored
-    # rve_metric = list(root_node)[6]
-    # assert rve_metric.get('name') == 'RelativeVolumeError'
-    # if np.isinf(float(rve_metric.text)):
-    #     print('Skipping Subject=%s ENTIRELY Due to Empty GT!' % subject)
-    #     continue
+def collect_metrics(subject_results):
+    """
+    Aggregates the per-subject ANIMA metrics. Returns the finite values of every metric
+    (dict name -> list) and the per-case table (one row per subject).
+    """
+    test_metrics = defaultdict(list)
+    # per-case table (one row per subject), used e.g. by bootstrap_metrics.py for confidence intervals
+    per_case_rows = []
 
-    for metric in list(root_node):
-        name, value = metric.get('name'), float(metric.text)
+    # Update the test metrics dictionary by iterating over all subjects
+    for subject_result in subject_results:
+        subject = subject_result['subject']
+        metrics = subject_result['metrics']
 
-        if np.isinf(value) or np.isnan(value):
-            print(f'Skipping Metric={name} for Subject={int(subject):03d} Due to INF or NaNs!')
+        if metrics is None:
+            print(f"Skipping Subject={int(subject):03d} ENTIRELY Due to a Failed ANIMA Run!")
             continue
 
-        test_metrics[name].append(value)
-
+        # if GT is empty then metrics aren't calculated, hence the only entries in the XML file 
+        # NbTestedLesions and VolTestedLesions, both of which are zero. Hence, we can skip subjects
+        # with empty GTs by checked if the length of the .xml file is 2
+        if len(metrics) == 2:
+            print(f"Skipping Subject={int(subject):03d} ENTIRELY Due to Empty GT!")
+            continue
 
-# Print aggregation of each metric via mean and standard dev.
-print('Test Phase Metrics [ANIMA]: ')
-for key in test_metrics:
-    print('\t%s -> Mean: %0.4f Std: %0.2f' % (key, np.mean(test_metrics[key]), np.std(test_metrics[key])))
-    
-    # save the metrics to a log file
-    with open(os.path.join(args.output_folder, 'log.txt'), 'a') as f:
-                print("\t%s --> Mean: %0.3f, Std: %0.3f" % 
-                        (key, np.mean(test_metrics[key]), np.std(test_metrics[key])), file=f)
+        # # Check if RelativeVolumeError is INF -> means the GT is empty and should be ignored
+        # rve_metric = list(root_node)[6]
+        # assert rve_metric.get('name') == 'RelativeVolumeError'
+        # if np.isinf(float(rve_metric.text)):
+        #     print('Skipping Subject=%s ENTIRELY Due to Empty GT!' % subject)
+        #     continue
+
+        row = {'subject': int(subject), 'case': subject_result['case']}
+        per_case_rows.append(row)
+
+        for name, value in metrics:
+            row[name] = value if np.isfinite(value) else np.nan
+
+            if np.isinf(value) or np.isnan(value):
+                print(f'Skipping Metric={name} for Subject={int(subject):03d} Due to INF or NaNs!')
+                continue
+
+            test_metrics[name].append(value)
+
+    return test_metrics, pd.DataFrame(per_case_rows)
+
+
+def main(argv=None):
+    # Define arguments
+    parser = argparse.ArgumentParser(description='Compute test metrics using animaSegPerfAnalyzer')
+
+    # Arguments for model, data, and training
+    parser.add_argument('--pred_folder', required=True, type=str,
+                        help='Path to the folder containing nifti images of test predictions')
+    parser.add_argument('--gt_folder', required=True, type=str,
+                        help='Path to the folder containing nifti images of GT labels')                
+    parser.add_argument('-o', '--output_folder', required=True, type=str,
+                        help='Path to the output folder to save the test metrics results')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Path to the per-case results cache (default: <output_folder>/metrics_cache.sqlite)')
+    parser.add_argument('--no_cache', action='store_true',
+                        help='Re-evaluate every case instead of reusing cached results of unchanged cases')
+    parser.add_argument('--store', type=str, default=None,
+                        help='Also upsert the per-case metrics into this results store (see results_store.py)')
+    parser.add_argument('--model_id', type=str, default=None,
+                        help='Model/dataset ID used as results store key, e.g. 804')
+    parser.add_argument('--mask_type', type=str, default='PH',
+                        help='Mask type used as results store key, e.g. PH, edema or IVH')
+    parser.add_argument('--conversion_dict', type=str, default=None,
+                        help='conversion_dict.json of the dataset, maps the case names back to the ICH IDs')
+    parser.add_argument('--conversion_split', type=str, default='imagesTs', choices=['imagesTr', 'imagesTs'],
+                        help='Split folder the evaluated cases come from (case names are numbered per split)')
+
+    tracing.add_argument(parser)
+
+    args = parser.parse_args(argv)
+    if args.store and not args.model_id:
+        parser.error('--model_id is required with --store (it is part of the results store key).')
+
+    tracing.enable(args.trace)
+
+    # get the ANIMA binaries path
+    anima_binaries_path = get_anima_binaries_path()
+    print('ANIMA Binaries Path:', anima_binaries_path)
+
+    pred_folder, gt_folder = args.pred_folder, args.gt_folder
+    num_predictions = len(glob.glob(os.path.join(pred_folder, "*.nii.gz")))
+    num_gts = len(glob.glob(os.path.join(gt_folder, "*.nii.gz"))) 
+
+    if not os.path.exists(args.output_folder):
+        os.makedirs(args.output_folder, exist_ok=True)
+
+    # basic checks
+    assert num_gts == num_predictions, 'Number of predictions and GTs do not match. Please check the folders.'
+    print(num_gts, "\t", num_predictions)
+
+    cache_conn = None if args.no_cache else open_cache(args.cache or os.path.join(args.output_folder, 'metrics_cache.sqlite'))
+
+    # Get the ANIMA performance metrics of each hold-out subject
+    subject_results = get_test_metrics(pred_folder, gt_folder, num_predictions, args.output_folder,
+                                       anima_binaries_path, cache_conn)
+    failed = [result['case'] for result in subject_results if result['metrics'] is None]
+    if failed:
+        print(f'ANIMA failed for {len(failed)} subjects (not cached, not aggregated): {failed}')
+
+    test_metrics, per_case_table = collect_metrics(subject_results)
+    per_case_table.to_csv(os.path.join(args.output_folder, 'per_case_metrics.csv'), index=False)
+
+    if args.store:
+        case_names = load_case_names(args.conversion_dict, args.conversion_split) if args.conversion_dict else None
+        upsert_metrics(open_store(args.store), per_case_metric_rows(per_case_table, args.model_id, args.mask_type,
+                                                                    case_names, os.path.abspath(args.output_folder)))
+
+    # Print aggregation of each metric via mean and standard dev.
+    print('Test Phase Metrics [ANIMA]: ')
+    # the log is regenerated on every run, including the cases taken from the cache
+    with open(os.path.join(args.output_folder, 'log.txt'), 'w') as f:
+        for key in test_metrics:
+            print('\t%s -> Mean: %0.4f Std: %0.2f' % (key, np.mean(test_metrics[key]), np.std(test_metrics[key])))
+
+            # save the metrics to a log file
+            print("\t%s --> Mean: %0.3f, Std: %0.3f" % 
+                    (key, np.mean(test_metrics[key]), np.std(test_metrics[key])), file=f)
+
+
+if __name__ == "__main__":
+    main()
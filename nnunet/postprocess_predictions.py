@@ -0,0 +1,268 @@
+"""
+Connected-component postprocessing of prediction folders: removes small spurious foci and other
+implausible components per class before volumetry and evaluation.
+
+Rules are given per class (a name with one or more label values) in a JSON file:
+
+    {
+        "PH":  {"labels": [1], "min_size_mm3": 30, "keep_largest": 0, "remove_border": true},
+        "IVH": {"labels": [4, 5, 6], "min_size_mm3": 20, "confine_to": [1, 2, 3]}
+    }
+
+or, for a single class, with --labels/--min_size_mm3/--keep_largest/--remove_border/--confine_to.
+The components of a class are those of the union of its labels (e.g. a clot reaching from the
+lateral into the third ventricle is one IVH component), with --connectivity / "connectivity"
+(3 = 26-neighbourhood by default). Every component is checked in this order:
+
+    confine_to      kept only if it overlaps or touches voxels with these labels, in the
+                    prediction itself or, with --confine_folder, in the label map of the same
+                    name there (e.g. ventricle segmentations for binary IVH predictions)
+    remove_border   removed if it touches a face of the volume
+    min_size_mm3    removed if smaller than this volume
+    keep_largest    only the N largest of the remaining components are kept (0 = all)
+
+Removed voxels become background. The bounding boxes of all labels are found in one pass, the
+components of every class are labelled once inside the bounding box of its labels, and all
+checks and removals work inside each component's own bounding box, so full-resolution CTs stay
+cheap. Cases are processed in parallel. The output folder gets the postprocessed masks (same
+dtype and header), the rules used (postprocessing.json) and one row per component with the
+decision (postprocessing_components.csv).
+
+USAGE:
+python postprocess_predictions.py --input_folder /path/to/predictions --output_folder /path/to/predictions_pp --min_size_mm3 30
+python postprocess_predictions.py --input_folder /path/to/predictions --output_folder /path/to/predictions_pp --rules rules.json --num_processes 8
+"""
+
+import os
+import json
+import argparse
+import multiprocessing
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy import ndimage
+from nifti_io import load_data, load_header, save
+import tracing
+
+
+RULE_DEFAULTS = {"labels": [1], "min_size_mm3": 0.0, "keep_largest": 0, "remove_border": False, "confine_to": [],
+                 "connectivity": 3}
+
+
+def make_rules(rules):
+    """Rules {name: rule} with the defaults filled in. Raises ValueError for unknown keys or shared labels."""
+    complete, owners = {}, {}
+    for name, rule in rules.items():
+        unknown = set(rule) - set(RULE_DEFAULTS)
+        if unknown:
+            raise ValueError(f"rule {name}: unknown keys {sorted(unknown)}")
+        rule = dict(RULE_DEFAULTS, **rule)
+        rule["labels"] = [int(value) for value in rule["labels"]]
+        rule["confine_to"] = [int(value) for value in rule["confine_to"]]
+        for value in rule["labels"]:
+            if value in owners:
+                raise ValueError(f"label {value} is in the rules {owners[value]} and {name}")
+            owners[value] = name
+        complete[name] = rule
+    return complete
+
+
+def load_rules(path):
+    with open(path) as f:
+        return make_rules(json.load(f))
+
+
+def load_label_map(path):
+    """Image and integer voxel data of a label map (in its stored dtype if that is integral)."""
+    img, data = load_header(path), load_data(path)
+    if not np.issubdtype(data.dtype, np.integer):
+        data = np.rint(data).astype(np.int32)
+    return img, data
+
+
+def label_boxes(data):
+    """{label value: bounding box} of all positive labels, from one find_objects pass."""
+    return {value: box for value, box in enumerate(ndimage.find_objects(np.clip(data, 0, None)), start=1)
+            if box is not None}
+
+
+def union_box(boxes):
+    boxes = [box for box in boxes if box is not None]
+    if not boxes:
+        return None
+    return tuple(slice(min(box[axis].start for box in boxes), max(box[axis].stop for box in boxes))
+                 for axis in range(len(boxes[0])))
+
+
+def label_components(data, labels, boxes, connectivity=3):
+    """
+    Components of the union of labels, labelled inside its bounding box. Returns the component
+    map of the box, the number of components and the box (None if the labels are absent).
+    """
+    box = union_box([boxes.get(value) for value in labels])
+    if box is None:
+        return None, 0, None
+    structure = ndimage.generate_binary_structure(data.ndim, connectivity)
+    components, num_components = ndimage.label(np.isin(data[box], labels), structure=structure)
+    return components, num_components, box
+
+
+def component_table(components, num_components, box, shape, zooms, confine=None, confine_to=(), connectivity=3):
+    """
+    One row per component: index, voxels, volume, bounding box in the full volume, whether it
+    touches the volume border and (with confine_to) whether it overlaps or touches those labels
+    of the confine map.
+    """
+    if components is None:
+        return []
+    voxel_volume = float(np.prod(zooms[:3]))
+    voxels = np.bincount(components.ravel(), minlength=num_components + 1)
+    offset = [s.start for s in box]
+    structure = ndimage.generate_binary_structure(components.ndim, connectivity)
+    rows = []
+    for index, local in enumerate(ndimage.find_objects(components), start=1):
+        if local is None:
+            continue
+        start = [s.start + o for s, o in zip(local, offset)]
+        stop = [s.stop + o for s, o in zip(local, offset)]
+        row = {"component": index, "voxels": int(voxels[index]), "volume_mm3": voxels[index] * voxel_volume,
+               "bbox_start": tuple(start), "bbox_stop": tuple(stop),
+               "border": any(lo == 0 or hi == size for lo, hi, size in zip(start, stop, shape)),
+               "confined": None}
+        if confine_to:
+            # the component grown by one voxel, inside its box padded by one voxel
+            padded = tuple(slice(max(lo - 1, 0), min(hi + 1, size)) for lo, hi, size in zip(start, stop, shape))
+            component = np.zeros([p.stop - p.start for p in padded], dtype=bool)
+            component[tuple(slice(lo - p.start, hi - p.start) for lo, hi, p in zip(start, stop, padded))] = \
+                components[local] == index
+            grown = ndimage.binary_dilation(component, structure=structure)
+            row["confined"] = bool(np.any(np.isin(confine[padded][grown], confine_to)))
+        rows.append(row)
+    return rows
+
+
+def decide(rows, rule):
+    """Reason for removing every component of a table (None if it is kept), in the order of the rows."""
+    reasons = []
+    for row in rows:
+        if rule["confine_to"] and not row["confined"]:
+            reasons.append("confine_to")
+        elif rule["remove_border"] and row["border"]:
+            reasons.append("remove_border")
+        elif row["volume_mm3"] < rule["min_size_mm3"]:
+            reasons.append("min_size_mm3")
+        else:
+            reasons.append(None)
+    if rule["keep_largest"]:
+        candidates = sorted((i for i, reason in enumerate(reasons) if reason is None),
+                            key=lambda i: (-rows[i]["voxels"], rows[i]["component"]))
+        for i in candidates[rule["keep_largest"]:]:
+            reasons[i] = "keep_largest"
+    return reasons
+
+
+def postprocess_array(data, rules, zooms, confine=None):
+    """Postprocessed copy of a label map and one row per component with the rule and the decision."""
+    output = data.copy()
+    confine = data if confine is None else confine
+    if confine.shape != data.shape:
+        raise ValueError(f"confine map shape {confine.shape} does not match {data.shape}")
+    boxes = label_boxes(data)
+    log = []
+    for name, rule in rules.items():
+        with tracing.span("postprocess", "compute", rule=name):
+            components, num_components, box = label_components(data, rule["labels"], boxes, rule["connectivity"])
+            rows = component_table(components, num_components, box, data.shape, zooms, confine, rule["confine_to"],
+                                   rule["connectivity"])
+            for row, reason in zip(rows, decide(rows, rule)):
+                if reason is not None:
+                    component_box = tuple(slice(lo, hi) for lo, hi in zip(row["bbox_start"], row["bbox_stop"]))
+                    local = tuple(slice(s.start - b.start, s.stop - b.start) for s, b in zip(component_box, box))
+                    output[component_box][components[local] == row["component"]] = 0
+                log.append(dict(row, rule=name, kept=reason is None, reason=reason or ""))
+    return output, log
+
+
+def postprocess_file(pred_path, output_path, rules, confine_path=None):
+    """Writes the postprocessed prediction to output_path. Returns the component rows."""
+    img, data = load_label_map(pred_path)
+    confine = load_label_map(confine_path)[1] if confine_path else None
+    output, log = postprocess_array(data, rules, img.header.get_zooms(), confine)
+    out = nib.Nifti1Image(output.astype(img.get_data_dtype(), copy=False), img.affine, img.header)
+    save(out, output_path)
+    case = os.path.basename(pred_path).replace(".nii.gz", "")
+    return [dict({"case": case}, **row) for row in log]
+
+
+def safe_postprocess_file(pred_path, output_path, rules, confine_path=None):
+    """Like postprocess_file, but reports the error instead of stopping the whole batch."""
+    try:
+        with tracing.span("case", "case", file=os.path.basename(pred_path)):
+            return postprocess_file(pred_path, output_path, rules, confine_path)
+    except Exception as e:
+        print(f"Error: {pred_path}: {e}")
+        return None
+
+
+def rules_from_args(args):
+    if args.rules:
+        return load_rules(args.rules)
+    return make_rules({"default": {"labels": args.labels, "min_size_mm3": args.min_size_mm3,
+                                   "keep_largest": args.keep_largest, "remove_border": args.remove_border,
+                                   "confine_to": args.confine_to or [], "connectivity": args.connectivity}})
+
+
+def add_rule_arguments(parser):
+    parser.add_argument("--rules", type=str, default=None, help="JSON file with the rules per class (see above).")
+    parser.add_argument("--labels", nargs="+", type=int, default=[1], help="Labels of the class (without --rules).")
+    parser.add_argument("--min_size_mm3", type=float, default=0.0, help="Minimum component volume (without --rules).")
+    parser.add_argument("--keep_largest", type=int, default=0, help="Keep the N largest components, 0 = all (without --rules).")
+    parser.add_argument("--remove_border", action="store_true", help="Remove components touching the volume border (without --rules).")
+    parser.add_argument("--confine_to", nargs="+", type=int, default=None,
+                        help="Keep only components overlapping or touching these labels (without --rules).")
+    parser.add_argument("--connectivity", type=int, default=3, choices=[1, 2, 3],
+                        help="Neighbourhood of the components: 1 = 6-, 2 = 18-, 3 = 26-connectivity (without --rules).")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Remove implausible connected components from predictions.")
+    parser.add_argument("--input_folder", required=True, type=str, help="Folder with the predictions.")
+    parser.add_argument("--output_folder", required=True, type=str, help="Folder for the postprocessed predictions.")
+    parser.add_argument("--pattern", type=str, default="*.nii.gz", help="Pattern of the predictions.")
+    parser.add_argument("--confine_folder", type=str, default=None,
+                        help="Label maps of the same names for confine_to (default: the predictions themselves).")
+    add_rule_arguments(parser)
+    parser.add_argument("--num_processes", type=int, default=os.cpu_count(), help="Number of processes in parallel.")
+    tracing.add_argument(parser)
+    args = parser.parse_args(argv)
+    tracing.enable(args.trace)
+
+    rules = rules_from_args(args)
+    os.makedirs(args.output_folder, exist_ok=True)
+    with open(os.path.join(args.output_folder, "postprocessing.json"), "w") as f:
+        json.dump(rules, f, indent=4)
+
+    predictions = sorted(Path(args.input_folder).glob(args.pattern))
+    jobs = [(str(path), os.path.join(args.output_folder, path.name), rules,
+             os.path.join(args.confine_folder, path.name) if args.confine_folder else None) for path in predictions]
+    print(f"Found {len(predictions)} predictions. Postprocessing...")
+    with multiprocessing.Pool(processes=args.num_processes) as pool:
+        results = pool.starmap(safe_postprocess_file, jobs)
+
+    rows = [row for case_rows in results if case_rows for row in case_rows]
+    table = pd.DataFrame(rows, columns=["case", "rule", "component", "voxels", "volume_mm3", "bbox_start", "bbox_stop",
+                                        "border", "confined", "kept", "reason"])
+    table.to_csv(os.path.join(args.output_folder, "postprocessing_components.csv"), index=False)
+    failed = sum(case_rows is None for case_rows in results)
+    print(f"Postprocessed {len(results) - failed} predictions ({failed} failed)")
+    for name in rules:
+        components = table[table["rule"] == name]
+        removed = components[~components["kept"].astype(bool)]
+        reasons = ", ".join(f"{reason}: {count}" for reason, count in removed["reason"].value_counts().items())
+        print(f"{name}: removed {len(removed)} of {len(components)} components, {removed['volume_mm3'].sum() / 1000.0:.2f} "
+              f"of {components['volume_mm3'].sum() / 1000.0:.2f} mL" + (f" ({reasons})" if reasons else ""))
+
+
+if __name__ == "__main__":
+    main()
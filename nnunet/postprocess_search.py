@@ -0,0 +1,295 @@
+"""
+Grid search over the postprocessing rules of postprocess_predictions.py (minimum component size,
+keep-largest, border removal, confine_to) against the GT, without postprocessing any volume.
+
+Every rule only keeps or removes whole components, so all metrics of a setting follow from a few
+numbers per component. For every case and class, the components of the prediction and of the GT
+are labelled once, with the same labels and connectivity, and stored as tables:
+
+    prediction components   voxels, volume, touches the border, touches confine_to labels,
+                            voxels overlapping the GT
+    GT components           voxels
+    overlapping pairs       (prediction component, GT component, voxels)
+
+The tables are cached in <output_folder>/postprocess_cache.sqlite (see metrics_cache.py), keyed
+by the content of the prediction, GT (and confine map) and the class definitions, so changing
+the grid or re-running the search does not read any NIfTI again. Every setting of the grid is
+then evaluated on all cases at once with array operations on the concatenated tables:
+
+    Dice            per case (NaN for empty GT and prediction) and pooled over the test set
+    volume error    absolute (mL) and relative (%, NaN for empty GT) per case
+    lesion F1       pooled over the test set: a GT lesion is detected if a kept component
+                    overlaps it, a kept component is a true positive if it overlaps a GT lesion
+
+The classes (labels, confine_to, connectivity) come from --rules (the thresholds in the file are
+ignored) or from --labels/--confine_to/--connectivity. The output folder gets one row per class
+and setting (postprocess_search.csv, sorted by --objective) and the best setting of every class
+as a rules file for postprocess_predictions.py (best_rules.json).
+
+USAGE:
+python postprocess_search.py --pred_folder /path/to/predictions --gt_folder /path/to/labelsTs -o /path/to/postprocess_search
+python postprocess_search.py --pred_folder /path/to/predictions --gt_folder /path/to/labelsTs --rules rules.json --min_size_mm3 0 10 20 50 100 200 --keep_largest 0 1 2 3 -o /path/to/postprocess_search
+"""
+
+import os
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+import pandas as pd
+from postprocess_predictions import (make_rules, load_rules, load_label_map, label_boxes,
+                                     label_components, component_table)
+from compute_multi_class_metrics import get_case_pairs
+from metrics_cache import open_cache, file_digest, cache_key, get_result, put_result
+import tracing
+
+
+# part of the cache key, bump when the tables change
+TABLE_SET = "postprocess component tables v1"
+
+OBJECTIVES = ["Dice", "Dice_pooled", "LesionF1", "AbsVolumeError_mL"]
+
+
+def pair_overlaps(components, box, gt_components, gt_box, num_gt):
+    """(prediction component, GT component, voxels) of all overlapping pairs (components numbered from 0)."""
+    if components is None or gt_components is None:
+        return []
+    inter = [slice(max(a.start, b.start), min(a.stop, b.stop)) for a, b in zip(box, gt_box)]
+    if any(s.start >= s.stop for s in inter):
+        return []
+    pred = components[tuple(slice(s.start - b.start, s.stop - b.start) for s, b in zip(inter, box))]
+    gt = gt_components[tuple(slice(s.start - b.start, s.stop - b.start) for s, b in zip(inter, gt_box))]
+    both = (pred > 0) & (gt > 0)
+    keys, counts = np.unique(pred[both].astype(np.int64) * (num_gt + 1) + gt[both], return_counts=True)
+    return [[int(key // (num_gt + 1)) - 1, int(key % (num_gt + 1)) - 1, int(count)] for key, count in zip(keys, counts)]
+
+
+def case_tables(pred_path, gt_path, rules, confine_path=None):
+    """Component tables of one case for every class of the rules."""
+    img, pred = load_label_map(pred_path)
+    gt = load_label_map(gt_path)[1]
+    confine = load_label_map(confine_path)[1] if confine_path else pred
+    if gt.shape != pred.shape or confine.shape != pred.shape:
+        raise ValueError(f"shapes {pred.shape} (prediction), {gt.shape} (GT), {confine.shape} (confine map) differ")
+    zooms = img.header.get_zooms()
+    boxes, gt_boxes = label_boxes(pred), label_boxes(gt)
+
+    tables = {"voxel_volume_mm3": float(np.prod(zooms[:3])), "classes": {}}
+    for name, rule in rules.items():
+        with tracing.span("component tables", "compute", rule=name):
+            components, num_components, box = label_components(pred, rule["labels"], boxes, rule["connectivity"])
+            rows = component_table(components, num_components, box, pred.shape, zooms, confine, rule["confine_to"],
+                                   rule["connectivity"])
+            gt_components, num_gt, gt_box = label_components(gt, rule["labels"], gt_boxes, rule["connectivity"])
+            gt_voxels = np.bincount(gt_components.ravel(), minlength=num_gt + 1)[1:] if num_gt else []
+            tables["classes"][name] = {
+                "voxels": [row["voxels"] for row in rows],
+                "border": [row["border"] for row in rows],
+                "confined": [bool(row["confined"]) for row in rows],
+                "gt_voxels": [int(v) for v in gt_voxels],
+                "pairs": pair_overlaps(components, box, gt_components, gt_box, num_gt),
+            }
+    return tables
+
+
+def safe_case_tables(pred_path, gt_path, rules, confine_path=None):
+    """Like case_tables, but reports the error instead of stopping the whole search."""
+    try:
+        with tracing.span("case", "case", file=os.path.basename(pred_path)):
+            return case_tables(pred_path, gt_path, rules, confine_path)
+    except Exception as e:
+        print(f"Error: {pred_path}: {e}")
+        return None
+
+
+class ClassTables:
+    """The component tables of one class, concatenated over all cases."""
+
+    def __init__(self, cases, name):
+        self.num_cases = len(cases)
+        classes = [tables["classes"][name] for tables in cases]
+        self.voxel_volume = np.array([tables["voxel_volume_mm3"] for tables in cases])
+
+        counts = [len(c["voxels"]) for c in classes]
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        gt_offsets = np.concatenate([[0], np.cumsum([len(c["gt_voxels"]) for c in classes])]).astype(np.int64)
+        self.case = np.repeat(np.arange(self.num_cases), counts)
+        self.voxels = np.concatenate([c["voxels"] for c in classes] + [[]]).astype(np.int64)
+        self.volume = self.voxels * self.voxel_volume[self.case]
+        self.border = np.concatenate([c["border"] for c in classes] + [[]]).astype(bool)
+        self.confined = np.concatenate([c["confined"] for c in classes] + [[]]).astype(bool)
+        self.gt_case = np.repeat(np.arange(self.num_cases), np.diff(gt_offsets))
+        self.gt_voxels = np.bincount(self.gt_case, weights=np.concatenate([c["gt_voxels"] for c in classes] + [[]]),
+                                     minlength=self.num_cases)
+
+        pairs = [np.array(c["pairs"], dtype=np.int64).reshape(-1, 3) for c in classes]
+        self.pair_pred = np.concatenate([p[:, 0] + offsets[i] for i, p in enumerate(pairs)] + [[]]).astype(np.int64)
+        self.pair_gt = np.concatenate([p[:, 1] + gt_offsets[i] for i, p in enumerate(pairs)] + [[]]).astype(np.int64)
+        pair_voxels = np.concatenate([p[:, 2] for p in pairs] + [[]])
+        self.overlap = np.bincount(self.pair_pred, weights=pair_voxels, minlength=len(self.voxels))
+        self.num_gt = int(gt_offsets[-1])
+
+        # components by case, then by size (largest first), for keep_largest
+        self.order = np.lexsort((np.arange(len(self.voxels)), -self.voxels, self.case))
+        self.case_start = offsets[:-1]
+
+    def kept(self, min_size_mm3=0.0, keep_largest=0, remove_border=False, confine=False):
+        """Which components the setting keeps (same decisions as postprocess_predictions.decide)."""
+        keep = self.volume >= min_size_mm3
+        if remove_border:
+            keep &= ~self.border
+        if confine:
+            keep &= self.confined
+        if keep_largest:
+            ordered = keep[self.order]
+            # rank among the kept components of the same case: kept before it minus kept in earlier cases
+            before = np.concatenate([[0], np.cumsum(ordered)])
+            rank = before[:-1] - before[self.case_start][self.case[self.order]]
+            keep[self.order[ordered & (rank >= keep_largest)]] = False
+        return keep
+
+    def metrics(self, keep):
+        """Test-set metrics of a selection of components."""
+        pred_voxels = np.bincount(self.case, weights=self.voxels * keep, minlength=self.num_cases)
+        tp = np.bincount(self.case, weights=self.overlap * keep, minlength=self.num_cases)
+        detected = np.bincount(self.pair_gt, weights=keep[self.pair_pred], minlength=self.num_gt) > 0
+        kept_tp = np.count_nonzero(keep & (self.overlap > 0))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dice = 2 * tp / (pred_voxels + self.gt_voxels)
+            relative_error = np.where(self.gt_voxels > 0, 100.0 * (pred_voxels - self.gt_voxels) / self.gt_voxels, np.nan)
+            precision = kept_tp / np.count_nonzero(keep) if np.any(keep) else np.nan
+            recall = np.count_nonzero(detected) / self.num_gt if self.num_gt else np.nan
+        return {
+            "Dice": np.nanmean(dice) if np.any(np.isfinite(dice)) else np.nan,
+            "Dice_pooled": 2 * tp.sum() / max(pred_voxels.sum() + self.gt_voxels.sum(), 1),
+            "AbsVolumeError_mL": np.mean(np.abs(pred_voxels - self.gt_voxels) * self.voxel_volume) / 1000.0,
+            "RelativeVolumeError": np.nanmean(relative_error) if np.any(np.isfinite(relative_error)) else np.nan,
+            "LesionPrecision": precision,
+            "LesionRecall": recall,
+            "LesionF1": 2 * precision * recall / (precision + recall) if precision + recall > 0 else np.nan,
+            "components_kept": int(np.count_nonzero(keep)),
+            "components_removed": int(len(keep) - np.count_nonzero(keep)),
+        }
+
+
+def search(cases, rules, min_sizes, keep_largest, remove_border, confine):
+    """One row of metrics per class and setting of the grid."""
+    rows = []
+    for name, rule in rules.items():
+        tables = ClassTables(cases, name)
+        confine_values = confine if rule["confine_to"] else [False]
+        for setting in itertools.product(min_sizes, keep_largest, remove_border, confine_values):
+            min_size, largest, border, confined = setting
+            row = {"class": name, "min_size_mm3": min_size, "keep_largest": largest, "remove_border": border,
+                   "confine": confined}
+            row.update(tables.metrics(tables.kept(min_size, largest, border, confined)))
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def best_rules(results, rules, objective):
+    """Rules of the best setting of every class for postprocess_predictions.py."""
+    ascending = objective == "AbsVolumeError_mL"
+    best = {}
+    for name, rule in rules.items():
+        row = results[results["class"] == name].sort_values(objective, ascending=ascending, kind="stable").iloc[0]
+        best[name] = dict(rule, min_size_mm3=float(row["min_size_mm3"]), keep_largest=int(row["keep_largest"]),
+                          remove_border=bool(row["remove_border"]), confine_to=rule["confine_to"] if row["confine"] else [])
+    return best
+
+
+def load_cases(pairs, rules, confine_folder, cache_conn, num_processes):
+    """Component tables of every case, from the cache or computed in parallel."""
+    params = {name: {key: rule[key] for key in ("labels", "confine_to", "connectivity")} for name, rule in rules.items()}
+    cases, keys, jobs = {}, {}, []
+    for case, pred_file, gt_file in pairs:
+        confine_file = os.path.join(confine_folder, pred_file.name) if confine_folder else None
+        key = None
+        if cache_conn is not None:
+            digests = [file_digest(cache_conn, pred_file), file_digest(cache_conn, gt_file)]
+            key = cache_key(*digests, TABLE_SET, dict(params, confine=file_digest(cache_conn, confine_file)
+                                                      if confine_file else None))
+            cases[case] = get_result(cache_conn, key)
+        keys[case] = key
+        if cases.get(case) is None:
+            jobs.append((case, (str(pred_file), str(gt_file), rules, confine_file)))
+
+    print(f"{len(pairs) - len(jobs)} of {len(pairs)} cases taken from the cache.")
+    if jobs:
+        with multiprocessing.Pool(processes=num_processes) as pool:
+            results = pool.starmap(safe_case_tables, [job for _, job in jobs])
+        for (case, _), tables in zip(jobs, results):
+            cases[case] = tables
+            if cache_conn is not None and tables is not None:
+                put_result(cache_conn, keys[case], tables)
+    return [cases[case] for case, _, _ in pairs if cases.get(case) is not None]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Grid search over postprocessing rules from cached component tables.")
+    parser.add_argument("--pred_folder", required=True, type=str, help="Folder with the predictions.")
+    parser.add_argument("--gt_folder", required=True, type=str, help="Folder with the GT labels (same file names).")
+    parser.add_argument("-o", "--output_folder", required=True, type=str, help="Folder for the results and the cache.")
+    parser.add_argument("--confine_folder", type=str, default=None,
+                        help="Label maps of the same names for confine_to (default: the predictions themselves).")
+    parser.add_argument("--rules", type=str, default=None, help="Rules JSON of postprocess_predictions.py defining the classes.")
+    parser.add_argument("--labels", nargs="+", type=int, default=[1], help="Labels of the class (without --rules).")
+    parser.add_argument("--confine_to", nargs="+", type=int, default=None, help="confine_to labels of the class (without --rules).")
+    parser.add_argument("--connectivity", type=int, default=3, choices=[1, 2, 3], help="Connectivity of the class (without --rules).")
+    parser.add_argument("--min_size_mm3", nargs="+", type=float,
+                        default=[0, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 750, 1000], help="Minimum sizes to try.")
+    parser.add_argument("--keep_largest", nargs="+", type=int, default=[0, 1, 2, 3, 5], help="keep_largest values to try (0 = all).")
+    parser.add_argument("--remove_border", nargs="+", type=int, choices=[0, 1], default=[0, 1], help="remove_border values to try.")
+    parser.add_argument("--confine", nargs="+", type=int, choices=[0, 1], default=[0, 1],
+                        help="Whether to apply confine_to, for classes that have it.")
+    parser.add_argument("--objective", choices=OBJECTIVES, default="Dice", help="Metric the best setting is chosen by.")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="Path to the component table cache (default: <output_folder>/postprocess_cache.sqlite).")
+    parser.add_argument("--no_cache", action="store_true", help="Label every case again instead of using the cache.")
+    parser.add_argument("--num_processes", type=int, default=os.cpu_count(), help="Number of processes in parallel.")
+    tracing.add_argument(parser)
+    args = parser.parse_args(argv)
+    tracing.enable(args.trace)
+
+    if args.rules:
+        rules = load_rules(args.rules)
+    else:
+        rules = make_rules({"default": {"labels": args.labels, "confine_to": args.confine_to or [],
+                                        "connectivity": args.connectivity}})
+    os.makedirs(args.output_folder, exist_ok=True)
+    cache_conn = None if args.no_cache else open_cache(args.cache or os.path.join(args.output_folder, "postprocess_cache.sqlite"))
+
+    pairs = get_case_pairs(args.pred_folder, args.gt_folder)
+    print(f"Found {len(pairs)} cases. Building the component tables...")
+    cases = load_cases(pairs, rules, args.confine_folder, cache_conn, args.num_processes)
+
+    start = time.perf_counter()
+    with tracing.span("search", "compute"):
+        results = search(cases, rules, args.min_size_mm3, args.keep_largest, [bool(v) for v in args.remove_border],
+                         [bool(v) for v in args.confine])
+    elapsed = time.perf_counter() - start
+    results = results.sort_values(["class", args.objective], ascending=[True, args.objective == "AbsVolumeError_mL"],
+                                  kind="stable")
+    results.to_csv(os.path.join(args.output_folder, "postprocess_search.csv"), index=False)
+    best = best_rules(results, rules, args.objective)
+    with open(os.path.join(args.output_folder, "best_rules.json"), "w") as f:
+        json.dump(best, f, indent=4)
+
+    print(f"Evaluated {len(results)} settings on {len(cases)} cases in {elapsed:.2f} s")
+    columns = ["Dice", "Dice_pooled", "AbsVolumeError_mL", "LesionPrecision", "LesionRecall", "LesionF1"]
+    for name, rule in best.items():
+        table = results[results["class"] == name]
+        none = table[(table["min_size_mm3"] == 0) & (table["keep_largest"] == 0) & ~table["remove_border"] & ~table["confine"]]
+        top = table.iloc[0]
+        print(f"{name}: best min_size_mm3={rule['min_size_mm3']:g} keep_largest={rule['keep_largest']} "
+              f"remove_border={rule['remove_border']} confine_to={rule['confine_to']}")
+        print("\t" + " ".join(f"{column} {top[column]:.4f}" for column in columns))
+        if not none.empty:
+            print("\twithout postprocessing: " + " ".join(f"{column} {none.iloc[0][column]:.4f}" for column in columns))
+
+
+if __name__ == "__main__":
+    main()
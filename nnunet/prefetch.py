@@ -0,0 +1,215 @@
+"""
+Read-ahead / write-behind pipeline for inputs on slow network storage (NFS-mounted RAID).
+
+On /media/raid3 and raid_access2 the time per file is dominated by the latency of the remote
+reads and writes, not by the computation. run() overlaps them in three stages connected by
+bounded queues:
+
+    reader threads --(read_ahead)--> compute workers --(write_behind)--> writer threads
+
+Readers fetch whole files into memory (read_bytes), workers decode and compute from memory
+(threads, or processes for GIL-bound work), writers write the results back. At most
+read_ahead + workers + write_behind items are in memory at any time. With read_ahead=0
+everything runs one item after another in the calling thread, as before.
+
+simulated_latency() adds a delay to every open(), a stand-in for the per-file latency of the
+network storage, so the overlap can be tested on a local disk:
+
+python prefetch.py --input_folder /path/to/masks --latency_ms 50 --read_ahead 16
+"""
+
+import os
+import time
+import queue
+import builtins
+import argparse
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import tracing
+
+
+_DONE = object()
+
+
+class _Failed:
+    """An item whose read, compute or write raised; later stages pass it on untouched."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def read_bytes(path):
+    """Whole content of a file (one sequential read, which is what network storage is good at)."""
+    with tracing.span("read", "io", file=os.path.basename(str(path))):
+        with open(path, "rb") as f:
+            return f.read()
+
+
+def write_bytes(path, data):
+    """
+    Writes a file through a temporary name, so readers never see partial files. A link at
+    path (e.g. into the scan store) is replaced, not written through.
+    """
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with tracing.span("write", "io", file=os.path.basename(str(path))):
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+def _apply(function, item, value):
+    if isinstance(value, _Failed):
+        return value
+    try:
+        return function(item, value) if value is not _DONE else function(item)
+    except Exception as e:
+        return _Failed(e)
+
+
+def _stage(function, in_queue, out_queue, num_threads, num_downstream):
+    """Starts num_threads threads applying function to the (item, value) pairs of in_queue."""
+    remaining = [num_threads]
+    lock = threading.Lock()
+
+    def loop():
+        while True:
+            entry = in_queue.get()
+            if entry is _DONE:
+                break
+            item, value = entry
+            out_queue.put((item, _apply(function, item, value)))
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(num_downstream):
+                out_queue.put(_DONE)
+
+    threads = [threading.Thread(target=loop, daemon=True) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def run(items, read, compute, write=None, read_ahead=8, write_behind=8, num_readers=4, num_workers=None,
+        num_writers=2, processes=False):
+    """
+    Yields (item, result) in completion order, where result is compute(item, read(item)); with
+    write, write(item, result) is called before the item is yielded. With processes, compute
+    runs in a process pool (it must then be picklable, e.g. a module-level function or a
+    functools.partial of one). Errors of single items are printed and yield result None.
+    """
+    num_workers = num_workers or os.cpu_count()
+
+    def write_item(item, result):
+        write(item, result)
+        return result
+
+    if not read_ahead:
+        for item in items:
+            result = _apply(compute, item, _apply(read, item, _DONE))
+            if write:
+                result = _apply(write_item, item, result)
+            if isinstance(result, _Failed):
+                print(f"Error: {item}: {result.error}")
+                result = None
+            yield item, result
+        return
+
+    item_queue = queue.Queue(maxsize=num_readers)
+    read_queue = queue.Queue(maxsize=read_ahead)
+    compute_queue = queue.Queue(maxsize=write_behind)
+    done_queue = queue.Queue()
+
+    executor = ProcessPoolExecutor(max_workers=num_workers) if processes else None
+
+    def compute_item(item, data):
+        if executor is not None:
+            return executor.submit(compute, item, data).result()
+        return compute(item, data)
+
+    def feed():
+        for item in items:
+            item_queue.put((item, _DONE))
+        for _ in range(num_readers):
+            item_queue.put(_DONE)
+
+    threading.Thread(target=feed, daemon=True).start()
+    _stage(read, item_queue, read_queue, num_readers, num_workers)
+    _stage(compute_item, read_queue, compute_queue, num_workers, num_writers)
+    _stage(write_item if write else (lambda item, result: result), compute_queue, done_queue, num_writers, 1)
+
+    try:
+        while True:
+            entry = done_queue.get()
+            if entry is _DONE:
+                break
+            item, result = entry
+            if isinstance(result, _Failed):
+                print(f"Error: {item}: {result.error}")
+                result = None
+            yield item, result
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+@contextmanager
+def simulated_latency(seconds, prefix=None):
+    """
+    Delays every open() of a file (below prefix) by the given time, in this process and in
+    worker processes forked from it, to test read-ahead and write-behind on a local disk.
+    """
+    original = builtins.open
+    prefix = prefix and os.path.abspath(prefix)
+
+    def slow_open(file, *args, **kwargs):
+        if isinstance(file, (str, bytes, os.PathLike)) and (prefix is None or os.path.abspath(file).startswith(prefix)):
+            time.sleep(seconds)
+        return original(file, *args, **kwargs)
+
+    builtins.open = slow_open
+    try:
+        yield
+    finally:
+        builtins.open = original
+
+
+def _volumes(path, data):
+    from volumetry import count_labels
+    return count_labels(path, raw=data)[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare sequential and prefetched volumetry under artificial latency.")
+    parser.add_argument("--input_folder", required=True, type=str, help="Folder with NIfTI masks.")
+    parser.add_argument("--latency_ms", type=float, default=50.0, help="Artificial latency per opened file.")
+    parser.add_argument("--read_ahead", type=int, default=16, help="Read-ahead depth of the prefetched run.")
+    parser.add_argument("--num_readers", type=int, default=8, help="Reader threads of the prefetched run.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="Compute workers.")
+    tracing.add_argument(parser)
+    args = parser.parse_args(argv)
+    tracing.enable(args.trace)
+
+    from pathlib import Path
+    from volumetry import count_labels
+    masks = sorted(str(p) for p in Path(args.input_folder).rglob("*.nii.gz"))
+    print(f"{len(masks)} masks, {args.latency_ms:.0f} ms latency per opened file")
+
+    with simulated_latency(args.latency_ms / 1000.0, args.input_folder):
+        start = time.perf_counter()
+        sequential = {path: count_labels(path)[0] for path in masks}
+        sequential_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        prefetched = dict(run(masks, read_bytes, _volumes, read_ahead=args.read_ahead, num_readers=args.num_readers,
+                              num_workers=args.num_workers, processes=True))
+        prefetched_s = time.perf_counter() - start
+
+    assert prefetched == sequential, "prefetched results differ"
+    print(f"sequential {sequential_s:.2f} s, prefetched {prefetched_s:.2f} s ({sequential_s / prefetched_s:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
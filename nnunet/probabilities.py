@@ -0,0 +1,107 @@
+"""
+Helpers to access the softmax outputs nnU-Net writes with --npz / --save_probabilities.
+
+nnU-Net stores the probabilities as "probabilities" array in a (usually compressed) .npz file,
+with the spatial axes in the order of its image reader, i.e. reversed with respect to nibabel
+for the default SimpleITK reader. Compressed members are extracted once into an uncompressed
+.npy file, uncompressed members are memory-mapped straight from the .npz, so callers can
+read the probabilities slab by slab without holding the full float array in memory. The .npy
+is a temporary file (in $TMPDIR) that is deleted as soon as it is mapped, unless a cache_dir is
+given to keep it for later runs.
+"""
+
+import os
+import shutil
+import struct
+import hashlib
+import tempfile
+import zipfile
+import numpy as np
+
+
+def _member_name(archive, key):
+    name = f"{key}.npy"
+    if name not in archive.namelist():
+        raise KeyError(f"{archive.filename} does not contain '{key}', found {archive.namelist()}")
+    return name
+
+
+def _memmap_stored_member(npz_path, info):
+    """Memory-maps an uncompressed .npy member of a zip archive in place."""
+    with open(npz_path, "rb") as f:
+        # the local file header is 30 bytes followed by the file name and an extra field
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+        name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    return np.memmap(npz_path, dtype=dtype, mode="r", shape=shape, offset=offset,
+                     order="F" if fortran_order else "C")
+
+
+def cache_path_for(npz_path, cache_dir, key="probabilities"):
+    """
+    Location of the uncompressed .npy copy of a compressed .npz member in cache_dir. The name
+    includes a hash of the .npz folder, as the model folders of an ensemble share case names.
+    """
+    folder = hashlib.sha256(os.path.dirname(os.path.abspath(npz_path)).encode("utf-8")).hexdigest()[:12]
+    stem = os.path.basename(npz_path)[:-len(".npz")]
+    return os.path.join(cache_dir, f"{stem}_{folder}_{key}.npy")
+
+
+def open_probabilities(npz_path, cache_dir=None, key="probabilities"):
+    """
+    Returns the probabilities of an nnU-Net .npz file as a read-only memory map of shape
+    (classes, *spatial). Compressed archives are decompressed (streamed, without loading the
+    array) into a temporary file that is unlinked once mapped, so its space is freed with the
+    memory map; with a cache_dir, the copy is kept there and reused while the .npz is unchanged.
+    """
+    with zipfile.ZipFile(npz_path) as archive:
+        info = archive.getinfo(_member_name(archive, key))
+        if info.compress_type == zipfile.ZIP_STORED:
+            return _memmap_stored_member(npz_path, info)
+
+        if cache_dir is None:
+            with tempfile.NamedTemporaryFile(suffix=".npy", delete=False) as dst, archive.open(info) as src:
+                shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+            try:
+                return np.load(dst.name, mmap_mode="r")
+            finally:
+                os.unlink(dst.name)
+
+        cache_file = cache_path_for(npz_path, cache_dir, key)
+        if not os.path.exists(cache_file) or os.path.getmtime(cache_file) < os.path.getmtime(npz_path):
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            with archive.open(info) as src, open(tmp_file, "wb") as dst:
+                shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+            os.replace(tmp_file, cache_file)
+
+    return np.load(cache_file, mmap_mode="r")
+
+
+def spatial_order(prob_shape, reference_shape):
+    """
+    Returns the axis order that maps the spatial axes of the probabilities onto a nibabel
+    reference image: (0, 1, 2) if they already match, (2, 1, 0) if they are reversed.
+    """
+    spatial = tuple(prob_shape[-3:])
+    reference = tuple(reference_shape[:3])
+    if spatial == reference:
+        return (0, 1, 2)
+    if spatial == reference[::-1]:
+        return (2, 1, 0)
+    raise ValueError(f"Probabilities of shape {spatial} do not match the reference image of shape {reference}.")
+
+
+def iter_slabs(length, slab_size):
+    """Yields slices covering range(length) in steps of slab_size."""
+    for start in range(0, length, slab_size):
+        yield slice(start, min(start + slab_size, length))
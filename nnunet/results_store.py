@@ -0,0 +1,207 @@
+"""
+Local SQLite store for volumes and evaluation metrics.
+
+Instead of scattered *_volume.csv / *_volumes.csv files and combined CSVs that are regenerated
+wholesale, results are kept as one row per (ICH ID, scan date, mask type, model/dataset ID) and
+quantity. Writers upsert in bulk, so re-processing 20 masks updates 20 rows; exports are filtered
+SQL queries, and joins across PH, edema and IVH classes are a pivot over the same table.
+
+USAGE:
+python results_store.py --store results.sqlite export --table volumes --mask_type PH edema --model_id 804 -o volumes.csv
+python results_store.py --store results.sqlite export --table volumes --wide -o volumes_wide.csv
+python results_store.py --store results.sqlite import-volumes --csv combined_ph_data.csv --mask_type PH --model_id 804
+"""
+
+import os
+import re
+import json
+import sqlite3
+import argparse
+import pandas as pd
+import tracing
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS volumes (
+    ich_id TEXT NOT NULL,
+    scan_date TEXT NOT NULL,
+    mask_type TEXT NOT NULL,
+    model_id TEXT NOT NULL,
+    voxels INTEGER,
+    volume_mm3 REAL,
+    volume_ml REAL,
+    source TEXT,
+    updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (ich_id, scan_date, mask_type, model_id)
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    ich_id TEXT NOT NULL,
+    scan_date TEXT NOT NULL,
+    mask_type TEXT NOT NULL,
+    model_id TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    source TEXT,
+    updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (ich_id, scan_date, mask_type, model_id, metric)
+);
+CREATE INDEX IF NOT EXISTS volumes_by_type ON volumes (mask_type, model_id);
+CREATE INDEX IF NOT EXISTS metrics_by_type ON metrics (mask_type, model_id, metric);
+"""
+
+KEY_COLUMNS = ["ich_id", "scan_date", "mask_type", "model_id"]
+VOLUME_COLUMNS = ["voxels", "volume_mm3", "volume_ml", "source"]
+METRIC_COLUMNS = ["metric", "value", "source"]
+
+
+def open_store(path):
+    """Opens (and creates if necessary) the results store."""
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def parse_case_id(filename, case_names=None):
+    """
+    Extracts ICH ID and scan date from a file name such as ICH00001_20190703_ct.nii.gz.
+    The scan date is empty if the name carries none (e.g. ICH00001_lesionmask.nii.gz).
+    nnU-Net case names are first mapped back to the original file via case_names
+    (see load_case_names); names without an ICH ID are kept as they are.
+    """
+    name = os.path.basename(str(filename))
+    for extension in (".nii.gz", ".csv"):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    if case_names:
+        name = case_names.get(name, name)
+
+    match = re.search(r"(ICH\d+)(?:_(\d{8}))?", name)
+    if match is None:
+        return name, ""
+    return match.group(1), match.group(2) or ""
+
+
+def load_case_names(conversion_dict, split="imagesTs"):
+    """
+    Maps the nnU-Net case names (e.g. ICH_Segmentation_PH_0001) of one split folder (imagesTr or
+    imagesTs) to the original file names. Both splits are numbered from _0001, so the same case
+    name stands for different scans in imagesTr and imagesTs.
+    """
+    with open(conversion_dict) as f:
+        conversion = json.load(f)
+    return {os.path.basename(nnunet_file).replace("_0000.nii.gz", ""): os.path.basename(original)
+            for original, nnunet_file in conversion.items()
+            if os.path.basename(os.path.dirname(nnunet_file)) == split}
+
+
+def _upsert(conn, table, columns, key_columns, rows):
+    placeholders = ", ".join("?" for _ in columns)
+    updates = ", ".join(f"{c} = excluded.{c}" for c in columns if c not in key_columns)
+    conn.executemany(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders}) "
+        f"ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {updates}, updated = CURRENT_TIMESTAMP",
+        [tuple(row.get(c) for c in columns) for row in rows])
+    conn.commit()
+
+
+def upsert_volumes(conn, rows):
+    """Bulk upsert of dicts with the key columns and voxels, volume_mm3, volume_ml, source."""
+    _upsert(conn, "volumes", KEY_COLUMNS + VOLUME_COLUMNS, KEY_COLUMNS, rows)
+
+
+def upsert_metrics(conn, rows):
+    """Bulk upsert of dicts with the key columns and metric, value, source."""
+    _upsert(conn, "metrics", KEY_COLUMNS + METRIC_COLUMNS, KEY_COLUMNS + ["metric"], rows)
+
+
+def per_case_metric_rows(table, model_id, mask_type=None, case_names=None, source=None):
+    """
+    Converts a per-case metric table (per_case_metrics.csv of the evaluation scripts) into
+    metric rows. The mask type is taken from a "region" column or given explicitly.
+    """
+    id_columns = [c for c in ("subject", "case", "region") if c in table.columns]
+    rows = []
+    for record in table.to_dict("records"):
+        ich_id, scan_date = parse_case_id(record["case"], case_names)
+        for metric in table.columns:
+            if metric in id_columns:
+                continue
+            rows.append({"ich_id": ich_id, "scan_date": scan_date, "mask_type": record.get("region", mask_type),
+                         "model_id": str(model_id), "metric": metric, "value": record[metric], "source": source})
+    return rows
+
+
+def query(conn, table, mask_types=None, model_ids=None, ich_ids=None, metrics=None):
+    """Filtered rows of a table as a DataFrame."""
+    clauses, params = [], []
+    for column, values in (("mask_type", mask_types), ("model_id", model_ids), ("ich_id", ich_ids),
+                           ("metric", metrics if table == "metrics" else None)):
+        if values:
+            clauses.append(f"{column} IN ({', '.join('?' for _ in values)})")
+            params.extend(values)
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    return pd.read_sql_query(f"SELECT * FROM {table}{where} ORDER BY ich_id, scan_date", conn, params=params)
+
+
+def wide_volumes(conn, value="volume_ml", **filters):
+    """One row per scan and model, one column per mask type (e.g. PH, edema and the IVH classes)."""
+    table = query(conn, "volumes", **filters)
+    return table.pivot_table(index=["ich_id", "scan_date", "model_id"], columns="mask_type", values=value).reset_index()
+
+
+def import_volume_csv(conn, csv_file, mask_type, model_id):
+    """Imports a table written by collect_ph.py/collect_edema.py or calculate_volumes_batch.py."""
+    table = pd.read_csv(csv_file)
+    prefix = next(c[:-len("_voxels")] for c in table.columns if c.endswith("_voxels"))
+    rows = []
+    for record in table.to_dict("records"):
+        ich_id, scan_date = parse_case_id(record["filename"])
+        volume_mm3 = record[f"{prefix}_volume_mm3"]
+        rows.append({"ich_id": ich_id, "scan_date": scan_date, "mask_type": mask_type, "model_id": str(model_id),
+                     "voxels": int(record[f"{prefix}_voxels"]), "volume_mm3": volume_mm3,
+                     "volume_ml": record.get(f"{prefix}_volume_ml", volume_mm3 / 1000.0), "source": record["filename"]})
+    upsert_volumes(conn, rows)
+    return len(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query and update the local volume/metrics results store.")
+    parser.add_argument("--store", required=True, type=str, help="Path to the SQLite results store.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Export (filtered) results to CSV.")
+    export_parser.add_argument("--table", choices=["volumes", "metrics"], default="volumes")
+    export_parser.add_argument("--mask_type", nargs="+", default=None, help="e.g. PH edema SV V3 V4")
+    export_parser.add_argument("--model_id", nargs="+", default=None, help="Model or dataset IDs, e.g. 804")
+    export_parser.add_argument("--ich_id", nargs="+", default=None, help="ICH IDs, e.g. ICH00001")
+    export_parser.add_argument("--metric", nargs="+", default=None, help="Metrics to export (metrics table only).")
+    export_parser.add_argument("--wide", action="store_true", help="One column per mask type (volumes only).")
+    export_parser.add_argument("-o", "--output", required=True, type=str, help="Output CSV file.")
+
+    import_parser = subparsers.add_parser("import-volumes", help="Import a combined volume CSV.")
+    import_parser.add_argument("--csv", required=True, type=str, help="Combined PH/edema volume CSV.")
+    import_parser.add_argument("--mask_type", required=True, type=str, help="Mask type of the CSV, e.g. PH.")
+    import_parser.add_argument("--model_id", required=True, type=str, help="Model or dataset ID.")
+
+    tracing.add_argument(parser)
+
+    args = parser.parse_args(argv)
+
+    tracing.enable(args.trace)
+    conn = open_store(args.store)
+
+    if args.command == "export":
+        filters = dict(mask_types=args.mask_type, model_ids=args.model_id, ich_ids=args.ich_id)
+        if args.wide:
+            table = wide_volumes(conn, **filters)
+        else:
+            table = query(conn, args.table, metrics=args.metric, **filters)
+        table.to_csv(args.output, index=False)
+        print(f"Exported {len(table)} rows to {args.output}")
+    else:
+        num_rows = import_volume_csv(conn, args.csv, args.mask_type, args.model_id)
+        print(f"Upserted {num_rows} rows into {args.store}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+"""
+Runs the processing pipeline declared in a TOML file (see ../ich_pipeline.toml), from the raw
+scans to volumes, metrics and figures.
+
+Every [[stage]] declares its inputs, outputs and commands. A stage with scope = "case" (the
+default) becomes one task per case, with {case} replaced by the case ID; a stage with
+scope = "cohort" is a single task (e.g. nnU-Net prediction of a whole folder, collecting the
+volumes). A task depends on every task whose outputs overlap its inputs (the same path, or one
+inside the other) and on the stages listed in `after`, which gives the per-case DAG.
+
+A task is skipped if it ran before with the same commands and the same input content (SHA-256,
+memoized by mtime and size, see metrics_cache.py) and its outputs are unchanged. So a new case
+only runs its own chain (and the cohort stages it feeds), and a changed mask only reruns what
+is downstream of it. Directory outputs are only checked for existence. With input_pattern
+(e.g. "*.nii.gz"), only the matching files of directory inputs are hashed, so files that other
+stages write next to them (e.g. *_volume.csv next to the predictions) do not cause reruns.
+
+Reading the pipeline file needs Python 3.11+ (tomllib) or the tomli package.
+
+Independent tasks run concurrently, as long as the sum of the `cpus` and `memory_gb` of the
+running tasks stays within the budget (--cpus, --memory_gb). The output of every task is
+written to <state_dir>/logs/<stage>/<case>.log; `cwd` and `env` of a stage set the working
+directory and extra environment variables of its commands. If a task fails, the tasks depending
+on it are not run; everything else continues.
+
+External tools can be replaced by stubs for testing, e.g. --stub "sct_image=cp {inputs[0]} {outputs[0]}"
+(or a [stubs] table in the pipeline file): every command starting with the tool runs the stub
+instead.
+
+USAGE:
+python run_pipeline.py --pipeline ../ich_pipeline.toml --set raw=/data/ICH/raw work=/data/ICH/work
+python run_pipeline.py --pipeline ../ich_pipeline.toml --cases ICH00117_20190502 --dry_run
+python run_pipeline.py --pipeline ../ich_pipeline.toml --force volumes --cpus 16 --memory_gb 64
+"""
+
+import os
+import re
+import sys
+import glob
+import json
+import shlex
+import hashlib
+import fnmatch
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from metrics_cache import open_cache, file_digest
+import tracing
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STAGE_DEFAULTS = {"scope": "case", "inputs": [], "outputs": [], "after": [], "cpus": 1, "memory_gb": 0.0,
+                  "cwd": None, "env": {}, "input_pattern": None}
+
+
+class Task:
+    """One stage of one case (case is None for cohort stages)."""
+
+    def __init__(self, stage, case, inputs, outputs, commands, cpus, memory_gb, fields, cwd=None, env=None,
+                 input_pattern=None):
+        self.stage = stage
+        self.case = case
+        self.inputs = inputs
+        self.outputs = outputs
+        self.commands = commands
+        self.cpus = cpus
+        self.memory_gb = memory_gb
+        self.fields = fields
+        self.cwd = cwd
+        self.env = env or {}
+        self.input_pattern = input_pattern
+        self.deps = set()
+
+    @property
+    def key(self):
+        return (self.stage, self.case or "")
+
+    @property
+    def name(self):
+        return f"{self.stage}[{self.case}]" if self.case else self.stage
+
+
+def load_pipeline(path, overrides=None):
+    """Pipeline definition with the [vars] resolved (later vars may use earlier ones) and overridden."""
+    with open(path, "rb") as f:
+        config = tomllib.load(f)
+
+    # commands are split with shlex, so the interpreter and ich.py are quoted (paths may contain spaces)
+    variables = {"repo": REPO_DIR, "python": shlex.quote(sys.executable),
+                 "ich": f"{shlex.quote(sys.executable)} {shlex.quote(os.path.join(REPO_DIR, 'ich.py'))}",
+                 "pipeline_dir": os.path.dirname(os.path.abspath(path))}
+    raw_vars = dict(config.get("vars", {}), **(overrides or {}))
+    for name, value in raw_vars.items():
+        variables[name] = str(value).format(**variables)
+    config["vars"] = variables
+
+    names = [stage["name"] for stage in config.get("stage", [])]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Stage names must be unique: {names}")
+    config["stage"] = [dict(STAGE_DEFAULTS, **stage) for stage in config.get("stage", [])]
+    for stage in config["stage"]:
+        if isinstance(stage.get("command"), str):
+            stage["commands"] = [stage.pop("command")]
+        if not stage.get("commands"):
+            raise ValueError(f"Stage {stage['name']} has no command.")
+        unknown = set(stage["after"]) - set(names)
+        if unknown:
+            raise ValueError(f"Stage {stage['name']} runs after unknown stages: {sorted(unknown)}")
+    return config
+
+
+def discover_cases(config):
+    """Case IDs: the first group of cases.pattern in the file names matched by cases.glob."""
+    cases = config.get("cases", {})
+    pattern = re.compile(cases.get("pattern", r"(.*)\.nii\.gz$"))
+    found = set()
+    for path in glob.glob(cases["glob"].format(**config["vars"]), recursive=True):
+        match = pattern.search(os.path.basename(path))
+        if match:
+            found.add(match.group(1))
+    return sorted(found)
+
+
+def overlaps(path_a, path_b):
+    """True if the paths are the same or one is inside the other."""
+    return path_a == path_b or path_a.startswith(path_b + os.sep) or path_b.startswith(path_a + os.sep)
+
+
+def build_tasks(config, cases):
+    """All tasks of the pipeline, keyed by (stage, case), with their dependencies."""
+    tasks = {}
+    for stage in config["stage"]:
+        for case in (cases if stage["scope"] == "case" else [None]):
+            fields = dict(config["vars"], case=case or "", cpus=stage["cpus"])
+            inputs = [os.path.abspath(p.format(**fields)) for p in stage["inputs"]]
+            outputs = [os.path.abspath(p.format(**fields)) for p in stage["outputs"]]
+            cwd = stage["cwd"] and os.path.abspath(stage["cwd"].format(**fields))
+            env = {name: str(value).format(**fields) for name, value in stage["env"].items()}
+            task = Task(stage["name"], case, inputs, outputs, stage["commands"], stage["cpus"], stage["memory_gb"],
+                        dict(fields, inputs=inputs, outputs=outputs), cwd, env, stage["input_pattern"])
+            tasks[task.key] = task
+
+    # case tasks only depend on tasks of the same case and on cohort tasks
+    after = {stage["name"]: set(stage["after"]) for stage in config["stage"]}
+    by_case = {}
+    for task in tasks.values():
+        by_case.setdefault(task.case, []).append(task)
+    for task in tasks.values():
+        candidates = list(tasks.values()) if task.case is None else by_case[task.case] + by_case.get(None, [])
+        for other in candidates:
+            if other is task:
+                continue
+            if other.stage in after[task.stage] or any(overlaps(i, o) for i in task.inputs for o in other.outputs):
+                task.deps.add(other.key)
+    return tasks
+
+
+def topological_order(tasks):
+    """Task keys in dependency order; raises ValueError on cycles."""
+    order, state = [], {}
+
+    def visit(key, path):
+        if state.get(key) == "done":
+            return
+        if state.get(key) == "visiting":
+            raise ValueError("Dependency cycle: " + " -> ".join(tasks[k].name for k in path + [key]))
+        state[key] = "visiting"
+        for dep in sorted(tasks[key].deps):
+            visit(dep, path + [key])
+        state[key] = "done"
+        order.append(key)
+
+    for key in tasks:
+        visit(key, [])
+    return order
+
+
+def resolve_commands(task, stubs):
+    """Argument lists of the commands of a task, with stubbed tools replaced."""
+    commands = []
+    for template in task.commands:
+        argv = shlex.split(template.format(**task.fields))
+        if argv and argv[0] in stubs:
+            argv = shlex.split(stubs[argv[0]].format(**task.fields))
+        commands.append(argv)
+    return commands
+
+
+def path_digest(conn, path, pattern=None):
+    """
+    Content hash of a file or (recursively) of a directory, None if it does not exist. With a
+    pattern, only the files of a directory whose names match it are hashed.
+    """
+    if os.path.isfile(path):
+        return file_digest(conn, path)
+    if not os.path.isdir(path):
+        return None
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if pattern and not fnmatch.fnmatch(name, pattern):
+                continue
+            file_path = os.path.join(root, name)
+            digest.update(f"{os.path.relpath(file_path, path)}:{file_digest(conn, file_path)}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def output_digests(conn, task):
+    return {path: "dir" if os.path.isdir(path) else path_digest(conn, path) for path in task.outputs}
+
+
+def task_fingerprint(conn, task, commands):
+    """Hash of what a task computes and from what; raises FileNotFoundError for missing inputs."""
+    digests = []
+    for path in task.inputs:
+        digest = path_digest(conn, path, task.input_pattern)
+        if digest is None:
+            raise FileNotFoundError(f"missing input {path}")
+        digests.append(digest)
+    return hashlib.sha256(json.dumps([commands, task.inputs, digests]).encode("utf-8")).hexdigest()
+
+
+def open_state(path):
+    conn = open_cache(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS tasks (stage TEXT, case_id TEXT, fingerprint TEXT, outputs TEXT, "
+                 "finished TIMESTAMP DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (stage, case_id))")
+    conn.commit()
+    return conn
+
+
+def is_up_to_date(conn, task, fingerprint):
+    row = conn.execute("SELECT fingerprint, outputs FROM tasks WHERE stage = ? AND case_id = ?", task.key).fetchone()
+    if row is None or row[0] != fingerprint:
+        return False
+    recorded = json.loads(row[1])
+    return all(os.path.exists(path) and recorded.get(path) == digest
+               for path, digest in output_digests(conn, task).items())
+
+
+def record_task(conn, task, fingerprint):
+    conn.execute("INSERT OR REPLACE INTO tasks (stage, case_id, fingerprint, outputs) VALUES (?, ?, ?, ?)",
+                 task.key + (fingerprint, json.dumps(output_digests(conn, task))))
+    conn.commit()
+
+
+def execute_task(task, commands, log_path):
+    """Runs the commands of a task one after another (in a worker thread). Returns an error or None."""
+    for path in task.outputs:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    if task.cwd:
+        os.makedirs(task.cwd, exist_ok=True)
+    env = dict(os.environ, ICH_PIPELINE_STAGE=task.stage, ICH_PIPELINE_CASE=task.case or "", **task.env)
+    with open(log_path, "w") as log, tracing.span(task.stage, "subprocess", case=task.case or ""):
+        for index, argv in enumerate(commands, 1):
+            print("$ " + shlex.join(argv), file=log, flush=True)
+            try:
+                returncode = subprocess.run(argv, stdout=log, stderr=subprocess.STDOUT, cwd=task.cwd, env=env).returncode
+            except OSError as e:
+                return f"command {index} ({argv[0]}): {e}"
+            if returncode != 0:
+                return f"command {index} exited with {returncode}, see {log_path}"
+    missing = [path for path in task.outputs if not os.path.exists(path)]
+    return f"outputs not written: {', '.join(missing)}" if missing else None
+
+
+def run_pipeline(config, cases, stubs=None, cpus=None, memory_gb=None, force=(), dry_run=False):
+    """
+    Runs (or with dry_run, lists) all tasks that are not up to date. Returns a dict task key ->
+    status ("ran", "skipped", "failed: <reason>", "blocked" or "would run").
+    """
+    settings = config.get("pipeline", {})
+    cpus = cpus or settings.get("cpus") or os.cpu_count()
+    memory_gb = memory_gb or settings.get("memory_gb") or \
+        os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 3
+    state_dir = os.path.abspath(settings.get("state_dir", "{work}/.pipeline").format(**config["vars"]))
+    stubs = dict(config.get("stubs", {}), **(stubs or {}))
+
+    tasks = build_tasks(config, cases)
+    order = topological_order(tasks)
+    conn = open_state(os.path.join(state_dir, "state.sqlite"))
+
+    status, running, pending = {}, {}, list(order)
+    used = {"cpus": 0, "memory_gb": 0.0}
+    with ThreadPoolExecutor(max_workers=max(1, int(cpus))) as pool:
+        while pending or running:
+            progress = True
+            while progress:
+                progress = False
+                for key in list(pending):
+                    task = tasks[key]
+                    dep_status = [status.get(dep) for dep in task.deps]
+                    if any(s is None or s == "running" for s in dep_status):
+                        continue
+                    if any(s == "blocked" or s.startswith("failed") for s in dep_status):
+                        status[key] = "blocked"
+                    elif dry_run and "would run" in dep_status:
+                        status[key] = "would run"
+                    else:
+                        commands = resolve_commands(task, stubs)
+                        try:
+                            fingerprint = task_fingerprint(conn, task, commands)
+                        except FileNotFoundError as e:
+                            status[key] = f"failed: {e}"
+                        else:
+                            if task.stage not in force and is_up_to_date(conn, task, fingerprint):
+                                status[key] = "skipped"
+                            elif dry_run:
+                                status[key] = "would run"
+                            elif running and (used["cpus"] + task.cpus > cpus or
+                                              used["memory_gb"] + task.memory_gb > memory_gb):
+                                continue  # wait until enough of the budget is free
+                            else:
+                                log_path = os.path.join(state_dir, "logs", task.stage, f"{task.case or 'cohort'}.log")
+                                running[pool.submit(execute_task, task, commands, log_path)] = (key, fingerprint)
+                                used["cpus"] += task.cpus
+                                used["memory_gb"] += task.memory_gb
+                                status[key] = "running"
+                                print(f"started  {task.name}")
+                    pending.remove(key)
+                    progress = True
+
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, fingerprint = running.pop(future)
+                    task = tasks[key]
+                    used["cpus"] -= task.cpus
+                    used["memory_gb"] -= task.memory_gb
+                    error = future.exception() or future.result()
+                    if error:
+                        status[key] = f"failed: {error}"
+                        print(f"FAILED   {task.name}: {error}")
+                    else:
+                        record_task(conn, task, fingerprint)
+                        status[key] = "ran"
+                        print(f"finished {task.name}")
+    return status
+
+
+def print_summary(status):
+    """Number of tasks per stage and status, plus the reasons of failures."""
+    counts = {}
+    for (stage, case), state in status.items():
+        counts.setdefault(stage, {}).setdefault(state.split(":")[0], 0)
+        counts[stage][state.split(":")[0]] += 1
+        if state.startswith("failed"):
+            print(f"{stage}[{case}] {state}" if case else f"{stage} {state}")
+    for stage, stage_counts in counts.items():
+        print(f"{stage:<24} " + ", ".join(f"{n} {state}" for state, n in sorted(stage_counts.items())))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the cached processing pipeline declared in a TOML file.")
+    parser.add_argument("--pipeline", required=True, type=str, help="Pipeline definition (TOML).")
+    parser.add_argument("--set", nargs="+", default=[], metavar="NAME=VALUE", help="Override [vars] of the pipeline.")
+    parser.add_argument("--cases", nargs="+", default=None, help="Only these case IDs (default: all discovered cases).")
+    parser.add_argument("--stub", nargs="+", default=[], metavar="TOOL=COMMAND",
+                        help="Replace an external tool by a command (same placeholders as the stage commands).")
+    parser.add_argument("--force", nargs="+", default=[], help="Rerun these stages even if they are up to date.")
+    parser.add_argument("--cpus", type=float, default=None, help="CPU budget (default: [pipeline] cpus or all CPUs).")
+    parser.add_argument("--memory_gb", type=float, default=None,
+                        help="Memory budget in GB (default: [pipeline] memory_gb or the physical memory).")
+    parser.add_argument("--dry_run", action="store_true", help="Only list the tasks that would run.")
+
+    tracing.add_argument(parser)
+
+    args = parser.parse_args(argv)
+    if tomllib is None:
+        parser.error("reading the pipeline file needs Python 3.11+ or the tomli package (pip install tomli).")
+
+    tracing.enable(args.trace)
+
+    config = load_pipeline(args.pipeline, dict(item.split("=", 1) for item in args.set))
+    cases = discover_cases(config)
+    if args.cases:
+        unknown = set(args.cases) - set(cases)
+        assert not unknown, f"Unknown cases: {sorted(unknown)}"
+        cases = args.cases
+    print(f"Found {len(cases)} cases.")
+
+    status = run_pipeline(config, cases, dict(item.split("=", 1) for item in args.stub), args.cpus, args.memory_gb,
+                          set(args.force), args.dry_run)
+    print_summary(status)
+    if any(state.startswith("failed") or state == "blocked" for state in status.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+Content-addressed store for source volumes shared by the nnU-Net datasets.
+
+Datasets 802-810 are built from largely the same CTs, and every Dataset{N}_* folder used to hold
+its own copy of each _0000.nii.gz. The store keeps every distinct file once, under its SHA-256:
+
+    <store>/objects/ab/ab12...ef.nii.gz     read-only blobs
+    <store>/store.sqlite                    file hashes (memoized by mtime/size) and links
+
+and dataset folders contain hardlinks (default) or symlinks to the blobs. Hardlinks need the
+store on the same filesystem as the datasets; otherwise symlinks are created. Blobs are
+read-only: tools that edit images in place (e.g. fslorient) must write to a copy.
+
+    ingest   replaces the files of existing folders (e.g. the whole nnUNet_raw tree) by links,
+             hashing them in parallel; files are moved into the store, not copied
+    gc       removes blobs that no dataset file links to anymore
+    report   logical vs. physical size of a tree, i.e. how much the deduplication saves, and
+             how much duplicate content is left (--hash)
+
+create_dataset*.py place the CTs through the store with --store <dir>.
+
+USAGE:
+python scan_store.py --store /media/raid3/scan_store ingest --input /path/to/nnUNet_raw --pattern "*_0000.nii.gz"
+python scan_store.py --store /media/raid3/scan_store gc --dry_run
+python scan_store.py --store /media/raid3/scan_store report --input /path/to/nnUNet_raw --hash
+"""
+
+import os
+import stat
+import errno
+import shutil
+import argparse
+import multiprocessing
+from pathlib import Path
+from metrics_cache import open_cache, file_digest, hash_file
+import tracing
+
+
+MODES = ["hardlink", "symlink"]
+
+
+def suffix(path):
+    """File extension including .nii.gz style double extensions."""
+    name = os.path.basename(path)
+    return name[name.index("."):] if "." in name else ""
+
+
+class ScanStore:
+    """A store directory with its SQLite index."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(os.path.join(self.root, "objects"), exist_ok=True)
+        self.conn = open_cache(os.path.join(self.root, "store.sqlite"))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS links (path TEXT PRIMARY KEY, blob TEXT)")
+        self.conn.commit()
+
+    def blob_path(self, digest, extension):
+        return os.path.join(self.root, "objects", digest[:2], digest + extension)
+
+    def blobs(self):
+        return sorted(str(p) for p in Path(self.root, "objects").glob("*/*") if not p.name.endswith(".tmp"))
+
+    def digests(self, paths, num_processes=None):
+        """SHA-256 of the files; files not hashed before (or changed since) are hashed in parallel."""
+        stale = []
+        for path in paths:
+            path = os.path.abspath(path)
+            st = os.stat(path)
+            row = self.conn.execute("SELECT mtime_ns, size FROM file_digests WHERE path = ?", (path,)).fetchone()
+            if row is None or row[0] != st.st_mtime_ns or row[1] != st.st_size:
+                stale.append(path)
+        if stale:
+            with tracing.span("hash", "io", files=len(stale)), multiprocessing.Pool(processes=num_processes) as pool:
+                hashes = pool.map(hash_file, stale)
+            self.conn.executemany("INSERT OR REPLACE INTO file_digests VALUES (?, ?, ?, ?)",
+                                  [(p, os.stat(p).st_mtime_ns, os.stat(p).st_size, h) for p, h in zip(stale, hashes)])
+            self.conn.commit()
+        return [file_digest(self.conn, path) for path in paths]
+
+    def add(self, source, digest, move=False):
+        """Blob of a file, created if necessary (by hardlinking the file if move, else by copying)."""
+        blob = self.blob_path(digest, suffix(source))
+        if os.path.exists(blob):
+            return blob
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        tmp = f"{blob}.{os.getpid()}.tmp"
+        try:
+            if not move:
+                raise OSError(errno.EXDEV, "copy requested")
+            os.link(source, tmp)
+        except OSError:
+            shutil.copyfile(source, tmp)
+        os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.replace(tmp, blob)
+        return blob
+
+    def link(self, blob, target, mode="hardlink"):
+        """Replaces target by a link to a blob. Returns the mode used."""
+        tmp = f"{target}.{os.getpid()}.tmp"
+        if mode == "hardlink":
+            try:
+                os.link(blob, tmp)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                mode = "symlink"  # other filesystem
+        if mode == "symlink":
+            os.symlink(blob, tmp)
+        os.replace(tmp, target)
+        self.conn.execute("INSERT OR REPLACE INTO links VALUES (?, ?)", (os.path.abspath(target), blob))
+        self.conn.commit()
+        return mode
+
+    def materialize(self, source, target, mode="hardlink"):
+        """Places a source file at target as a link into the store (the source is left untouched)."""
+        blob = self.add(source, self.digests([source])[0])
+        return self.link(blob, target, mode)
+
+    def is_linked(self, path, blob):
+        try:
+            return os.path.samefile(path, blob)
+        except OSError:
+            return False
+
+    def ingest(self, paths, mode="hardlink", num_processes=None):
+        """Replaces files by links into the store. Returns (number of files replaced, bytes freed)."""
+        paths = [os.path.abspath(p) for p in paths if not os.path.islink(p)]
+        replaced, freed = 0, 0
+        for path, digest in zip(paths, self.digests(paths, num_processes)):
+            blob = self.blob_path(digest, suffix(path))
+            if self.is_linked(path, blob):
+                continue
+            existed = os.path.exists(blob)
+            size = os.path.getsize(path)
+            self.link(self.add(path, digest, move=True), path, mode)
+            replaced += 1
+            freed += size if existed else 0
+        return replaced, freed
+
+    def gc(self, dry_run=False):
+        """Removes blobs no file links to anymore. Returns (number of blobs, bytes) removed."""
+        referenced = set()
+        for path, blob in self.conn.execute("SELECT path, blob FROM links").fetchall():
+            if self.is_linked(path, blob):
+                referenced.add(blob)
+            elif not dry_run:
+                self.conn.execute("DELETE FROM links WHERE path = ?", (path,))
+        self.conn.commit()
+
+        removed, freed = 0, 0
+        for blob in self.blobs():
+            # a hardlink count above one also covers links that were not recorded (e.g. copied trees)
+            if blob in referenced or os.stat(blob).st_nlink > 1:
+                continue
+            removed += 1
+            freed += os.path.getsize(blob)
+            if not dry_run:
+                os.remove(blob)
+        return removed, freed
+
+
+def place(source, target, store=None, mode="hardlink"):
+    """Copies a file into a dataset folder, or links it through the store if one is given."""
+    if store is None:
+        shutil.copyfile(source, target)
+    else:
+        store.materialize(source, target, mode)
+
+
+def tree_usage(root, pattern="*.nii.gz", store=None, num_processes=None):
+    """
+    Size of the files of a tree per top-level folder: logical (what copies would take), physical
+    (distinct inodes, following symlinks) and, with a store, the size of distinct contents.
+    """
+    files = sorted(p for p in Path(root).rglob(pattern) if p.is_file())
+    digests = store.digests([str(p) for p in files], num_processes) if store is not None else [None] * len(files)
+    rows, seen_inodes, seen_digests = {}, set(), set()
+    for path, digest in zip(files, digests):
+        st = os.stat(path)
+        folder = path.relative_to(root).parts[0] if len(path.relative_to(root).parts) > 1 else "."
+        row = rows.setdefault(folder, {"folder": folder, "files": 0, "logical": 0, "physical": 0, "unique_content": 0})
+        row["files"] += 1
+        row["logical"] += st.st_size
+        if (st.st_dev, st.st_ino) not in seen_inodes:
+            seen_inodes.add((st.st_dev, st.st_ino))
+            row["physical"] += st.st_size
+        if digest is not None and digest not in seen_digests:
+            seen_digests.add(digest)
+            row["unique_content"] += st.st_size
+    return list(rows.values())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Content-addressed store of source volumes.")
+    parser.add_argument("--store", required=True, type=str, help="Store directory.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="Replace the files of folders by links into the store.")
+    ingest_parser.add_argument("--input", required=True, nargs="+", help="Folders (searched recursively).")
+    ingest_parser.add_argument("--pattern", default="*_0000.nii.gz", help="Files to deduplicate.")
+    ingest_parser.add_argument("--mode", choices=MODES, default="hardlink", help="Link type.")
+    ingest_parser.add_argument("--num_processes", type=int, default=os.cpu_count(), help="Hashing processes.")
+
+    gc_parser = subparsers.add_parser("gc", help="Remove blobs that are not linked anymore.")
+    gc_parser.add_argument("--dry_run", action="store_true", help="Only report what would be removed.")
+
+    report_parser = subparsers.add_parser("report", help="Disk usage of a tree with and without deduplication.")
+    report_parser.add_argument("--input", required=True, help="Tree to report on, e.g. nnUNet_raw.")
+    report_parser.add_argument("--pattern", default="*.nii.gz", help="Files to count.")
+    report_parser.add_argument("--hash", action="store_true", help="Also hash the files to find remaining duplicates.")
+    report_parser.add_argument("--num_processes", type=int, default=os.cpu_count(), help="Hashing processes.")
+
+    tracing.add_argument(parser)
+
+    args = parser.parse_args(argv)
+
+    tracing.enable(args.trace)
+    store = ScanStore(args.store)
+
+    if args.command == "ingest":
+        paths = [str(p) for folder in args.input for p in sorted(Path(folder).rglob(args.pattern)) if p.is_file()]
+        print(f"Found {len(paths)} files. Ingesting...")
+        replaced, freed = store.ingest(paths, args.mode, args.num_processes)
+        print(f"Linked {replaced} files into {args.store}, {freed / 1024 ** 3:.2f} GB freed")
+    elif args.command == "gc":
+        removed, freed = store.gc(args.dry_run)
+        print(f"{'Would remove' if args.dry_run else 'Removed'} {removed} blobs ({freed / 1024 ** 3:.2f} GB)")
+    else:
+        rows = tree_usage(args.input, args.pattern, store if args.hash else None, args.num_processes)
+        gb = 1024 ** 3
+        print(f"{'folder':<40} {'files':>7} {'logical GB':>11} {'physical GB':>12}" +
+              (f" {'unique GB':>10}" if args.hash else ""))
+        for row in rows + [{"folder": "total", **{k: sum(r[k] for r in rows)
+                                                  for k in ("files", "logical", "physical", "unique_content")}}]:
+            print(f"{row['folder']:<40} {row['files']:>7} {row['logical'] / gb:>11.2f} {row['physical'] / gb:>12.2f}" +
+                  (f" {row['unique_content'] / gb:>10.2f}" if args.hash else ""))
+        total = rows and sum(r["logical"] for r in rows)
+        if total:
+            physical = sum(r["physical"] for r in rows)
+            print(f"Deduplication saves {(total - physical) / gb:.2f} GB ({100 * (total - physical) / total:.1f}%)")
+            if args.hash:
+                unique = sum(r["unique_content"] for r in rows)
+                print(f"Duplicate content not yet deduplicated: {(physical - unique) / gb:.2f} GB "
+                      f"({100 * (physical - unique) / total:.1f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,54 +1,108 @@
 import os
 import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import nibabel as nib
 import numpy as np
 import glob
+from scipy import ndimage
+from compute_multi_class_metrics import load_label_definitions
+from nifti_io import load_image
+import tracing
 
 
-def separate_masks(combined_img):
-    """
-    Separates a combined lesion mask into binary masks for each label.
-    Assumes labels: SV=1, V3=2, V4=3.
-    """
-    combined_data = combined_img.get_fdata()
+DEFAULT_LABELS = {"SV": 1, "V3": 2, "V4": 3}
 
-    # Create binary masks
-    sv_mask = (combined_data == 1).astype(np.uint8)  # Binary mask for SV
-    v3_mask = (combined_data == 2).astype(np.uint8)  # Binary mask for V3
-    v4_mask = (combined_data == 3).astype(np.uint8)  # Binary mask for V4
 
-    sv_img = nib.Nifti1Image(sv_mask, combined_img.affine, combined_img.header)
-    v3_img = nib.Nifti1Image(v3_mask, combined_img.affine, combined_img.header)
-    v4_img = nib.Nifti1Image(v4_mask, combined_img.affine, combined_img.header)
+def load_labels(dataset_json=None):
+    """
+    Labels to split off: the single (non-region) classes of a dataset.json without the
+    background, or SV=1, V3=2, V4=3.
+    """
+    if dataset_json is None:
+        return dict(DEFAULT_LABELS)
+    classes, _ = load_label_definitions(dataset_json)
+    return {name: value for name, value in classes.items() if value != 0}
 
-    return sv_img, v3_img, v4_img
 
+def separate_masks(combined_img, labels=DEFAULT_LABELS, crop=False):
+    """
+    Separates a combined lesion mask into binary uint8 masks for each label.
 
-def process_mask(file_path, output_dir):
+    The label map is read once in its stored dtype; a single find_objects pass gives the
+    bounding box of every label, and each binary mask is only computed inside its box.
+    With crop=True the masks are cropped to that box (affine shifted accordingly),
+    otherwise they have the full size of the input. Labels that are absent give an empty
+    full-size mask (or None when cropping).
+    """
+    combined_data = np.asanyarray(combined_img.dataobj)
+    if not np.issubdtype(combined_data.dtype, np.integer):
+        combined_data = np.rint(combined_data).astype(np.int32)
+
+    boxes = ndimage.find_objects(np.clip(combined_data, 0, None))
+
+    header = combined_img.header.copy()
+    header.set_data_dtype(np.uint8)
+    header.set_slope_inter(1, 0)
+
+    images = {}
+    for name, value in labels.items():
+        box = boxes[value - 1] if 0 < value <= len(boxes) else None
+        if box is None:
+            images[name] = None if crop else nib.Nifti1Image(
+                np.zeros(combined_data.shape, dtype=np.uint8), combined_img.affine, header)
+            continue
+
+        binary = (combined_data[box] == value).astype(np.uint8)
+        if crop:
+            start = np.array([s.start for s in box])
+            affine = combined_img.affine.copy()
+            affine[:3, 3] = combined_img.affine[:3, :3] @ start + combined_img.affine[:3, 3]
+            images[name] = nib.Nifti1Image(binary, affine, header)
+        else:
+            full = np.zeros(combined_data.shape, dtype=np.uint8)
+            full[box] = binary
+            images[name] = nib.Nifti1Image(full, combined_img.affine, header)
+
+    return images
+
+
+def process_mask(file_path, output_dir, labels=DEFAULT_LABELS, crop=False, num_threads=None):
     """
     Processes a single mask file to separate it into binary masks.
+    The compressed writes of the masks run concurrently (zlib releases the GIL).
     """
-    # Load the combined mask
-    combined_img = nib.load(file_path)
+    case = os.path.basename(file_path)
+    combined_img = load_image(file_path)
+    with tracing.span("split", "compute", file=case):
+        images = separate_masks(combined_img, labels, crop)
+
+    base_name = os.path.basename(file_path)
+    for extension in (".nii.gz", ".nii"):
+        if base_name.endswith(extension):
+            base_name = base_name[:-len(extension)]
+            break
 
-    # Separate into individual binary masks
-    sv_img, v3_img, v4_img = separate_masks(combined_img)
+    outputs = {os.path.join(output_dir, f"{base_name}_{name.lower()}.nii.gz"): img
+               for name, img in images.items() if img is not None}
+    with tracing.span("write", "io", file=case), ThreadPoolExecutor(max_workers=num_threads or len(outputs) or 1) as executor:
+        list(executor.map(lambda item: nib.save(item[1], item[0]), outputs.items()))
 
-    # Generate output filenames
-    base_name = os.path.splitext(os.path.basename(file_path))[0]  # Strip extension
-    sv_filename = os.path.join(output_dir, f"{base_name}_sv.nii.gz")
-    v3_filename = os.path.join(output_dir, f"{base_name}_v3.nii.gz")
-    v4_filename = os.path.join(output_dir, f"{base_name}_v4.nii.gz")
+    print(f"Saved: {', '.join(outputs)}")
+    return list(outputs)
 
-    # Save the separated binary masks
-    nib.save(sv_img, sv_filename)
-    nib.save(v3_img, v3_filename)
-    nib.save(v4_img, v4_filename)
 
-    print(f"Saved: {sv_filename}, {v3_filename}, {v4_filename}")
+def safe_process_mask(file_path, output_dir, labels, crop):
+    """Like process_mask, but reports the error instead of stopping the whole batch."""
+    try:
+        with tracing.span("case", "case", file=os.path.basename(file_path)):
+            return process_mask(file_path, output_dir, labels, crop)
+    except Exception as e:
+        print(f"Error: {file_path}: {e}")
+        return []
 
 
-def main(input_dir, output_dir):
+def separate_folder(input_dir, output_dir, labels=DEFAULT_LABELS, crop=False, num_processes=None):
     # Get all .nii.gz files in the input directory
     mask_files = sorted(glob.glob(os.path.join(input_dir, "*.nii.gz")))
 
@@ -56,18 +110,31 @@ def main(input_dir, output_dir):
         print("No .nii.gz files found in the input directory.")
         return
 
-    for mask_file in mask_files:
-        process_mask(mask_file, output_dir)
+    with multiprocessing.Pool(processes=num_processes) as pool:
+        pool.starmap(safe_process_mask, [(mask_file, output_dir, labels, crop) for mask_file in mask_files])
 
 
-if __name__ == "__main__":
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Separate any combined lesion mask into binary masks.")
     parser.add_argument("--input", required=True, help="Directory containing combined lesion masks.")
     parser.add_argument("--output", required=True, help="Output directory for separated binary masks.")
-    
-    args = parser.parse_args()
+    parser.add_argument("--dataset_json", default=None,
+                        help="dataset.json providing the labels to split (default: SV=1, V3=2, V4=3).")
+    parser.add_argument("--crop", action="store_true",
+                        help="Crop every binary mask to the bounding box of its label (empty labels are skipped).")
+    parser.add_argument("--num_processes", type=int, default=os.cpu_count(), help="Number of files in parallel.")
+
+    tracing.add_argument(parser)
+
+    args = parser.parse_args(argv)
+
+    tracing.enable(args.trace)
 
     # Ensure output directory exists
     os.makedirs(args.output, exist_ok=True)
 
-    main(args.input, args.output)
+    separate_folder(args.input, args.output, load_labels(args.dataset_json), args.crop, args.num_processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Synthetic head-CT-like cohorts for benchmarks and smoke tests (no patient data).
+
+Every case is an ellipsoidal head (air, skull, brain parenchyma with noise) with lateral, third
+and fourth ventricles and a configurable number of ellipsoidal hyperdense lesions (PH) with a
+hypodense rim (edema). The cohort is written in the layouts the scripts of this folder expect:
+
+    <output>/images/ICH00001_20200101_ct.nii.gz             CT (HU, dtype configurable)
+    <output>/labels/ICH00001_lesionmask.nii.gz              PH mask        (create_dataset.py)
+    <output>/labels_edema/ICH00001_edemamask.nii.gz         edema mask
+    <output>/labels_ivh/IVH_SV/ICH00001_seg-SV.nii.gz       ventricle masks (create_dataset_multi_class.py)
+    <output>/labels_ivh/IVH_V3/ICH00001_seg-V3.nii.gz
+    <output>/labels_ivh/IVH_V4/ICH00001_seg-V4.nii.gz
+    <output>/labels_combined/ICH00001_20200101_seg.nii.gz   SV=1, V3=2, V4=3 label map
+    <output>/images_multi_class/ICH00001_ct.nii.gz          CT named as in the multi-class splits
+    <output>/split.json                                     train/test split of create_dataset.py
+    <output>/split_multi_class.json                         train/test split of create_dataset_multi_class.py
+
+USAGE:
+python synthetic_data.py --output /tmp/ich_synthetic --n_cases 20 --shape 256 256 48 --spacing 0.9 0.9 4.0 --n_lesions 2
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+import nibabel as nib
+
+
+DTYPES = ["int16", "uint16", "float32"]
+
+# ventricles as (label, center in mm relative to the head center, radii in mm); x = left-right,
+# y = posterior-anterior, z = inferior-superior
+VENTRICLES = [
+    (1, (-12.0, 5.0, 15.0), (6.0, 25.0, 10.0)),    # SV, left lateral ventricle
+    (1, (12.0, 5.0, 15.0), (6.0, 25.0, 10.0)),     # SV, right lateral ventricle
+    (2, (0.0, -5.0, 0.0), (2.0, 10.0, 8.0)),       # V3
+    (3, (0.0, -35.0, -30.0), (6.0, 5.0, 6.0)),     # V4
+]
+BRAIN_RADII = (65.0, 85.0, 70.0)
+SKULL_THICKNESS = 6.0
+
+
+def affine_for(shape, spacing):
+    """RAS affine with the given spacing and the origin in the center of the volume."""
+    affine = np.diag(list(spacing) + [1.0])
+    affine[:3, 3] = -(np.array(shape) - 1) / 2.0 * np.array(spacing)
+    return affine
+
+
+def ellipsoid(shape, spacing, center_mm, radii_mm):
+    """Boolean ellipsoid, center given in mm relative to the center of the volume."""
+    axes = [(np.arange(n) - (n - 1) / 2.0) * s - c for n, s, c in zip(shape, spacing, center_mm)]
+    x, y, z = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    distance = ((axes[0][x] / radii_mm[0]) ** 2 + (axes[1][y] / radii_mm[1]) ** 2 + (axes[2][z] / radii_mm[2]) ** 2)
+    return distance <= 1.0
+
+
+def synthetic_case(shape=(256, 256, 48), spacing=(0.9, 0.9, 4.0), n_lesions=2, lesion_radius_mm=12.0, rng=None):
+    """
+    Returns the CT in HU (float32), the PH mask, the edema mask and the ventricle label map
+    (SV=1, V3=2, V4=3) of one synthetic case.
+    """
+    rng = np.random.default_rng(rng)
+    head = ellipsoid(shape, spacing, (0, 0, 0), [r + SKULL_THICKNESS for r in BRAIN_RADII])
+    brain = ellipsoid(shape, spacing, (0, 0, 0), BRAIN_RADII)
+
+    ct = np.full(shape, -1024.0, dtype=np.float32)
+    ct[head] = 1000.0
+    ct[brain] = 35.0
+
+    ventricles = np.zeros(shape, dtype=np.uint8)
+    for label, center, radii in VENTRICLES:
+        ventricles[ellipsoid(shape, spacing, center, radii) & brain] = label
+    ct[ventricles > 0] = 5.0
+
+    lesions = np.zeros(shape, dtype=bool)
+    edema = np.zeros(shape, dtype=bool)
+    for _ in range(n_lesions):
+        radii = lesion_radius_mm * rng.uniform(0.5, 1.5, size=3)
+        # centers well inside the brain
+        center = rng.uniform(-0.6, 0.6, size=3) * np.array(BRAIN_RADII)
+        lesion = ellipsoid(shape, spacing, center, radii) & brain & (ventricles == 0)
+        rim = ellipsoid(shape, spacing, center, radii * 1.5) & brain & (ventricles == 0) & ~lesion
+        lesions |= lesion
+        edema |= rim
+    edema &= ~lesions
+    ct[edema] = 20.0
+    ct[lesions] = 65.0
+
+    ct[head] += rng.normal(0.0, 5.0, size=int(head.sum())).astype(np.float32)
+    return ct, lesions.astype(np.uint8), edema.astype(np.uint8), ventricles
+
+
+def ct_image(ct, affine, dtype):
+    """
+    CT image with the given stored dtype. uint16 cannot hold negative HU, so nibabel stores it
+    with a slope/intercept in the header (as many scanners do). HU are whole numbers in every
+    dtype, as in reconstructed CTs, so float32 CTs can be cast to int16 by compact_ct.py.
+    """
+    ct = np.rint(ct)
+    if dtype == "int16":
+        return nib.Nifti1Image(np.clip(ct, -1024, 32767).astype(np.int16), affine)
+    img = nib.Nifti1Image(ct if dtype == "uint16" else ct.astype(np.float32), affine)
+    img.set_data_dtype(np.dtype(dtype))
+    return img
+
+
+def write_cohort(output_dir, n_cases=10, shape=(256, 256, 48), spacing=(0.9, 0.9, 4.0), dtype="int16",
+                 n_lesions=2, lesion_radius_mm=12.0, test_fraction=0.2, seed=0):
+    """Writes a synthetic cohort in the layouts described above and returns the case IDs."""
+    rng = np.random.default_rng(seed)
+    folders = {name: os.path.join(output_dir, *name.split("/")) for name in
+               ("images", "images_multi_class", "labels", "labels_edema", "labels_combined",
+                "labels_ivh/IVH_SV", "labels_ivh/IVH_V3", "labels_ivh/IVH_V4")}
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+
+    affine = affine_for(shape, spacing)
+    cases = []
+    for index in range(1, n_cases + 1):
+        ich_id = f"ICH{index:05d}"
+        scan_date = f"2020{(index % 12) + 1:02d}{(index % 28) + 1:02d}"
+        ct, lesions, edema, ventricles = synthetic_case(shape, spacing, n_lesions, lesion_radius_mm, rng)
+
+        ct_img = ct_image(ct, affine, dtype)
+        nib.save(ct_img, os.path.join(folders["images"], f"{ich_id}_{scan_date}_ct.nii.gz"))
+        nib.save(ct_img, os.path.join(folders["images_multi_class"], f"{ich_id}_ct.nii.gz"))
+
+        def save_mask(mask, folder, filename):
+            nib.save(nib.Nifti1Image(mask, affine), os.path.join(folders[folder], filename))
+
+        save_mask(lesions, "labels", f"{ich_id}_lesionmask.nii.gz")
+        save_mask(edema, "labels_edema", f"{ich_id}_edemamask.nii.gz")
+        save_mask(ventricles, "labels_combined", f"{ich_id}_{scan_date}_seg.nii.gz")
+        for label, name in ((1, "SV"), (2, "V3"), (3, "V4")):
+            save_mask((ventricles == label).astype(np.uint8), f"labels_ivh/IVH_{name}", f"{ich_id}_seg-{name}.nii.gz")
+        cases.append((ich_id, scan_date))
+
+    n_test = int(round(n_cases * test_fraction))
+    test_ids = {ich_id for ich_id, _ in cases[len(cases) - n_test:]}
+    split = {"train": [f"{i}_{d}_ct.nii.gz" for i, d in cases if i not in test_ids],
+             "test": [f"{i}_{d}_ct.nii.gz" for i, d in cases if i in test_ids]}
+    split_multi_class = {"train": [f"{i}_ct_0000.nii.gz" for i, _ in cases if i not in test_ids],
+                         "test": [f"{i}_ct_0000.nii.gz" for i, _ in cases if i in test_ids]}
+    with open(os.path.join(output_dir, "split.json"), "w") as f:
+        json.dump(split, f, indent=4)
+    with open(os.path.join(output_dir, "split_multi_class.json"), "w") as f:
+        json.dump(split_multi_class, f, indent=4)
+    return [ich_id for ich_id, _ in cases]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic head CT / lesion cohort.")
+    parser.add_argument("--output", required=True, type=str, help="Output folder of the cohort.")
+    parser.add_argument("--n_cases", type=int, default=10, help="Number of cases.")
+    parser.add_argument("--shape", type=int, nargs=3, default=[256, 256, 48], help="Volume shape in voxels.")
+    parser.add_argument("--spacing", type=float, nargs=3, default=[0.9, 0.9, 4.0], help="Voxel spacing in mm.")
+    parser.add_argument("--dtype", choices=DTYPES, default="int16", help="Stored dtype of the CT.")
+    parser.add_argument("--n_lesions", type=int, default=2, help="Number of lesions per case.")
+    parser.add_argument("--lesion_radius_mm", type=float, default=12.0, help="Mean lesion radius in mm.")
+    parser.add_argument("--test_fraction", type=float, default=0.2, help="Fraction of cases in the test split.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    args = parser.parse_args(argv)
+
+    cases = write_cohort(args.output, args.n_cases, tuple(args.shape), tuple(args.spacing), args.dtype,
+                         args.n_lesions, args.lesion_radius_mm, args.test_fraction, args.seed)
+    print(f"Wrote {len(cases)} synthetic cases to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
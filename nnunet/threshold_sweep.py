@@ -0,0 +1,132 @@
+"""
+This script evaluates a full probability-threshold curve directly from the nnU-Net softmax
+outputs (.npz files written with --npz / --save_probabilities).
+
+For every case, the predicted probabilities of the evaluated label are binned and one bincount
+yields two histograms: of the probabilities of GT foreground voxels and of GT background
+voxels. Since a voxel is predicted positive at threshold t if its probability is >= t, the true
+and false positives at every threshold are the reverse cumulative sums of these histograms.
+Dice, sensitivity, PPV and the volume error at all thresholds therefore cost about as much as a
+single fixed-threshold evaluation. The probability arrays are memory-mapped and processed slab
+by slab (see probabilities.py).
+
+Note: nnU-Net itself predicts the argmax, which for a binary task equals a threshold of 0.5.
+
+USAGE:
+python threshold_sweep.py --pred_folder <folder_with_npz> --gt_folder <path_to_labelsTs> --label 1 -o <output_folder>
+"""
+
+import os
+import argparse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from nifti_io import load_data, load_header
+from probabilities import open_probabilities, spatial_order, iter_slabs
+import tracing
+
+
+def class_histograms(prob, gt, label, n_bins, slab_size=16):
+    """
+    Computes the histograms of the probabilities of the given label for GT background (row 0)
+    and GT foreground (row 1) voxels in one pass over the memory-mapped probabilities.
+    prob: (classes, *spatial) array, gt: label map already in the spatial order of prob.
+    """
+    counts = np.zeros(2 * n_bins, dtype=np.int64)
+    for slab in iter_slabs(gt.shape[0], slab_size):
+        p = np.asarray(prob[label, slab], dtype=np.float32)
+        bins = np.minimum((p * n_bins).astype(np.int32), n_bins - 1)
+        bins += n_bins * (gt[slab] == label)
+        counts += np.bincount(bins.ravel(), minlength=2 * n_bins)
+    return counts.reshape(2, n_bins)
+
+
+def threshold_curve(histograms, voxel_volume_mm3, n_bins):
+    """Derives the metrics at the thresholds k / n_bins from the class-conditional histograms."""
+    # voxels with probability >= k / n_bins, i.e. reverse cumulative sums over the bins
+    fp = np.cumsum(histograms[0, ::-1])[::-1].astype(np.float64)
+    tp = np.cumsum(histograms[1, ::-1])[::-1].astype(np.float64)
+    gt_pos = histograms[1].sum()
+    fn = gt_pos - tp
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        curve = pd.DataFrame({
+            "threshold": np.arange(n_bins) / n_bins,
+            "Dice": 2 * tp / (2 * tp + fp + fn),
+            "Sensitivity": tp / gt_pos,
+            "PPV": tp / (tp + fp),
+            "VolumeError_mL": (tp + fp - gt_pos) * voxel_volume_mm3 / 1000.0,
+            "RelativeVolumeError": 100.0 * (tp + fp - gt_pos) / gt_pos,
+        })
+    return curve
+
+
+def case_histograms(npz_file, gt_file, label, n_bins, cache_dir=None):
+    """Loads one case (probabilities memory-mapped) and returns its histograms and voxel volume."""
+    gt_img, gt = load_header(gt_file), load_data(gt_file)
+    with tracing.span("load", "io", file=os.path.basename(npz_file)):
+        prob = open_probabilities(npz_file, cache_dir)
+
+    # bring the GT into the axis order of the probabilities, so we can slab along the contiguous axis
+    gt = gt.transpose(spatial_order(prob.shape, gt.shape))
+    with tracing.span("histograms", "compute", file=os.path.basename(npz_file)):
+        histograms = class_histograms(prob, gt, label, n_bins)
+    return histograms, float(np.prod(gt_img.header.get_zooms()[:3]))
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Threshold sweep over nnU-Net softmax outputs.')
+    parser.add_argument('--pred_folder', required=True, type=str, help='Folder containing the nnU-Net .npz files.')
+    parser.add_argument('--gt_folder', required=True, type=str, help='Folder containing nifti images of GT labels.')
+    parser.add_argument('--label', type=int, default=1, help='Label (softmax channel) to evaluate.')
+    parser.add_argument('--n_bins', type=int, default=100, help='Number of thresholds between 0 and 1.')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Keep the uncompressed probabilities in this folder for later runs '
+                             '(default: temporary files, deleted after each case).')
+    parser.add_argument('-o', '--output_folder', required=True, type=str, help='Path to the output folder.')
+
+    tracing.add_argument(parser)
+
+    args = parser.parse_args(argv)
+
+    tracing.enable(args.trace)
+
+    npz_files = sorted(Path(args.pred_folder).glob("*.npz"))
+    assert npz_files, f'No .npz files found in {args.pred_folder}. Did you predict with --save_probabilities?'
+
+    curves = []
+    pooled = np.zeros((2, args.n_bins), dtype=np.int64)
+    for npz_file in npz_files:
+        case = npz_file.name[:-len(".npz")]
+        gt_file = os.path.join(args.gt_folder, f"{case}.nii.gz")
+        assert os.path.isfile(gt_file), f'No GT found for {case}.'
+
+        histograms, voxel_volume = case_histograms(npz_file, gt_file, args.label, args.n_bins, args.cache_dir)
+        pooled += histograms
+
+        curve = threshold_curve(histograms, voxel_volume, args.n_bins)
+        curve.insert(0, "case", case)
+        curves.append(curve)
+        print(f"{case}: done")
+
+    per_case = pd.concat(curves, ignore_index=True)
+    mean_curve = per_case.drop(columns="case").groupby("threshold").mean().reset_index()
+    # voxel counts of cases with different spacings are pooled, so only relative volumes are meaningful
+    pooled_curve = threshold_curve(pooled, 1.0, args.n_bins).drop(columns="VolumeError_mL")
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    per_case.to_csv(os.path.join(args.output_folder, "threshold_curves_per_case.csv"), index=False)
+    mean_curve.to_csv(os.path.join(args.output_folder, "threshold_curve_mean.csv"), index=False)
+    pooled_curve.to_csv(os.path.join(args.output_folder, "threshold_curve_pooled.csv"), index=False)
+
+    best = mean_curve.loc[mean_curve["Dice"].idxmax()]
+    default = mean_curve.loc[(mean_curve["threshold"] - 0.5).abs().idxmin()]
+    print(f"Best threshold (mean Dice): {best['threshold']:.3f} -> Dice {best['Dice']:.4f}, "
+          f"Sensitivity {best['Sensitivity']:.4f}, PPV {best['PPV']:.4f}")
+    print(f"Threshold 0.5 (argmax):      Dice {default['Dice']:.4f}, "
+          f"Sensitivity {default['Sensitivity']:.4f}, PPV {default['PPV']:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Lightweight per-stage tracing for the command line scripts.
+
+Scripts enable it with --trace out.json (tracing.add_argument / tracing.enable). Code marks its
+stages with
+
+    with span("load", "io", file=path):
+        ...
+
+where the category is one of "case", "io" (load/decompress, compress/write), "compute" and
+"subprocess". Every span records its wall time, the bytes read and written by the process
+(/proc/self/io) and the peak RSS of the process. When tracing is off, span() costs one
+attribute lookup.
+
+Each process (including pool workers, which inherit the setting through the ICH_TRACE
+environment variable) appends its spans to <out.json>.parts/<pid>.jsonl. When the main process
+exits, the parts are merged into one Chrome trace (open out.json in chrome://tracing or
+https://ui.perfetto.dev) and a summary table per stage is written to out_summary.csv and printed.
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+ENV_VARIABLE = "ICH_TRACE"
+
+_state = {"path": os.environ.get(ENV_VARIABLE), "file": None, "pid": None}
+_lock = threading.Lock()
+
+
+def add_argument(parser):
+    parser.add_argument("--trace", type=str, default=None,
+                        help="Write a Chrome trace (JSON) and a summary of the per-case stages to this file.")
+
+
+def enable(path):
+    """Enables tracing for this process and its workers; the trace is merged at exit."""
+    if not path:
+        return
+    path = os.path.abspath(path)
+    parts = Path(parts_dir(path))
+    parts.mkdir(parents=True, exist_ok=True)
+    for part in parts.glob("*.jsonl"):
+        part.unlink()
+    _state["path"] = path
+    os.environ[ENV_VARIABLE] = path
+    main_pid = os.getpid()
+    atexit.register(lambda: os.getpid() == main_pid and finish())
+
+
+def enabled():
+    return _state["path"] is not None
+
+
+def parts_dir(path):
+    return path + ".parts"
+
+
+def io_counters():
+    """(bytes read, bytes written) by this process from storage, or (0, 0) if unknown."""
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def peak_rss_mb():
+    if resource is None:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # KB on Linux
+
+
+def _write(event):
+    with _lock:
+        if _state["pid"] != os.getpid():
+            _state["file"] = open(os.path.join(parts_dir(_state["path"]), f"{os.getpid()}.jsonl"), "a")
+            _state["pid"] = os.getpid()
+        _state["file"].write(json.dumps(event) + "\n")
+        _state["file"].flush()
+
+
+@contextmanager
+def span(name, category="compute", **args):
+    """Records the enclosed block as one span (no-op unless tracing is enabled)."""
+    if _state["path"] is None:
+        yield
+        return
+
+    read_start, written_start = io_counters()
+    start = time.perf_counter_ns()
+    start_epoch = time.time_ns()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter_ns() - start
+        read_end, written_end = io_counters()
+        event_args = {key: str(value) for key, value in args.items()}
+        event_args.update(read_bytes=read_end - read_start, written_bytes=written_end - written_start,
+                          peak_rss_mb=round(peak_rss_mb(), 1))
+        _write({"name": name, "cat": category, "ph": "X", "ts": start_epoch / 1000.0, "dur": duration / 1000.0,
+                "pid": os.getpid(), "tid": threading.get_ident() % 100000, "args": event_args})
+
+
+def merge(path):
+    """Merges the per-process parts into the Chrome trace at path and returns the events."""
+    events = []
+    for part in sorted(Path(parts_dir(path)).glob("*.jsonl")):
+        with open(part) as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+    events.sort(key=lambda event: event["ts"])
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return events
+
+
+def summarize(events):
+    """Rows per (category, stage): count, total/mean/max seconds, MB read/written, peak RSS."""
+    import pandas as pd
+
+    table = pd.DataFrame([{"category": e["cat"], "stage": e["name"], "pid": e["pid"], "seconds": e["dur"] / 1e6,
+                           "read_mb": e["args"]["read_bytes"] / 1024 ** 2,
+                           "written_mb": e["args"]["written_bytes"] / 1024 ** 2,
+                           "peak_rss_mb": e["args"]["peak_rss_mb"]} for e in events])
+    if table.empty:
+        return table
+    summary = table.groupby(["category", "stage"]).agg(
+        count=("seconds", "size"), total_s=("seconds", "sum"), mean_s=("seconds", "mean"), max_s=("seconds", "max"),
+        read_mb=("read_mb", "sum"), written_mb=("written_mb", "sum"), peak_rss_mb=("peak_rss_mb", "max"),
+        processes=("pid", "nunique"))
+    return summary.sort_values("total_s", ascending=False).reset_index()
+
+
+def finish():
+    """Merges the trace of all processes and writes/prints the summary."""
+    path = _state["path"]
+    if path is None:
+        return
+    if _state["file"] is not None:
+        _state["file"].close()
+        _state["file"], _state["pid"] = None, None
+
+    events = merge(path)
+    summary = summarize(events)
+    summary_path = os.path.splitext(path)[0] + "_summary.csv"
+    summary.to_csv(summary_path, index=False)
+    for part in Path(parts_dir(path)).glob("*.jsonl"):
+        part.unlink()
+    os.rmdir(parts_dir(path))
+
+    print(f"\nTrace of {len(events)} spans written to {path} (summary: {summary_path})")
+    if not summary.empty:
+        print(summary.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
@@ -0,0 +1,236 @@
+"""
+Local uncompressed cache of .nii.gz volumes, read through mmap.
+
+`build` transcodes images and labels once into plain .nii files in their native dtype (the
+decompressed gzip stream, byte for byte), each with a .json sidecar recording the source path,
+size, mtime and SHA-256. Readers open the cached .nii with mmap, so worker processes share the
+page cache instead of each decompressing into a private copy. nifti_io uses the cache
+automatically when ICH_VOLUME_CACHE points to it; entries whose source changed are ignored.
+
+Entries are evicted least recently used first (the sidecar mtime is the last access) once the
+cache exceeds its size limit; `verify` checks entries against their sources.
+
+USAGE:
+python volume_cache.py --cache_dir /scratch/ich_cache build --input /path/to/Dataset804/imagesTr /path/to/Dataset804/labelsTr --max_gb 200
+python volume_cache.py --cache_dir /scratch/ich_cache verify --deep --remove
+python volume_cache.py --cache_dir /scratch/ich_cache evict --max_gb 100
+export ICH_VOLUME_CACHE=/scratch/ich_cache
+"""
+
+import os
+import gzip
+import json
+import shutil
+import hashlib
+import argparse
+import multiprocessing
+from pathlib import Path
+import tracing
+
+
+ENV_VARIABLE = "ICH_VOLUME_CACHE"
+
+
+class _HashingReader:
+    """File wrapper that hashes the bytes read through it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+
+def default_cache_dir():
+    return os.environ.get(ENV_VARIABLE)
+
+
+def entry_paths(cache_dir, source):
+    """Cached .nii and sidecar .json of a source file."""
+    name = hashlib.sha1(os.path.abspath(source).encode("utf-8")).hexdigest()
+    base = os.path.join(cache_dir, name[:2], name)
+    return base + ".nii", base + ".json"
+
+
+def read_sidecar(sidecar):
+    try:
+        with open(sidecar) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_fresh(meta):
+    """True if the source of an entry still has the recorded size and mtime."""
+    try:
+        stat = os.stat(meta["source"])
+    except OSError:
+        return False
+    return stat.st_size == meta["source_size"] and stat.st_mtime_ns == meta["source_mtime_ns"]
+
+
+def lookup(source, cache_dir=None):
+    """Path of the cached .nii of a source, or None if it is not cached or the source changed."""
+    cache_dir = cache_dir or default_cache_dir()
+    if not cache_dir or not str(source).endswith(".nii.gz"):
+        return None
+    cached, sidecar = entry_paths(cache_dir, source)
+    meta = read_sidecar(sidecar)
+    if meta is None or not os.path.exists(cached) or not is_fresh(meta):
+        return None
+    try:
+        os.utime(sidecar)  # last access, for eviction
+    except OSError:
+        return None  # evicted concurrently; read the .nii.gz instead
+    return cached
+
+
+def add(source, cache_dir):
+    """Transcodes one .nii.gz into the cache unless an up-to-date entry exists. Returns the entry size."""
+    source = os.path.abspath(source)
+    cached, sidecar = entry_paths(cache_dir, source)
+    meta = read_sidecar(sidecar)
+    if meta is not None and os.path.exists(cached) and is_fresh(meta):
+        return meta["size"]
+
+    os.makedirs(os.path.dirname(cached), exist_ok=True)
+    stat = os.stat(source)
+    tmp = f"{cached}.{os.getpid()}.tmp"
+    with open(source, "rb") as raw, open(tmp, "wb") as out:
+        reader = _HashingReader(raw)
+        with gzip.GzipFile(fileobj=reader, mode="rb") as stream:
+            shutil.copyfileobj(stream, out, length=4 * 1024 * 1024)
+        reader.read()  # anything after the gzip member, so the hash covers the whole file
+    os.replace(tmp, cached)
+
+    meta = {"source": source, "source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns,
+            "source_sha256": reader.digest.hexdigest(), "size": os.path.getsize(cached)}
+    with open(sidecar, "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta["size"]
+
+
+def safe_add(source, cache_dir):
+    """Like add, but reports the error instead of stopping the whole build."""
+    try:
+        with tracing.span("transcode", "io", file=os.path.basename(source)):
+            return add(source, cache_dir)
+    except Exception as e:
+        print(f"Error: {source}: {e}")
+        return 0
+
+
+def entries(cache_dir):
+    """(sidecar, metadata) of all cache entries."""
+    for sidecar in sorted(Path(cache_dir).glob("*/*.json")):
+        yield str(sidecar), read_sidecar(sidecar)
+
+
+def remove(sidecar):
+    for path in (sidecar[:-len(".json")] + ".nii", sidecar):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def evict(cache_dir, max_bytes):
+    """
+    Removes entries of missing or changed sources, then the least recently used entries until
+    the cache is at most max_bytes. Returns the number of removed entries.
+    """
+    kept, removed = [], 0
+    for sidecar, meta in entries(cache_dir):
+        if meta is None or not is_fresh(meta):
+            remove(sidecar)
+            removed += 1
+        else:
+            kept.append((os.path.getmtime(sidecar), sidecar, meta["size"]))
+
+    total = sum(size for _, _, size in kept)
+    for _, sidecar, size in sorted(kept):
+        if max_bytes is None or total <= max_bytes:
+            break
+        remove(sidecar)
+        total -= size
+        removed += 1
+    return removed
+
+
+def verify(cache_dir, deep=False):
+    """
+    Returns (sidecar, problem) for every inconsistent entry: source missing or changed, cached
+    file missing or truncated, and with deep=True a source whose content hash differs.
+    """
+    from metrics_cache import hash_file
+
+    problems = []
+    for sidecar, meta in entries(cache_dir):
+        cached = sidecar[:-len(".json")] + ".nii"
+        if meta is None:
+            problems.append((sidecar, "unreadable sidecar"))
+        elif not os.path.exists(meta["source"]):
+            problems.append((sidecar, f"source missing: {meta['source']}"))
+        elif not is_fresh(meta):
+            problems.append((sidecar, f"source changed: {meta['source']}"))
+        elif not os.path.exists(cached) or os.path.getsize(cached) != meta["size"]:
+            problems.append((sidecar, "cached file missing or truncated"))
+        elif deep and hash_file(meta["source"]) != meta["source_sha256"]:
+            problems.append((sidecar, f"source content differs: {meta['source']}"))
+    return problems
+
+
+def cache_size(cache_dir):
+    return sum(meta["size"] for _, meta in entries(cache_dir) if meta is not None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Uncompressed, memory-mapped cache of .nii.gz volumes.")
+    parser.add_argument("--cache_dir", type=str, default=default_cache_dir(),
+                        help=f"Cache directory (default: ${ENV_VARIABLE}).")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Add the .nii.gz files of folders to the cache.")
+    build_parser.add_argument("--input", required=True, nargs="+", help="Folders (searched recursively) or files.")
+    build_parser.add_argument("--max_gb", type=float, default=None, help="Evict down to this size afterwards.")
+    build_parser.add_argument("--num_processes", type=int, default=os.cpu_count(), help="Number of processes.")
+
+    evict_parser = subparsers.add_parser("evict", help="Remove stale and least recently used entries.")
+    evict_parser.add_argument("--max_gb", type=float, default=None, help="Maximum size of the cache.")
+
+    verify_parser = subparsers.add_parser("verify", help="Check the entries against their source files.")
+    verify_parser.add_argument("--deep", action="store_true", help="Also compare the SHA-256 of every source.")
+    verify_parser.add_argument("--remove", action="store_true", help="Remove inconsistent entries.")
+
+    tracing.add_argument(parser)
+
+    args = parser.parse_args(argv)
+
+    tracing.enable(args.trace)
+    assert args.cache_dir, f"Please provide --cache_dir or set ${ENV_VARIABLE}."
+    max_bytes = None if getattr(args, "max_gb", None) is None else int(args.max_gb * 1024 ** 3)
+
+    if args.command == "build":
+        sources = []
+        for entry in args.input:
+            sources.extend(sorted(str(p) for p in Path(entry).rglob("*.nii.gz")) if os.path.isdir(entry) else [entry])
+        print(f"Found {len(sources)} files. Building the cache...")
+        with multiprocessing.Pool(processes=args.num_processes) as pool:
+            pool.starmap(safe_add, [(source, args.cache_dir) for source in sources])
+        removed = evict(args.cache_dir, max_bytes)
+        print(f"Cache {args.cache_dir}: {cache_size(args.cache_dir) / 1024 ** 3:.2f} GB, {removed} entries evicted")
+    elif args.command == "evict":
+        removed = evict(args.cache_dir, max_bytes)
+        print(f"Evicted {removed} entries, {cache_size(args.cache_dir) / 1024 ** 3:.2f} GB left")
+    else:
+        problems = verify(args.cache_dir, args.deep)
+        for sidecar, problem in problems:
+            print(f"{sidecar}: {problem}")
+            if args.remove:
+                remove(sidecar)
+        print(f"{len(problems)} inconsistent entries" + (" removed" if args.remove and problems else ""))
+
+
+if __name__ == "__main__":
+    main()
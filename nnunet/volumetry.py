@@ -0,0 +1,89 @@
+"""
+Volume kernel shared by the calculate_* scripts (compute_lesion_volume for the binary PH and
+edema masks, label_volumes for label maps).
+
+The mask is read in its stored dtype through the image's dataobj (no float64 copy via
+get_fdata) and every label's voxel count is taken from one bincount, accumulated slab by slab
+so the temporary index array stays small. Non-integer values and labels that are not part of
+the expected classes are reported instead of being silently dropped. With raw, the mask is
+decoded from file content that was already read into memory (see prefetch.py).
+"""
+
+import os
+import numpy as np
+from nifti_io import image_from_bytes, load_data, load_header
+import tracing
+
+
+def count_labels(mask_path, slab_size=32, raw=None):
+    """
+    Counts the voxels of every label value of a mask.
+
+    Returns a dict {label value: voxels}, the voxel volume in mm³ and a list of warnings
+    (non-integer or negative values).
+    """
+    # no scaling in the header -> the data keeps its stored (usually integer) dtype
+    if raw is None:
+        img, data = load_header(mask_path), load_data(mask_path)
+    else:
+        img = image_from_bytes(raw)
+        with tracing.span("load", "io", file=os.path.basename(str(mask_path))):
+            data = np.asanyarray(img.dataobj)
+    voxel_volume = float(np.prod(img.header.get_zooms()[:3]))
+    warnings = []
+
+    if not np.issubdtype(data.dtype, np.integer):
+        non_integer = np.count_nonzero(np.mod(data, 1))
+        if non_integer:
+            warnings.append(f"{non_integer} voxels with non-integer values (rounded)")
+        data = np.rint(data)
+
+    offset = int(data.min(initial=0))
+    if offset < 0:
+        warnings.append(f"negative label values down to {offset}")
+    size = int(data.max(initial=0)) - offset + 1
+
+    counts = np.zeros(size, dtype=np.int64)
+    with tracing.span("count labels", "compute", file=os.path.basename(str(mask_path))):
+        # nibabel arrays are Fortran ordered, so slabs along the last axis are contiguous
+        for start in range(0, data.shape[-1], slab_size):
+            slab = data[..., start:start + slab_size]
+            if offset:
+                slab = slab.astype(np.int64) - offset
+            counts += np.bincount(slab.astype(np.intp, copy=False).ravel(), minlength=size)
+
+    label_counts = {value + offset: int(count) for value, count in enumerate(counts) if count}
+    return label_counts, voxel_volume, warnings
+
+
+def label_volumes(mask_path, class_labels, raw=None):
+    """
+    Voxels, volume in mm³ and volume in mL of every class of a mask, plus the background and
+    the total over all non-background classes.
+    Label values other than the background (0) and the given classes are reported.
+    """
+    label_counts, voxel_volume, warnings = count_labels(mask_path, raw=raw)
+
+    expected = set(class_labels.values()) | {0}
+    unexpected = {value: count for value, count in label_counts.items() if value not in expected}
+    if unexpected:
+        warnings.append(f"unexpected label values (value: voxels) {unexpected}")
+    for warning in warnings:
+        print(f"Warning: {mask_path}: {warning}")
+
+    def volumes(voxels):
+        return {"voxels": voxels, "volume_mm3": voxels * voxel_volume, "volume_ml": voxels * voxel_volume / 1000.0}
+
+    results = {"background": volumes(label_counts.get(0, 0))}
+    for label_name, label_value in class_labels.items():
+        if label_name != "background":
+            results[label_name] = volumes(label_counts.get(label_value, 0))
+
+    results["total"] = volumes(sum(results[name]["voxels"] for name in class_labels if name != "background"))
+    return results
+
+
+def compute_lesion_volume(mask_path, raw=None):
+    """Returns the number of lesion voxels and the lesion volume in mm³ and mL of a binary mask (label 1)."""
+    results = label_volumes(mask_path, {"lesion": 1}, raw)["lesion"]
+    return results["voxels"], results["volume_mm3"], results["volume_ml"]
@@ -0,0 +1,49 @@
+import os
+import sys
+
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "nnunet"))
+
+import volume_cache  # noqa: E402
+import compute_multi_class_metrics  # noqa: E402
+import volumetry  # noqa: E402
+
+
+def write_mask(path):
+    data = np.zeros((16, 12, 8), dtype=np.uint8)
+    data[2:6, 3:7, 1:4] = 1
+    data[8:10, 1:3, 5:7] = 2
+    nib.save(nib.Nifti1Image(data, np.diag([0.5, 0.5, 5.0, 1.0])), path)
+    return data
+
+
+def test_cached_read_is_memmap(tmp_path, monkeypatch):
+    mask = str(tmp_path / "ICH00001_lesionmask.nii.gz")
+    data = write_mask(mask)
+    cache_dir = str(tmp_path / "cache")
+    volume_cache.add(mask, cache_dir)
+
+    monkeypatch.setenv(volume_cache.ENV_VARIABLE, cache_dir)
+    cached = compute_multi_class_metrics.load_label_map(mask)
+    assert isinstance(cached, np.memmap)
+    np.testing.assert_array_equal(cached, data)
+
+    label_counts, voxel_volume, _ = volumetry.count_labels(mask)
+    assert label_counts == {0: data.size - 56, 1: 48, 2: 8}
+    assert voxel_volume == 1.25
+
+
+def test_changed_source_is_read_from_the_file(tmp_path, monkeypatch):
+    mask = str(tmp_path / "ICH00001_lesionmask.nii.gz")
+    write_mask(mask)
+    cache_dir = str(tmp_path / "cache")
+    volume_cache.add(mask, cache_dir)
+
+    data = np.ones((16, 12, 8), dtype=np.uint8)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), mask)
+    monkeypatch.setenv(volume_cache.ENV_VARIABLE, cache_dir)
+    fresh = compute_multi_class_metrics.load_label_map(mask)
+    assert not isinstance(fresh, np.memmap)
+    np.testing.assert_array_equal(fresh, data)